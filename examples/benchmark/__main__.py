@@ -0,0 +1,326 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import pathlib
+import platform
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import _load
+import _serve
+import _upstream
+
+
+HERE = pathlib.Path(__file__).resolve().parent
+HOST = "127.0.0.1"
+STARTUP_TIMEOUT = 10.0
+SHUTDOWN_TIMEOUT = 30.0
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as socket_:
+        socket_.bind((HOST, 0))
+        return socket_.getsockname()[1]
+
+
+def _wait_for_port(port):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while True:
+        try:
+            socket.create_connection((HOST, port), timeout=1.0).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def _quiet():
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    os.close(devnull)
+
+
+def _run_upstream(kind, port, response_size):
+    _quiet()
+    _upstream.serve_upstream(kind, HOST, port, response_size)
+
+
+def _run_proxy(proxy_kwargs):
+    _quiet()
+    _serve.serve_proxy(**proxy_kwargs)
+
+
+def _process_tree(pid):
+    """Find a process and all of its descendants (Linux only)."""
+    pids = [pid]
+    index = 0
+    while index < len(pids):
+        task_dir = pathlib.Path(f"/proc/{pids[index]}/task")
+        for children in task_dir.glob("*/children"):
+            pids.extend(int(child) for child in children.read_text().split())
+        index += 1
+    return pids
+
+
+def _process_stats(pid):
+    """Measure the CPU time and RSS of a process tree.
+
+    Returns:
+        Optional[Tuple[float, int]]: The CPU time (in seconds) and peak RSS
+        (in bytes) summed over the process and its descendants, or
+        :data:`None` if ``/proc`` is not available.
+    """
+    cpu_seconds = 0.0
+    max_rss = 0
+    try:
+        for tree_pid in _process_tree(pid):
+            stat = pathlib.Path(f"/proc/{tree_pid}/stat").read_text()
+            # Skip past the command name, which may contain spaces.
+            fields = stat[stat.rindex(")") + 2 :].split()
+            cpu_seconds += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+            status = pathlib.Path(f"/proc/{tree_pid}/status").read_text()
+            for line in status.splitlines():
+                if line.startswith("VmHWM:"):
+                    max_rss += int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        return None
+    return cpu_seconds, max_rss
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=HERE,
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _run_case(context, args, upstream_port, case, replay_dir):
+    """Run one benchmark case, with or without the proxy in front."""
+    request = _upstream.encode_request(args.upstream, case["chunk_size"])
+    expected = _upstream.response_size(
+        args.upstream, request, args.response_size
+    )
+    target_port = upstream_port
+    proxy = None
+    if case["engine"] != "direct":
+        target_port = _free_port()
+        proxy_kwargs = {
+            "proxy_port": target_port,
+            "server_host": HOST,
+            "server_port": upstream_port,
+            "replay_log": replay_dir / f"replay-{target_port}.log",
+            "engine": case["engine"],
+            "workers": args.workers,
+            "zero_copy": args.zero_copy,
+            "capture": case["capture"],
+        }
+        proxy = context.Process(target=_run_proxy, args=(proxy_kwargs,))
+        proxy.start()
+        _wait_for_port(target_port)
+
+    before = None if proxy is None else _process_stats(proxy.pid)
+    start = time.monotonic()
+    result = _load.run_load(
+        host=HOST,
+        port=target_port,
+        connections=case["connections"],
+        request=request,
+        expected=expected,
+        warmup=args.warmup,
+        duration=args.duration,
+    )
+    elapsed = time.monotonic() - start
+    after = None if proxy is None else _process_stats(proxy.pid)
+    if proxy is not None:
+        os.kill(proxy.pid, signal.SIGINT)
+        proxy.join(SHUTDOWN_TIMEOUT)
+        if proxy.is_alive():
+            proxy.kill()
+            proxy.join()
+
+    result.update(case)
+    if before is not None and after is not None:
+        result["proxy_cpu_seconds"] = after[0] - before[0]
+        result["proxy_cpu_percent"] = 100 * (after[0] - before[0]) / elapsed
+        result["proxy_max_rss_bytes"] = after[1]
+    return result
+
+
+def _add_overhead(results):
+    """Compute the latency added by the proxy, relative to ``"direct"``."""
+    baselines = {
+        (result["connections"], result["chunk_size"]): result["latency_ms"]
+        for result in results
+        if result["engine"] == "direct"
+    }
+    for result in results:
+        baseline = baselines.get((result["connections"], result["chunk_size"]))
+        if result["engine"] == "direct" or baseline is None:
+            continue
+        result["added_latency_ms"] = {
+            name: result["latency_ms"][name] - baseline[name]
+            for name in ("p50", "p99")
+            if name in result["latency_ms"] and name in baseline
+        }
+
+
+def _display_result(result):
+    latency = result["latency_ms"]
+    added = result.get("added_latency_ms", {})
+    cpu = result.get("proxy_cpu_percent")
+    capture = "-" if result["engine"] == "direct" else result["capture"]
+    print(
+        f"{result['engine']:>8} capture={capture!s:<5} "
+        f"conns={result['connections']:<4} size={result['chunk_size']:<7} "
+        f"{result['exchanges_per_second']:>10.1f} req/s "
+        f"p50={latency.get('p50', 0.0):.3f}ms "
+        f"p99={latency.get('p99', 0.0):.3f}ms "
+        f"added_p50={added.get('p50', 0.0):.3f}ms "
+        f"added_p99={added.get('p99', 0.0):.3f}ms "
+        + ("" if cpu is None else f"cpu={cpu:.0f}% ")
+        + f"errors={len(result['errors'])}",
+        flush=True,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Benchmark the proxy in front of a local stand-in upstream and "
+            "save the results as JSON"
+        )
+    )
+    parser.add_argument(
+        "--upstream", choices=_upstream.UPSTREAMS, default="echo"
+    )
+    parser.add_argument(
+        "--response-size",
+        type=int,
+        default=0x2000,
+        help="Response payload size for the request-response upstream",
+    )
+    parser.add_argument(
+        "--engines",
+        nargs="+",
+        choices=_serve.ENGINES,
+        default=list(_serve.ENGINES),
+    )
+    parser.add_argument(
+        "--connections", type=int, nargs="+", default=[1, 16, 64]
+    )
+    parser.add_argument(
+        "--chunk-sizes", type=int, nargs="+", default=[64, 0x1000, 0x10000]
+    )
+    parser.add_argument(
+        "--capture",
+        choices=("on", "off"),
+        nargs="+",
+        default=["on", "off"],
+    )
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--zero-copy", action="store_true")
+    parser.add_argument("--warmup", type=float, default=1.0)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument(
+        "--output",
+        default="benchmark.json",
+        help="File where the results are written",
+    )
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("fork")
+    upstream_port = _free_port()
+    upstream = context.Process(
+        target=_run_upstream,
+        args=(args.upstream, upstream_port, args.response_size),
+    )
+    upstream.start()
+    results = []
+    try:
+        _wait_for_port(upstream_port)
+        cases = [
+            {
+                "engine": "direct",
+                "capture": False,
+                "connections": connections,
+                "chunk_size": chunk_size,
+            }
+            for connections, chunk_size in itertools.product(
+                args.connections, args.chunk_sizes
+            )
+        ]
+        cases.extend(
+            {
+                "engine": engine,
+                "capture": capture == "on",
+                "connections": connections,
+                "chunk_size": chunk_size,
+            }
+            for engine, capture, connections, chunk_size in itertools.product(
+                args.engines, args.capture, args.connections, args.chunk_sizes
+            )
+        )
+        with tempfile.TemporaryDirectory() as replay_dir:
+            for case in cases:
+                result = _run_case(
+                    context,
+                    args,
+                    upstream_port,
+                    case,
+                    pathlib.Path(replay_dir),
+                )
+                results.append(result)
+                _add_overhead(results)
+                _display_result(result)
+    finally:
+        upstream.terminate()
+        upstream.join()
+
+    output = {
+        "metadata": {
+            "commit": _git_commit(),
+            "python": sys.version,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "time": time.time(),
+            "upstream": args.upstream,
+            "response_size": args.response_size,
+            "workers": args.workers,
+            "zero_copy": args.zero_copy,
+            "warmup": args.warmup,
+            "duration": args.duration,
+        },
+        "results": results,
+    }
+    pathlib.Path(args.output).write_text(json.dumps(output, indent=2) + "\n")
+    print(f"Wrote {len(results)} results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
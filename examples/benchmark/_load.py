@@ -0,0 +1,100 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import time
+
+import _histogram
+
+
+async def _drive_connection(
+    host, port, request, expected, warmup_until, deadline, latencies, totals
+):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while True:
+            start_ns = time.perf_counter_ns()
+            if start_ns >= deadline:
+                break
+            writer.write(request)
+            await writer.drain()
+            await reader.readexactly(expected)
+            end_ns = time.perf_counter_ns()
+            if start_ns >= warmup_until:
+                latencies.record(end_ns - start_ns)
+                totals[0] += 1
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+async def _drive(
+    host, port, connections, request, expected, warmup, duration
+):
+    latencies = _histogram.Histogram()
+    # The number of exchanges completed after the warmup.
+    totals = [0]
+    now_ns = time.perf_counter_ns()
+    warmup_until = now_ns + int(warmup * 1e9)
+    deadline = warmup_until + int(duration * 1e9)
+    results = await asyncio.gather(
+        *(
+            _drive_connection(
+                host,
+                port,
+                request,
+                expected,
+                warmup_until,
+                deadline,
+                latencies,
+                totals,
+            )
+            for _ in range(connections)
+        ),
+        return_exceptions=True,
+    )
+    errors = [repr(result) for result in results if result is not None]
+    return latencies, totals[0], errors
+
+
+def run_load(
+    *, host, port, connections, request, expected, warmup, duration
+):
+    """Drive closed-loop load against a server.
+
+    Each connection repeatedly sends ``request`` and waits for the full
+    response before sending the next one. Exchanges during the warmup are
+    not measured.
+
+    Args:
+        host (str): The host of the server.
+        port (int): The port of the server.
+        connections (int): The number of concurrent connections.
+        request (bytes): The request sent on each exchange.
+        expected (int): The size of the response to each request.
+        warmup (float): The time (in seconds) before measuring starts.
+        duration (float): The time (in seconds) to measure for.
+
+    Returns:
+        Dict[str, Any]: The exchanges per second, bytes (sent and received)
+        per second, latency percentiles (in milliseconds) and any errors.
+    """
+    latencies, exchanges, errors = asyncio.run(
+        _drive(host, port, connections, request, expected, warmup, duration)
+    )
+    return {
+        "exchanges": exchanges,
+        "exchanges_per_second": exchanges / duration,
+        "bytes_per_second": exchanges * (len(request) + expected) / duration,
+        "latency_ms": latencies.summary(scale=1e6),
+        "errors": errors,
+    }
@@ -0,0 +1,114 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import os
+import struct
+
+
+UPSTREAMS = ("echo", "request-response")
+# A request / response message is a length prefix followed by the payload,
+# similar to a PostgreSQL message.
+LENGTH_STRUCT = struct.Struct(">I")
+READ_SIZE = 0x10000
+
+
+async def _handle_echo(reader, writer):
+    try:
+        chunk = await reader.read(READ_SIZE)
+        while chunk:
+            writer.write(chunk)
+            await writer.drain()
+            chunk = await reader.read(READ_SIZE)
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+def _make_request_response_handler(response_size):
+    response = LENGTH_STRUCT.pack(response_size) + os.urandom(response_size)
+
+    async def _handle(reader, writer):
+        try:
+            while True:
+                header = await reader.readexactly(LENGTH_STRUCT.size)
+                (size,) = LENGTH_STRUCT.unpack(header)
+                await reader.readexactly(size)
+                writer.write(response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return _handle
+
+
+async def _serve(kind, host, port, response_size):
+    if kind == "echo":
+        handler = _handle_echo
+    else:
+        handler = _make_request_response_handler(response_size)
+    server = await asyncio.start_server(handler, host, port, backlog=1024)
+    async with server:
+        await server.serve_forever()
+
+
+def serve_upstream(kind, host, port, response_size):
+    """Serve a stand-in upstream server (until the process is terminated).
+
+    Args:
+        kind (str): One of :data:`UPSTREAMS`. An ``"echo"`` upstream sends
+            back every byte it receives; a ``"request-response"`` upstream
+            reads length-prefixed requests and answers each one with a
+            length-prefixed response of ``response_size`` bytes.
+        host (str): The host to bind.
+        port (int): The port to bind.
+        response_size (int): The size of each response payload; only used
+            by a ``"request-response"`` upstream.
+    """
+    asyncio.run(_serve(kind, host, port, response_size))
+
+
+def encode_request(kind, chunk_size):
+    """Encode the request sent by the load generator.
+
+    Args:
+        kind (str): One of :data:`UPSTREAMS`.
+        chunk_size (int): The size of the request.
+
+    Returns:
+        bytes: The request; for a ``"request-response"`` upstream, the
+        length prefix is included in ``chunk_size``.
+    """
+    if kind == "echo":
+        return os.urandom(chunk_size)
+    payload_size = max(chunk_size - LENGTH_STRUCT.size, 0)
+    return LENGTH_STRUCT.pack(payload_size) + os.urandom(payload_size)
+
+
+def response_size(kind, request, payload_size):
+    """Determine the size of the response to a request.
+
+    Args:
+        kind (str): One of :data:`UPSTREAMS`.
+        request (bytes): The request.
+        payload_size (int): The size of each response payload for a
+            ``"request-response"`` upstream.
+
+    Returns:
+        int: The number of bytes in the response.
+    """
+    if kind == "echo":
+        return len(request)
+    return LENGTH_STRUCT.size + payload_size
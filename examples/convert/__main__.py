@@ -0,0 +1,48 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import pathlib
+
+import _merge_replay_log
+import _replay_format
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert a replay log to another format version"
+    )
+    parser.add_argument(
+        "--source", required=True, help="Replay log to convert"
+    )
+    parser.add_argument(
+        "--filename", required=True, help="File for the converted replay log"
+    )
+    parser.add_argument(
+        "--version",
+        type=int,
+        choices=_replay_format.VERSIONS,
+        default=_replay_format.VERSION_2,
+        help="Format version of the converted replay log",
+    )
+    args = parser.parse_args()
+
+    source = pathlib.Path(args.source).resolve()
+    filename = pathlib.Path(args.filename).resolve()
+    count = _merge_replay_log.convert_replay_log(
+        source, filename, args.version
+    )
+    print(f"Converted {count} records into {filename}")
+
+
+if __name__ == "__main__":
+    main()
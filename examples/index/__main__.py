@@ -0,0 +1,47 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import pathlib
+
+import _index
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build a sidecar index for an existing replay log"
+    )
+    parser.add_argument(
+        "--filename", required=True, help="Replay log to build an index for"
+    )
+    parser.add_argument(
+        "--parts",
+        type=int,
+        default=0,
+        help="Also split the replay log into this many byte ranges",
+    )
+    args = parser.parse_args()
+
+    replay_log = pathlib.Path(args.filename).resolve()
+    count = _index.build_index(replay_log)
+    index_file = _index.index_filename(replay_log)
+    print(f"Indexed {count} records in {index_file}")
+
+    if args.parts > 0:
+        index = _index.load_index(index_file)
+        file_size = replay_log.stat().st_size
+        for start, end in index.split(args.parts, file_size):
+            print(f"{start:d}-{end:d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -42,6 +42,12 @@ func runParse(filename string) error {
 	i := 0
 
 	for err == nil {
+		if tp.Direction != parse.ClientToServer {
+			// Only frontend (client) messages are parsed.
+			tp, err = rls.Next()
+			continue
+		}
+
 		fm, parseErr := postgres.ParseChunk(tp.Chunk)
 		if parseErr != nil {
 			return parseErr
@@ -0,0 +1,69 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import json
+import os
+import pathlib
+
+import _profile
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Profile the workload captured in a replay log"
+    )
+    parser.add_argument(
+        "--filename", required=True, help="Replay log to profile"
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes the replay log is split across",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=_profile.TOP_N,
+        help="Number of most frequent payload prefixes to report",
+    )
+    parser.add_argument(
+        "--prefix-bytes",
+        type=int,
+        default=_profile.PREFIX_BYTES,
+        help="Number of bytes of each client chunk counted as its prefix",
+    )
+    parser.add_argument(
+        "--postgres",
+        action="store_true",
+        help="Count PostgreSQL query texts rather than raw prefixes",
+    )
+    parser.add_argument(
+        "--json", action="store_true", help="Print the summary as JSON"
+    )
+    args = parser.parse_args()
+
+    profile = _profile.profile_replay_log(
+        pathlib.Path(args.filename).resolve(),
+        processes=args.processes,
+        prefix_bytes=args.prefix_bytes,
+        postgres=args.postgres,
+    )
+    if args.json:
+        print(json.dumps(profile.summary(top=args.top), indent=2))
+    else:
+        profile.display(top=args.top)
+
+
+if __name__ == "__main__":
+    main()
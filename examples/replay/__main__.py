@@ -0,0 +1,73 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import json
+import pathlib
+
+import _replay
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay a captured log against a running server"
+    )
+    parser.add_argument(
+        "--filename", required=True, help="Replay log to replay"
+    )
+    parser.add_argument(
+        "--server-host", default="localhost", help="Host of the server"
+    )
+    parser.add_argument(
+        "--server-port", type=int, default=5432, help="Port of the server"
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="Speed multiplier applied to the original timing",
+    )
+    parser.add_argument(
+        "--as-fast-as-possible",
+        action="store_true",
+        help="Ignore the original timing",
+    )
+    parser.add_argument(
+        "--response-timeout",
+        type=float,
+        default=_replay.RESPONSE_TIMEOUT,
+        help=(
+            "Seconds to wait for a response (to a chunk that got one in the "
+            "capture) before sending the next chunk (0 never waits)"
+        ),
+    )
+    parser.add_argument(
+        "--json", action="store_true", help="Print the summary as JSON"
+    )
+    args = parser.parse_args()
+
+    speed = None if args.as_fast_as_possible else args.speed
+    stats = _replay.replay(
+        filename=pathlib.Path(args.filename).resolve(),
+        server_host=args.server_host,
+        server_port=args.server_port,
+        speed=speed,
+        response_timeout=args.response_timeout,
+    )
+    if args.json:
+        print(json.dumps(stats.summary(), indent=2))
+    else:
+        stats.display()
+
+
+if __name__ == "__main__":
+    main()
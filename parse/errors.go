@@ -20,4 +20,10 @@ var (
 	// ErrParsingIP indicates a failure occurred when parsing an IP address.
 	// This is necessary because `net.ParseIP()` does not return an error.
 	ErrParsingIP = errors.New("Failed to parse IP address")
+	// ErrUnsupportedVersion indicates a replay log header has a version that
+	// is not supported.
+	ErrUnsupportedVersion = errors.New("Unsupported replay log version")
+	// ErrUnsupportedFlags indicates a replay log header has flags that are
+	// not supported.
+	ErrUnsupportedFlags = errors.New("Unsupported replay log flags")
 )
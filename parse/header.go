@@ -0,0 +1,77 @@
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     https://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+package parse
+
+import (
+	"bufio"
+	"bytes"
+	"fmt"
+	"io"
+)
+
+const (
+	// Version is the replay log format version understood by this package.
+	// A replay log without a header is also this version, with no flags.
+	Version = 1
+	// FlagDirection indicates each "row" has a direction byte after its
+	// timestamp.
+	FlagDirection = 0x01
+	// knownFlags is the union of all flags understood by this package.
+	knownFlags = FlagDirection
+	// headerSize is the size of the magic, version and flags.
+	headerSize = 10
+)
+
+var (
+	// Magic is the start of the header of a replay log. Since a replay log
+	// without a header starts with a timestamp, the `0x89` byte can't be the
+	// start of a header-less replay log.
+	Magic = []byte("\x89TRPLOG\n")
+)
+
+// Header is the (optional) header at the start of a replay log.
+type Header struct {
+	Version uint8
+	Flags   uint8
+}
+
+// ReadHeader reads the header (if any) at the start of a replay log. If the
+// replay log doesn't start with `Magic`, nothing is consumed from the reader.
+func ReadHeader(br *bufio.Reader) (Header, error) {
+	prefix, err := br.Peek(len(Magic))
+	if err != nil && err != io.EOF {
+		return Header{}, err
+	}
+	if !bytes.Equal(prefix, Magic) {
+		return Header{Version: Version}, nil
+	}
+
+	var headerBytes [headerSize]byte
+	_, err = io.ReadFull(br, headerBytes[:])
+	if err == io.EOF {
+		err = io.ErrUnexpectedEOF
+	}
+	if err != nil {
+		return Header{}, err
+	}
+
+	h := Header{Version: headerBytes[8], Flags: headerBytes[9]}
+	if h.Version != Version {
+		return Header{}, fmt.Errorf("%w; Version=%d", ErrUnsupportedVersion, h.Version)
+	}
+	if h.Flags&^knownFlags != 0 {
+		return Header{}, fmt.Errorf("%w; Flags=%#x", ErrUnsupportedFlags, h.Flags)
+	}
+
+	return h, nil
+}
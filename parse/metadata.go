@@ -22,18 +22,38 @@ import (
 	"time"
 )
 
+// Direction indicates which side of a connection sent a TCP packet.
+type Direction uint8
+
+const (
+	// ClientToServer indicates a TCP packet sent from the client to the
+	// server. Every "row" in a replay log without `FlagDirection` has this
+	// direction.
+	ClientToServer Direction = 0
+	// ServerToClient indicates a TCP packet sent from the server to the
+	// client.
+	ServerToClient Direction = 1
+)
+
 // TCPPacket represents a "row" from a replay file containing a TCP packet
 // and associated metadata.
 type TCPPacket struct {
 	Timestamp  time.Time
+	Direction  Direction
 	ClientAddr Addr
 	ServerAddr Addr
 	Chunk      []byte
 }
 
-// Read reads and parses the next "row" in a replay log into the
-// current receiver.
+// Read reads and parses the next "row" in a replay log (without any header
+// flags) into the current receiver.
 func (tp *TCPPacket) Read(br *bufio.Reader) (bytesRead int, err error) {
+	return tp.ReadWithFlags(br, 0)
+}
+
+// ReadWithFlags reads and parses the next "row" in a replay log into the
+// current receiver, using the flags from the replay log header.
+func (tp *TCPPacket) ReadWithFlags(br *bufio.Reader, flags uint8) (bytesRead int, err error) {
 	var tsBytes [8]byte
 	n, err := io.ReadFull(br, tsBytes[:])
 	bytesRead += n
@@ -46,6 +66,17 @@ func (tp *TCPPacket) Read(br *bufio.Reader) (bytesRead int, err error) {
 	nsec := tsNanos % 1_000_000_000
 	tp.Timestamp = time.Unix(int64(sec), int64(nsec)).UTC()
 
+	tp.Direction = ClientToServer
+	if flags&FlagDirection != 0 {
+		var directionByte byte
+		directionByte, err = br.ReadByte()
+		if err != nil {
+			return
+		}
+		bytesRead++
+		tp.Direction = Direction(directionByte)
+	}
+
 	clientAddrBytes, err := br.ReadBytes(' ')
 	bytesRead += len(clientAddrBytes)
 	if err != nil {
@@ -19,7 +19,9 @@ import (
 
 // ReplayLogStream parses an input stream of replay log "rows".
 type ReplayLogStream struct {
-	br *bufio.Reader
+	br         *bufio.Reader
+	header     Header
+	headerRead bool
 }
 
 // NewReplayLogStream produces a ReplayLogStream that wraps a reader.
@@ -28,10 +30,30 @@ func NewReplayLogStream(r io.Reader) *ReplayLogStream {
 	return &ReplayLogStream{br: br}
 }
 
+// Header produces the header of the replay log; this reads the header from
+// the stream if it has not been read yet.
+func (rls *ReplayLogStream) Header() (Header, error) {
+	if !rls.headerRead {
+		h, err := ReadHeader(rls.br)
+		if err != nil {
+			return Header{}, err
+		}
+		rls.header = h
+		rls.headerRead = true
+	}
+
+	return rls.header, nil
+}
+
 // Next produces the next parsed `*TCPPacket` in the stream.
 func (rls *ReplayLogStream) Next() (*TCPPacket, error) {
+	h, err := rls.Header()
+	if err != nil {
+		return nil, err
+	}
+
 	tp := &TCPPacket{}
-	n, err := tp.Read(rls.br)
+	n, err := tp.ReadWithFlags(rls.br, h.Flags)
 	if err == io.EOF && n != 0 {
 		return nil, io.ErrUnexpectedEOF
 	}
@@ -0,0 +1,310 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import queue
+import socket
+import time
+
+import _buffer
+import _connect
+import _display
+import _metrics
+import _replay_format
+
+
+def _put_all(log_queue, log_lines):
+    for log_line in log_lines:
+        log_queue.put(log_line)
+
+
+async def _log_line(loop, log_queue, tcp_chunk, connection, direction):
+    """Send a log line to the log queue, if set, without stalling the loop.
+
+    This is the ``asyncio`` analog of :func:`_connect.maybe_log_line`. If a
+    log line can't be pushed without waiting (i.e. with the ``"block"``
+    overflow policy, or ``"spill"`` with the spill thread behind), it and
+    the rest of the log lines for the chunk are pushed from a worker thread,
+    so that only this connection waits (as with the threaded relay).
+
+    Returns:
+        bool: Indicates if the connection is still captured (as for
+        :func:`_connect.maybe_log_line`).
+    """
+    if log_queue is None:
+        return False
+
+    log_lines = _connect.capture_log_lines(tcp_chunk, connection, direction)
+    if log_lines is None:
+        return False
+    for index, log_line in enumerate(log_lines):
+        try:
+            log_queue.put_nowait(log_line)
+        except queue.Full:
+            await loop.run_in_executor(
+                None, _put_all, log_queue, log_lines[index:]
+            )
+            break
+    return True
+
+
+async def _relay(
+    loop,
+    recv_socket,
+    send_socket,
+    log_queue,
+    connection,
+    direction,
+    relay_metrics,
+    zero_copy,
+):
+    if zero_copy:
+        buffer_view = memoryview(bytearray(_buffer.DEFAULT_BUFFER_SIZE))
+        size = await loop.sock_recv_into(recv_socket, buffer_view)
+        while size != 0:
+            received_ns = time.perf_counter_ns()
+            is_full = size == len(buffer_view)
+            relayed = size
+            if log_queue is None:
+                await loop.sock_sendall(send_socket, buffer_view[:size])
+            else:
+                tcp_chunks = [buffer_view[:size]]
+                if is_full:
+                    tcp_chunks.extend(_buffer.drain(recv_socket, size))
+                if not await _log_line(
+                    loop,
+                    log_queue,
+                    b"".join(tcp_chunks),
+                    connection,
+                    direction,
+                ):
+                    log_queue = None
+                for tcp_chunk in tcp_chunks:
+                    await loop.sock_sendall(send_socket, tcp_chunk)
+                relayed = sum(len(tcp_chunk) for tcp_chunk in tcp_chunks)
+            relay_metrics.observe(
+                relayed, time.perf_counter_ns() - received_ns
+            )
+
+            if is_full and size < _buffer.MAX_BUFFER_SIZE:
+                buffer_view = memoryview(bytearray(2 * size))
+            # Read the next chunk from the socket.
+            size = await loop.sock_recv_into(recv_socket, buffer_view)
+    else:
+        buffer_size = _buffer.DEFAULT_BUFFER_SIZE
+        tcp_chunk = await loop.sock_recv(recv_socket, buffer_size)
+        while tcp_chunk != b"":
+            received_ns = time.perf_counter_ns()
+            if log_queue is not None and len(tcp_chunk) == buffer_size:
+                tcp_chunks = _buffer.drain(recv_socket, buffer_size)
+                tcp_chunk = b"".join([tcp_chunk, *tcp_chunks])
+            if not await _log_line(
+                loop, log_queue, tcp_chunk, connection, direction
+            ):
+                log_queue = None
+
+            await loop.sock_sendall(send_socket, tcp_chunk)
+            relay_metrics.observe(
+                len(tcp_chunk), time.perf_counter_ns() - received_ns
+            )
+            # Read the next chunk from the socket.
+            buffer_size = _buffer.next_buffer_size(buffer_size, len(tcp_chunk))
+            tcp_chunk = await loop.sock_recv(recv_socket, buffer_size)
+
+
+async def redirect_socket(
+    loop,
+    recv_socket,
+    send_socket,
+    description,
+    log_queue,
+    connection,
+    direction,
+    zero_copy,
+):
+    """Redirect a TCP stream from one socket to another.
+
+    This is the ``asyncio`` analog of :func:`_connect.redirect_socket`; it
+    only redirects in **one** direction, i.e. it RECVs from ``recv_socket``
+    and SENDs to ``send_socket``. As with the threaded relay, reads are
+    sized adaptively and a captured read that fills its buffer is followed
+    by ``_buffer.drain()`` so that one logical write is captured as one
+    chunk. Once ``recv_socket`` reaches EOF, it is propagated to the peer
+    with ``_connect.half_close()``.
+
+    Args:
+        loop (asyncio.AbstractEventLoop): The event loop driving the sockets.
+        recv_socket (socket.socket): The socket that will be RECV-ed from.
+        send_socket (socket.socket): The socket that will be SENT to.
+        description (str): A description of the RECV->SEND relationship for
+            this socket pair.
+        log_queue (Optional[queue.Queue]): The queue where log lines will be
+            pushed, or :data:`None`.
+        connection (Optional[_save_replay_log.Connection]): The connection
+            being relayed; only used if ``log_queue`` is set.
+        direction (int): The direction being relayed; used to capture log
+            lines and to select the relay metrics to update.
+        zero_copy (bool): Indicates if chunks should be read into a single
+            preallocated buffer (reused for the lifetime of the connection)
+            rather than into a new ``bytes`` object for every chunk.
+    """
+    relay_metrics = _metrics.RELAY[direction].shard()
+    try:
+        await _relay(
+            loop,
+            recv_socket,
+            send_socket,
+            log_queue,
+            connection,
+            direction,
+            relay_metrics,
+            zero_copy,
+        )
+    finally:
+        _metrics.RELAY[direction].close(relay_metrics)
+
+    _connect.half_close(send_socket)
+    _display.display(f"Done redirecting socket for {description}")
+
+
+async def connect_socket_pair(
+    log_queue,
+    client_socket,
+    client_addr,
+    server_host,
+    server_port,
+    zero_copy=False,
+    capture_responses=False,
+    upstream_pool=None,
+    capture_policy=None,
+):
+    """Connect two socket pairs for bidirectional RECV<->SEND.
+
+    Rather than spawning two threads (as :func:`_connect.connect_socket_pair`
+    does), both directions are relayed as tasks on the running event loop.
+    An EOF in one direction is propagated as a half-close and the other
+    direction keeps running; if either direction fails (or the handler is
+    cancelled), the other is cancelled. Once both are done, both sockets are
+    closed. A connection that ``capture_policy`` decides not to capture is
+    relayed through preallocated buffers without touching the capture path.
+
+    .. note::
+
+        Log lines are pushed to ``log_queue`` directly from the event loop
+        unless the push would wait (e.g. with the ``"block"`` overflow
+        policy), in which case it is done from a worker thread. Either way,
+        a full queue only stalls the connection that produced the log line.
+
+    Args:
+        log_queue (Optional[queue.Queue]): The queue where log lines will be
+            pushed, or :data:`None` to relay without capturing.
+        client_socket (socket.socket): An already open (non-blocking) socket
+            from a client that has made a request directly to a running
+            ``tcp-replay-reverse-proxy`` proxy.
+        client_addr (str): The address of the client socket; used for printing
+            information about the connection.
+        server_host (str): The host name where the "server" process is running
+            (i.e. the server that is being proxied).
+        server_port (int): A port number for a running "server" process.
+        zero_copy (Optional[bool]): Indicates if chunks should be read into a
+            preallocated buffer per direction. (Moving uncaptured chunks with
+            ``splice(2)`` is only supported by the ``"threads"`` engine.)
+        capture_responses (Optional[bool]): Indicates if the chunks sent
+            from the server to the client should also be logged.
+        upstream_pool (Optional[_upstream_pool.UpstreamPool]): A pool of
+            already connected server sockets to take from. If not set (or if
+            the pool is empty), a new connection is opened.
+        capture_policy (Optional[_capture_policy.CapturePolicy]): Decides if
+            (and how much of) the connection is captured. If not set, the
+            whole connection is captured.
+    """
+    if not _connect.should_capture(log_queue, client_addr, capture_policy):
+        # NOTE: Only a connection the policy skipped is forced onto the
+        #       zero-copy relay; with capture off altogether, ``zero_copy``
+        #       is honored as given.
+        if log_queue is not None:
+            zero_copy = True
+        log_queue = None
+
+    loop = asyncio.get_running_loop()
+    server_addr = f"{server_host}:{server_port}"
+    server_socket = None
+    if upstream_pool is not None:
+        server_socket = upstream_pool.get()
+    if server_socket is None:
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setblocking(0)
+        try:
+            await asyncio.wait_for(
+                loop.sock_connect(server_socket, (server_host, server_port)),
+                _connect.CONNECT_TIMEOUT,
+            )
+        except (OSError, asyncio.TimeoutError) as exc:
+            _metrics.CONNECT_FAILURES.inc()
+            _display.display(
+                f"Failed to connect to server({server_addr}): {exc!r}"
+            )
+            server_socket.close()
+            client_socket.close()
+            return
+
+    try:
+        connection = _connect.capture_connection(
+            log_queue, client_socket, server_socket, capture_policy
+        )
+    except OSError as exc:
+        _display.display(f"Client({client_addr}) disconnected: {exc}")
+        client_socket.close()
+        server_socket.close()
+        return
+
+    read_description = f"client({client_addr})->proxy->server({server_addr})"
+    write_description = f"server({server_addr})->proxy->client({client_addr})"
+    t_read = asyncio.create_task(
+        redirect_socket(
+            loop,
+            client_socket,
+            server_socket,
+            read_description,
+            log_queue,
+            connection,
+            _replay_format.CLIENT_TO_SERVER,
+            zero_copy,
+        )
+    )
+    t_write = asyncio.create_task(
+        redirect_socket(
+            loop,
+            server_socket,
+            client_socket,
+            write_description,
+            log_queue if capture_responses else None,
+            connection,
+            _replay_format.SERVER_TO_CLIENT,
+            zero_copy,
+        )
+    )
+
+    try:
+        done, _ = await asyncio.wait(
+            (t_read, t_write), return_when=asyncio.FIRST_EXCEPTION
+        )
+        for task in done:
+            exc = task.exception()
+            if exc is not None:
+                _display.display(f"Error relaying {client_addr}: {exc!r}")
+    finally:
+        for task in (t_read, t_write):
+            task.cancel()
+        await asyncio.gather(t_read, t_write, return_exceptions=True)
+        client_socket.close()
+        server_socket.close()
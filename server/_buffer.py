@@ -10,121 +10,424 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import errno
+import os
 import select
+import socket
+
+
+# Bounds for the adaptive read size used when relaying a TCP stream.
+MIN_BUFFER_SIZE = 0x1000
+DEFAULT_BUFFER_SIZE = 0x10000
+MAX_BUFFER_SIZE = 0x100000
+# Upper bound on the size of a single chunk assembled by ``drain()``.
+MAX_CHUNK_SIZE = 0x1000000
+# `os.splice()` is only available on Linux (with Python 3.10+).
+SPLICE_AVAILABLE = hasattr(os, "splice")
+SPLICE_FLAGS = getattr(os, "SPLICE_F_MOVE", 0) | getattr(
+    os, "SPLICE_F_NONBLOCK", 0
+)
+# `os.eventfd()` is only available on Linux (with Python 3.10+).
+EVENTFD_AVAILABLE = hasattr(os, "eventfd")
+
+
+class Wakeup:
+    """A flag that wakes up every relay waiting on it.
+
+    The flag is backed by a file descriptor (an ``eventfd(2)`` where
+    available, otherwise a pipe) that becomes readable once the flag is set
+    and is never drained. Relays poll it alongside their socket, so a
+    relay is woken on events rather than waking up periodically to check
+    for them, and an idle connection costs no CPU.
+    """
+
+    def __init__(self):
+        if EVENTFD_AVAILABLE:
+            self._read_fd = os.eventfd(0, os.EFD_CLOEXEC)
+            self._write_fd = self._read_fd
+        else:
+            self._read_fd, self._write_fd = os.pipe()
+        self._is_set = False
+
+    def fileno(self):
+        """Get the file descriptor to poll.
+
+        Returns:
+            int: A file descriptor that is readable once the flag is set.
+        """
+        return self._read_fd
+
+    def is_set(self):
+        """Check if the flag is set.
+
+        Returns:
+            bool: Indicates if the flag is set.
+        """
+        return self._is_set
 
+    def set(self):
+        """Set the flag, waking up every relay waiting on it."""
+        if self._is_set:
+            return
 
-SELECT_TIMEOUT = 0.05
+        self._is_set = True
+        if EVENTFD_AVAILABLE:
+            os.eventfd_write(self._write_fd, 1)
+        else:
+            os.write(self._write_fd, b"\x00")
 
+    def close(self):
+        """Close the file descriptor(s) backing the flag."""
+        os.close(self._read_fd)
+        if self._write_fd != self._read_fd:
+            os.close(self._write_fd)
 
-def is_closed(socket_):
-    """Determine if a socket is closed.
 
-    This uses the associated file descriptor as a proxy for "closed".
+def wait_for(socket_, events, timeout=None, wakeups=()):
+    """Wait for events on a single socket.
+
+    This uses ``poll(2)`` rather than ``select(2)``, since ``select(2)``
+    can't wait on a file descriptor at or above ``FD_SETSIZE`` (typically
+    1024), which a proxy relaying a few hundred connections will reach.
 
     Args:
-        socket_ (socket.socket): The socket to check.
+        socket_ (socket.socket): The socket to wait on.
+        events (int): The events to wait for, e.g. ``select.POLLIN``.
+        timeout (Optional[float]): The maximum time (in seconds) to wait; if
+            not set, this waits indefinitely.
+        wakeups (Optional[Sequence[Wakeup]]): Flags that stop the wait
+            early once any of them is set.
 
     Returns:
-        bool: Indicates if closed or open.
+        bool: Indicates if any event occurred on the socket (i.e.
+        :data:`False` if the wait timed out or was woken up). Errors and hang
+        ups count as events, so that the next call on the socket can report
+        them.
     """
-    return socket_.fileno() == -1
+    poller = select.poll()
+    poller.register(socket_, events)
+    for wakeup in wakeups:
+        poller.register(wakeup, select.POLLIN)
+    if timeout is not None:
+        timeout = 1000.0 * timeout
+    ready = poller.poll(timeout)
+    if not ready:
+        return False
+
+    socket_fd = socket_.fileno()
+    return all(fd == socket_fd for fd, _ in ready)
 
 
-def wait_readable(recv_socket, send_socket):
+def wait_readable(recv_socket, wakeups):
     """Wait until a non-blocking socket is readable.
 
+    A TLS socket (see :class:`_tls.TLSSocket`) is readable without waiting
+    if it has already decrypted bytes that haven't been read.
+
     Args:
-        recv_socket (socket.socket): A socket to RECV from.
-        send_socket (socket.socket): A socket connected (on the "other end") to
-            ``recv_socket``.
+        recv_socket (Union[socket.socket, _tls.TLSSocket]): A socket to RECV
+            from.
+        wakeups (Sequence[Wakeup]): Flags indicating the connection is being
+            torn down.
 
     Returns:
-        Optional[socket.socket]: Either ``recv_socket`` if the connection is
-        still open or :data:`None`.
+        Optional[socket.socket]: Either ``recv_socket`` if it is readable or
+        :data:`None` if the wait was woken up.
+    """
+    pending = getattr(recv_socket, "pending", None)
+    if pending is not None and pending():
+        return recv_socket
+    if wait_for(recv_socket, select.POLLIN, wakeups=wakeups):
+        return recv_socket
 
-    Raises:
-        ValueError: If ``recv_socket`` is not readable after
-            ``select.select()`` returns.
+    return None
+
+
+def next_buffer_size(buffer_size, chunk_size):
+    """Adapt the read size for a TCP stream to the size of the last chunk.
+
+    The read size doubles whenever a read fills the buffer and halves
+    whenever a read uses less than a quarter of it, staying within
+    ``MIN_BUFFER_SIZE`` and ``MAX_BUFFER_SIZE``.
+
+    Args:
+        buffer_size (int): The read size used for the last chunk.
+        chunk_size (int): The size of the last chunk.
+
+    Returns:
+        int: The read size to use for the next chunk.
     """
-    while True:
-        readable, _, _ = select.select([recv_socket], [], [], SELECT_TIMEOUT)
-        if readable:
+    if chunk_size >= buffer_size:
+        return min(2 * buffer_size, MAX_BUFFER_SIZE)
+    if 4 * chunk_size < buffer_size:
+        return max(buffer_size // 2, MIN_BUFFER_SIZE)
+    return buffer_size
+
+
+def drain(recv_socket, buffer_size):
+    """Read everything that is immediately available on a socket.
+
+    This is intended to be called after a read has **filled** its buffer;
+    rather than considering the chunk complete, subsequent (non-blocking)
+    reads are made as long as they also fill their buffer, so that one
+    logical write from the peer that spans several reads is returned as one
+    chunk.
+
+    Args:
+        recv_socket (socket.socket): A non-blocking socket to RECV from.
+        buffer_size (int): The size of the first read.
+
+    Returns:
+        List[bytes]: The chunks read (possibly empty). Reads stop once a read
+        does not fill its buffer, would block, or ``MAX_CHUNK_SIZE`` bytes
+        have been read.
+    """
+    tcp_chunks = []
+    total = 0
+    while total < MAX_CHUNK_SIZE:
+        try:
+            tcp_chunk = recv_socket.recv(buffer_size)
+        except BlockingIOError:
             break
-        # If the "other end" of the socket is closed, ``recv_socket`` is done.
-        if is_closed(send_socket):
-            return None
 
-    if readable != [recv_socket]:
-        raise ValueError("Socket not ready to RECV")
+        tcp_chunks.append(tcp_chunk)
+        total += len(tcp_chunk)
+        if len(tcp_chunk) < buffer_size:
+            break
+        buffer_size = min(2 * buffer_size, MAX_BUFFER_SIZE)
+
+    return tcp_chunks
+
+
+def _read_when_ready(recv_socket, wakeups, read, argument):
+    """Wait until a non-blocking socket is readable, then read from it.
+
+    Args:
+        recv_socket (Union[socket.socket, _tls.TLSSocket]): A socket to RECV
+            from.
+        wakeups (Sequence[Wakeup]): Flags indicating the connection is being
+            torn down.
+        read (Callable[[Any], Any]): The read to make, e.g.
+            ``recv_socket.recv``.
+        argument (Any): The argument for ``read``.
 
-    return recv_socket
+    Returns:
+        Any: The result of ``read``, or :data:`None` if the wait was woken
+        up.
+    """
+    while True:
+        if wait_readable(recv_socket, wakeups) is None:
+            return None
+        try:
+            return read(argument)
+        except BlockingIOError:
+            # Spurious wakeup (e.g. only part of a TLS record has arrived),
+            # wait for the socket to be readable again.
+            continue
 
 
-def recv(recv_socket, send_socket, buffer_size=0x10000):
+def recv(recv_socket, wakeups, buffer_size=DEFAULT_BUFFER_SIZE):
     """Call ``recv()`` on a socket; with some extra checks.
 
     This **assumes** ``recv_socket`` is non-blocking, so a **blocking** call to
-    ``select.select()`` with a timoeut is used to wait until the socket is
-    ready. Additionally, the ``send_socket`` is used to determine if the
-    connection has been closed.
+    ``wait_readable()`` is used to wait until the socket is ready (or until
+    one of ``wakeups`` is set, e.g. because the connection is being torn
+    down).
 
     .. note::
 
-        Rather than using the negotiated connection (e.g.
-        ``SETTINGS_MAX_FRAME_SIZE``) to set the buffer size, we just use a
-        best guess of something "large enough" to make sure that each frame
-        fits in this size.
-
         If a RECV returns a chunk from the TCP stream **equal** to the buffer
-        size, we interpret this as an "incomplete" frame and throw a cowardly
-        exception. A more robust implementation could try to make subsequent
-        ``recv()`` calls to see if the chunk is an entire frame.
+        size, the rest of the data that is immediately available is read with
+        ``drain()`` and joined to it. This way one large write (e.g. a
+        ``COPY`` or a large bind parameter) is usually returned (and captured)
+        as a single chunk rather than being split at an arbitrary boundary.
 
     Args:
         recv_socket (socket.socket): A socket to RECV from.
-        send_socket (socket.socket): A socket connected (on the "other end") to
-            ``recv_socket``.
+        wakeups (Sequence[Wakeup]): Flags indicating the connection is being
+            torn down.
         buffer_size (Optional[int]): The size of the read.
 
     Returns:
-        bytes: The chunk that was read from the TCP stream.
-
-    Raises:
-        RuntimeError: If the TCP chunk returned is "full size" (i.e. has
-            ``buffer_size`` bytes).
+        bytes: The chunk that was read from the TCP stream. This may be
+        larger than ``buffer_size``.
     """
-    recv_socket = wait_readable(recv_socket, send_socket)
-    if recv_socket is None:
-        # Indicates the "other end" of the socket is closed, so we
-        # simulate an empty RECV.
+    tcp_chunk = _read_when_ready(
+        recv_socket, wakeups, recv_socket.recv, buffer_size
+    )
+    if tcp_chunk is None:
+        # Indicates the connection is being torn down, so we simulate an
+        # empty RECV.
         return b""
 
-    tcp_chunk = recv_socket.recv(buffer_size)
     if len(tcp_chunk) == buffer_size:
-        raise RuntimeError(
-            "TCP RECV() may not have captured entire message frame"
-        )
+        tcp_chunks = drain(recv_socket, buffer_size)
+        if tcp_chunks:
+            tcp_chunks.insert(0, tcp_chunk)
+            tcp_chunk = b"".join(tcp_chunks)
 
     return tcp_chunk
 
 
-def send(send_socket, tcp_chunk):
-    """Call ``send()`` on a socket; with some extra checks.
+def recv_into(recv_socket, wakeups, buffer_view):
+    """Call ``recv_into()`` on a socket; with some extra checks.
 
-    .. note::
+    This is the same as :func:`recv`, but reads into a preallocated buffer
+    rather than allocating a new ``bytes`` object for every chunk. A read that
+    fills ``buffer_view`` is **not** drained; callers that need one logical
+    write as one chunk should call ``drain()`` in that case.
+
+    Args:
+        recv_socket (socket.socket): A socket to RECV from.
+        wakeups (Sequence[Wakeup]): Flags indicating the connection is being
+            torn down.
+        buffer_view (memoryview): A writable view of the buffer to read into.
+
+    Returns:
+        int: The number of bytes read into ``buffer_view``. A value of ``0``
+        indicates the connection is closed.
+    """
+    size = _read_when_ready(
+        recv_socket, wakeups, recv_socket.recv_into, buffer_view
+    )
+    if size is None:
+        # Indicates the connection is being torn down, so we simulate an
+        # empty RECV.
+        return 0
+
+    return size
+
+
+def wait_writable(send_socket, timeout=None, wakeups=()):
+    """Wait until a non-blocking socket is writable.
+
+    Args:
+        send_socket (socket.socket): A socket to SEND to.
+        timeout (Optional[float]): The maximum time (in seconds) to wait; if
+            not set, this waits indefinitely.
+        wakeups (Optional[Sequence[Wakeup]]): Flags that stop the wait
+            early once any of them is set.
+
+    Returns:
+        bool: Indicates if the socket is writable (i.e. :data:`False` if the
+        wait timed out or was woken up).
+    """
+    return wait_for(send_socket, select.POLLOUT, timeout, wakeups)
+
+
+def _wait_send(send_socket, wakeups):
+    """Wait for a full send buffer to drain; unless the wait is woken up.
+
+    Args:
+        send_socket (socket.socket): A socket to SEND to.
+        wakeups (Sequence[Wakeup]): Flags indicating the connection is being
+            torn down.
+
+    Raises:
+        ConnectionAbortedError: If the wait was woken up.
+    """
+    if not wait_writable(send_socket, wakeups=wakeups):
+        raise ConnectionAbortedError(
+            errno.ECONNABORTED, "Connection torn down while sending"
+        )
+
+
+def can_splice(recv_socket, send_socket):
+    """Determine if chunks can be moved between two sockets with ``splice()``.
+
+    Args:
+        recv_socket (Union[socket.socket, _tls.TLSSocket]): A socket to RECV
+            from.
+        send_socket (Union[socket.socket, _tls.TLSSocket]): A socket to SEND
+            to.
+
+    Returns:
+        bool: Indicates if ``splice(2)`` is available and both sockets are
+        plain sockets (rather than TLS sockets, whose chunks must be
+        decrypted or encrypted in user space).
+    """
+    return (
+        SPLICE_AVAILABLE
+        and isinstance(recv_socket, socket.socket)
+        and isinstance(send_socket, socket.socket)
+    )
+
+
+def splice(recv_socket, send_socket, pipe_fds, wakeups, size=0x10000):
+    """Move a chunk from one socket to another without copying it.
+
+    The chunk is moved with ``splice(2)`` from ``recv_socket`` into a pipe
+    and then from the pipe into ``send_socket``, so it never leaves the
+    kernel. As a result, the chunk is **not** available to be captured.
+
+    Args:
+        recv_socket (socket.socket): A socket to RECV from.
+        send_socket (socket.socket): A socket connected (on the "other end") to
+            ``recv_socket``; the chunk will be sent to this socket.
+        pipe_fds (Tuple[int, int]): The read and write file descriptors of a
+            pipe used as the in-kernel buffer; the pipe should be empty.
+        wakeups (Sequence[Wakeup]): Flags indicating the connection is being
+            torn down.
+        size (Optional[int]): The maximum size of the chunk to move.
+
+    Returns:
+        int: The number of bytes moved. A value of ``0`` indicates the
+        connection is closed.
+
+    Raises:
+        ConnectionAbortedError: If the connection is torn down while the
+            chunk is being sent.
+    """
+    pipe_read, pipe_write = pipe_fds
+    while True:
+        if wait_readable(recv_socket, wakeups) is None:
+            return 0
+
+        try:
+            moved = os.splice(
+                recv_socket.fileno(), pipe_write, size, flags=SPLICE_FLAGS
+            )
+            break
+        except BlockingIOError:
+            # Spurious wakeup, wait for the socket to be readable again.
+            continue
+
+    remaining = moved
+    while remaining > 0:
+        try:
+            remaining -= os.splice(
+                pipe_read, send_socket.fileno(), remaining, flags=SPLICE_FLAGS
+            )
+        except BlockingIOError:
+            _wait_send(send_socket, wakeups)
+
+    return moved
+
+
+def send(send_socket, tcp_chunk, wakeups=()):
+    """Call ``send()`` on a socket until the entire chunk has been sent.
 
-        This throws a cowardly exception if the entire ``tcp_chunk`` cannot be
-        sent in a single SND. A more robust implementation could try to make
-        subsequent ``send()`` calls or just use ``sendall()``.
+    This **assumes** ``send_socket`` is non-blocking; if the socket's send
+    buffer is full (e.g. for a slow client), a **blocking** call to
+    ``wait_writable()`` is used to wait until the socket is writable again
+    and the remainder of the chunk is sent.
 
     Args:
         send_socket (socket.socket): A socket to SEND to.
-        tcp_chunk (bytes): A chunk to send to the socket.
+        tcp_chunk (Union[bytes, memoryview]): A chunk to send to the socket.
+        wakeups (Optional[Sequence[Wakeup]]): Flags indicating the
+            connection is being torn down.
 
     Raises:
-        RuntimeError: If SEND returns a length other than the size of
-            ``tcp_chunk``.
+        ConnectionAbortedError: If the connection is torn down while the
+            chunk is being sent.
     """
-    bytes_sent = send_socket.send(tcp_chunk)
-    if bytes_sent != len(tcp_chunk):
-        raise RuntimeError("Not all bytes were sent")
+    chunk_view = memoryview(tcp_chunk)
+    while chunk_view:
+        try:
+            bytes_sent = send_socket.send(chunk_view)
+        except BlockingIOError:
+            _wait_send(send_socket, wakeups)
+            continue
+
+        chunk_view = chunk_view[bytes_sent:]
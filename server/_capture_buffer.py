@@ -0,0 +1,432 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import os
+import queue
+import struct
+import tempfile
+import threading
+
+import _display
+
+
+# - "block": wait for the writer to make room (stalls the proxied connection)
+# - "drop": drop the newest log line and count it
+# - "spill": append the log line to a temporary file, to be read back by the
+#   writer once the in-memory buffer has been drained
+OVERFLOW_POLICIES = ("block", "drop", "spill")
+# Approximate memory used by a log line in addition to the TCP chunk.
+ITEM_OVERHEAD = 128
+# Directory for spill files; `None` uses the platform default.
+SPILL_DIR = None
+SPILL_HEADER = struct.Struct(">QIIB")
+# Bytes of log lines (at least) that can wait in memory for the spill
+# thread before ``put()`` waits for it to catch up.
+SPILL_PENDING_BYTES = 0x1000000
+
+
+def _item_size(item):
+    return len(item[1]) + ITEM_OVERHEAD
+
+
+class _SpillFile:
+    """An append-only temporary file of log lines, read back in order.
+
+    The ``Connection`` for each log line is kept in memory (once per
+    connection) and replaced by a small integer key in the file. The size
+    of each log line that has been written (but not claimed for reading) is
+    kept in memory as well, so that a log line can be claimed without
+    touching the disk.
+    """
+
+    def __init__(self):
+        self.file_obj = tempfile.TemporaryFile(dir=SPILL_DIR)
+        self.fd = self.file_obj.fileno()
+        self.read_offset = 0
+        self.write_offset = 0
+        self.sizes = collections.deque()
+        self.keys = {}
+        self.connections = []
+
+    @property
+    def pending(self):
+        return bool(self.sizes)
+
+    def write(self, items):
+        """Append log lines to the file.
+
+        The returned sizes must be added to ``sizes`` once the log lines
+        can be read back.
+
+        Returns:
+            List[int]: The size of each log line in the file.
+        """
+        parts = []
+        sizes = []
+        for time_ns, tcp_chunk, connection, direction in items:
+            key = self.keys.get(id(connection))
+            if key is None:
+                key = len(self.connections)
+                self.keys[id(connection)] = key
+                self.connections.append(connection)
+            parts.append(
+                SPILL_HEADER.pack(time_ns, key, len(tcp_chunk), direction)
+            )
+            parts.append(tcp_chunk)
+            sizes.append(SPILL_HEADER.size + len(tcp_chunk))
+
+        data = memoryview(b"".join(parts))
+        while data:
+            written = os.pwrite(self.fd, data, self.write_offset)
+            self.write_offset += written
+            data = data[written:]
+        return sizes
+
+    def claim(self):
+        """Claim the oldest log line that hasn't been read.
+
+        Returns:
+            int: The offset of the log line, to be passed to ``read()``.
+        """
+        offset = self.read_offset
+        self.read_offset += self.sizes.popleft()
+        return offset
+
+    def read(self, offset):
+        """Read a claimed log line; this doesn't touch any shared state.
+
+        Returns:
+            Tuple[int, bytes, int, int]: The timestamp, TCP chunk, connection
+            key and direction.
+        """
+        header = os.pread(self.fd, SPILL_HEADER.size, offset)
+        time_ns, key, size, direction = SPILL_HEADER.unpack(header)
+        tcp_chunk = os.pread(self.fd, size, offset + SPILL_HEADER.size)
+        return time_ns, tcp_chunk, key, direction
+
+    def reset(self):
+        """Start over once fully drained, so the file doesn't grow forever."""
+        os.ftruncate(self.fd, 0)
+        self.read_offset = 0
+        self.write_offset = 0
+        self.keys.clear()
+        self.connections.clear()
+
+    def close(self):
+        self.file_obj.close()
+
+
+class CaptureBuffer:
+    """A buffer of log lines bounded by bytes rather than item count.
+
+    This is a drop-in replacement for the ``queue.Queue`` shared by the proxy
+    (which calls ``put()`` or ``put_nowait()``) and the writer (see
+    :func:`_sinks.run_sinks`, which calls ``get()``, ``get_nowait()`` and
+    ``empty()``). When adding a
+    log line would exceed ``max_bytes``, the ``overflow`` policy decides
+    what happens, so that the proxied connection only waits on persistence
+    if ``"block"`` is used.
+
+    Log lines are always returned in the order they were added; once a log
+    line has been spilled, every later log line is spilled as well until the
+    spill file has been read back.
+
+    Spilled log lines are written to disk by a dedicated thread (and read
+    back by ``get()`` without holding the lock), so ``put()`` doesn't wait
+    on disk I/O. Log lines waiting for that thread
+    are held in memory; only if more than ``SPILL_PENDING_BYTES`` (or
+    ``max_bytes``, if larger) are waiting does ``put()`` wait for the disk
+    to catch up. If ``max_spill_bytes`` is set, a log line that would take
+    the spill file (and the log lines waiting for it) past that size is
+    dropped instead.
+
+    Args:
+        max_bytes (int): The maximum number of bytes (approximately) of log
+            lines held in memory.
+        overflow (Optional[str]): One of :data:`OVERFLOW_POLICIES`.
+        max_spill_bytes (Optional[int]): The maximum number of bytes
+            (approximately) of log lines spilled to disk, if limited.
+    """
+
+    def __init__(self, max_bytes, overflow="drop", max_spill_bytes=None):
+        self.max_bytes = max_bytes
+        self.overflow = overflow
+        self.max_spill_bytes = max_spill_bytes
+        self.num_bytes = 0
+        self.dropped_records = 0
+        self.dropped_bytes = 0
+        self.spilled_records = 0
+        self._items = collections.deque()
+        self._spill = None
+        # Log lines to be spilled, waiting for the spill thread.
+        self._to_spill = collections.deque()
+        self._to_spill_bytes = 0
+        # Indicates if the spill thread is writing (without the lock).
+        self._spill_writing = False
+        # Indicates if a spilled log line is being read (without the lock).
+        self._spill_reading = False
+        self._spill_thread = None
+        self._closed = False
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._spill_ready = threading.Condition(self._lock)
+        self._spill_written = threading.Condition(self._lock)
+
+    def _spilling(self):
+        return (
+            bool(self._to_spill)
+            or self._spill_writing
+            or self._spill_reading
+            or (self._spill is not None and self._spill.pending)
+        )
+
+    def _is_full(self, size):
+        # An empty buffer always accepts a log line, even an oversized one.
+        return self._items and self.num_bytes + size > self.max_bytes
+
+    def put(self, item, block=True):
+        """Add a log line to the buffer.
+
+        Args:
+            item (Tuple[int, bytes, _save_replay_log.Connection, int]): The
+                log line; the timestamp, TCP chunk, connection and direction.
+            block (Optional[bool]): Indicates if this should wait when the
+                overflow policy calls for it (``"block"``, or ``"spill"``
+                with too many log lines waiting for the spill thread).
+
+        Raises:
+            queue.Full: If ``block`` is not set and the log line can't be
+                added without waiting; the log line is not added.
+        """
+        size = _item_size(item)
+        with self._lock:
+            if self._spilling():
+                self._spill_item(item, block)
+                return
+
+            if self._is_full(size):
+                if self.overflow == "drop":
+                    self._drop(item)
+                    return
+                if self.overflow == "spill":
+                    self._spill_item(item, block)
+                    return
+                if not block:
+                    raise queue.Full
+                while self._is_full(size):
+                    self._not_full.wait()
+
+            self._items.append(item)
+            self.num_bytes += size
+            self._not_empty.notify()
+
+    def put_nowait(self, item):
+        """Add a log line to the buffer without waiting.
+
+        Args:
+            item (Tuple[int, bytes, _save_replay_log.Connection, int]): The
+                log line.
+
+        Raises:
+            queue.Full: If the log line can't be added without waiting.
+        """
+        self.put(item, block=False)
+
+    def _drop(self, item):
+        if self.dropped_records == 0:
+            _display.display("Capture buffer is full; dropping log lines")
+        self.dropped_records += 1
+        self.dropped_bytes += len(item[1])
+
+    def _spill_bytes(self):
+        # NOTE: Log lines being written by the spill thread are briefly
+        #       counted in neither; this is only an approximate bound.
+        spilled = 0
+        if self._spill is not None:
+            spilled = self._spill.write_offset - self._spill.read_offset
+        return spilled + self._to_spill_bytes
+
+    def _spill_item(self, item, block=True):
+        size = _item_size(item)
+        if (
+            self.max_spill_bytes is not None
+            and self._spill_bytes() + size > self.max_spill_bytes
+        ):
+            self._drop(item)
+            return
+
+        limit = max(self.max_bytes, SPILL_PENDING_BYTES)
+        while self._to_spill and self._to_spill_bytes + size > limit:
+            if not block:
+                raise queue.Full
+            self._spill_written.wait()
+
+        if self._spill is None:
+            self._spill = _SpillFile()
+            self._spill_thread = threading.Thread(
+                target=self._spill_worker, daemon=True
+            )
+            self._spill_thread.start()
+        self._to_spill.append(item)
+        self._to_spill_bytes += size
+        self.spilled_records += 1
+        self._spill_ready.notify()
+        self._not_empty.notify()
+
+    def _spill_worker(self):
+        """Write log lines waiting to be spilled, without holding the lock."""
+        with self._lock:
+            while True:
+                self._spill_ready.wait_for(
+                    lambda: self._to_spill or self._closed
+                )
+                if self._closed:
+                    return
+
+                items = list(self._to_spill)
+                self._to_spill.clear()
+                self._to_spill_bytes = 0
+                self._spill_writing = True
+                self._lock.release()
+                try:
+                    sizes = self._spill.write(items)
+                finally:
+                    self._lock.acquire()
+                    self._spill_writing = False
+                    self._spill_written.notify_all()
+                self._spill.sizes.extend(sizes)
+
+    def _empty(self):
+        return not self._items and not self._spilling()
+
+    def get(self, block=True, timeout=None):
+        """Remove and return the oldest log line in the buffer.
+
+        Args:
+            block (Optional[bool]): Indicates if this should wait for a log
+                line when the buffer is empty.
+            timeout (Optional[float]): The maximum time to wait when
+                ``block`` is set.
+
+        Returns:
+            Tuple[int, bytes, _save_replay_log.Connection, int]: The log
+            line.
+
+        Raises:
+            queue.Empty: If no log line is available.
+        """
+        with self._lock:
+            if block:
+                self._not_empty.wait_for(
+                    lambda: not self._empty(), timeout=timeout
+                )
+            if self._items:
+                item = self._items.popleft()
+                self.num_bytes -= _item_size(item)
+                self._not_full.notify()
+                return item
+            # NOTE: Log lines being written by the spill thread are older
+            #       than any still waiting for it, so wait for the write.
+            self._spill_written.wait_for(
+                lambda: not self._spill_writing and not self._spill_reading
+            )
+            if self._spill is not None and self._spill.pending:
+                return self._read_spilled()
+            if self._to_spill:
+                # The spill file has been read back, so the rest never
+                # needs to touch the disk.
+                item = self._to_spill.popleft()
+                self._to_spill_bytes -= _item_size(item)
+                self._spill_written.notify_all()
+                return item
+
+        raise queue.Empty
+
+    def _read_spilled(self):
+        """Read back the oldest spilled log line.
+
+        This must be called with the lock held; the lock is released while
+        reading from disk (as in ``_spill_worker()``), so ``put()`` never
+        waits on the read.
+        """
+        spill = self._spill
+        offset = spill.claim()
+        self._spill_reading = True
+        self._lock.release()
+        try:
+            time_ns, tcp_chunk, key, direction = spill.read(offset)
+        finally:
+            self._lock.acquire()
+            self._spill_reading = False
+            self._spill_written.notify_all()
+
+        item = time_ns, tcp_chunk, spill.connections[key], direction
+        if not spill.pending and not self._spill_writing:
+            # NOTE: The spill thread may be writing newer log lines; if so,
+            #       the file is reset once those have been read back.
+            spill.reset()
+        return item
+
+    def get_nowait(self):
+        """Remove and return the oldest log line without waiting.
+
+        Returns:
+            Tuple[int, bytes, _save_replay_log.Connection, int]: The log
+            line.
+
+        Raises:
+            queue.Empty: If no log line is available.
+        """
+        return self.get(block=False)
+
+    def empty(self):
+        """Determine if the buffer is empty.
+
+        Returns:
+            bool: Indicates if there are no log lines in memory or spilled.
+        """
+        with self._lock:
+            return self._empty()
+
+    def qsize(self):
+        """Determine the number of log lines held in memory.
+
+        Returns:
+            int: The number of log lines (not counting spilled log lines).
+        """
+        return len(self._items)
+
+    def close(self):
+        """Stop the spill thread and remove the spill file, if created."""
+        with self._lock:
+            self._closed = True
+            self._spill_ready.notify()
+        if self._spill_thread is not None:
+            self._spill_thread.join()
+        with self._lock:
+            if self._spill is not None:
+                self._spill.close()
+                self._spill = None
+
+    def display_summary(self):
+        """Display how many log lines were dropped or spilled, if any."""
+        if self.dropped_records:
+            _display.display(
+                f"Capture is INCOMPLETE: dropped {self.dropped_records} log "
+                f"lines ({self.dropped_bytes} bytes)"
+            )
+        if self.spilled_records:
+            _display.display(
+                f"Spilled {self.spilled_records} log lines to disk"
+            )
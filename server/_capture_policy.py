@@ -0,0 +1,215 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import ipaddress
+import threading
+import zlib
+
+import _metrics
+import _postgres
+
+
+# Ways a client->server stream can be split into capture records, besides
+# one record per TCP chunk.
+FRAMINGS = ("postgres",)
+# Sampling is decided in steps of 0.01%.
+SAMPLE_SCALE = 10000
+
+
+def _parse_networks(cidrs):
+    """Parse a list of CIDR blocks.
+
+    Args:
+        cidrs (Optional[Iterable[str]]): CIDR blocks, e.g. ``"10.0.0.0/8"``.
+            A bare address is treated as a block with a single address.
+
+    Returns:
+        Optional[Tuple[ipaddress.IPv4Network, ...]]: The parsed blocks
+        (IPv6 blocks are ``ipaddress.IPv6Network``), or :data:`None` if
+        ``cidrs`` is not set.
+
+    Raises:
+        ValueError: If any of ``cidrs`` is not a valid CIDR block.
+    """
+    if cidrs is None:
+        return None
+    return tuple(ipaddress.ip_network(cidr, strict=False) for cidr in cidrs)
+
+
+class Budget:
+    """The number of bytes that may still be captured for a connection.
+
+    Both directions of a connection charge the same budget. Once a chunk
+    doesn't fit, the budget is exhausted for good, so that the capture of
+    a connection always ends at a chunk boundary rather than having gaps.
+
+    Args:
+        max_bytes (int): The number of bytes that may be captured.
+    """
+
+    __slots__ = ("remaining", "_lock")
+
+    def __init__(self, max_bytes):
+        self.remaining = max_bytes
+        self._lock = threading.Lock()
+
+    def charge(self, size):
+        """Charge a captured chunk to the budget.
+
+        Args:
+            size (int): The size of the chunk.
+
+        Returns:
+            bool: Indicates if the chunk fits in the budget (and should be
+            captured).
+        """
+        with self._lock:
+            if size <= self.remaining:
+                self.remaining -= size
+                return True
+            if self.remaining >= 0:
+                self.remaining = -1
+                _metrics.CAPTURE_BUDGET_EXHAUSTED.inc()
+            return False
+
+
+class CapturePolicy:
+    """Decides, once per connection, if (and how) it is captured.
+
+    The decision is made from the client address alone, when the connection
+    is accepted, so that a connection that isn't captured can be relayed
+    without touching the capture path at all.
+
+    A client address that is in any ``deny`` block or (if ``allow`` is set)
+    isn't in any ``allow`` block is never captured. Of the remaining
+    connections, ``sample_percent`` are captured; each connection is
+    sampled by a hash of its client address, so the same connections are
+    sampled across worker processes and across runs.
+
+    Args:
+        sample_percent (Optional[float]): The percentage of connections to
+            capture.
+        allow (Optional[Iterable[str]]): If set, only clients in one of
+            these CIDR blocks are captured.
+        deny (Optional[Iterable[str]]): Clients in any of these CIDR blocks
+            are not captured.
+        max_bytes (Optional[int]): If set, at most this many bytes are
+            captured per connection (in both directions combined); the rest
+            of the connection is relayed without being captured.
+        framing (Optional[str]): If set, the client->server stream of each
+            captured connection is split into one record per protocol
+            message rather than one record per TCP chunk; one of
+            :data:`FRAMINGS`.
+        passwords (Optional[str]): What to do with password / SASL
+            messages when ``framing`` is ``"postgres"``; one of
+            :data:`_postgres.PASSWORD_POLICIES`.
+
+    Raises:
+        ValueError: If ``sample_percent`` is not between 0 and 100.
+        ValueError: If ``allow`` or ``deny`` contain an invalid CIDR block.
+        ValueError: If ``max_bytes`` is not positive.
+        ValueError: If ``framing`` is not one of :data:`FRAMINGS`.
+        ValueError: If ``passwords`` is not one of
+            :data:`_postgres.PASSWORD_POLICIES`.
+    """
+
+    def __init__(
+        self,
+        sample_percent=100.0,
+        allow=None,
+        deny=None,
+        max_bytes=None,
+        framing=None,
+        passwords="redact",
+    ):
+        if not 0.0 <= sample_percent <= 100.0:
+            raise ValueError(
+                "The capture sample percentage must be between 0 and 100",
+                sample_percent,
+            )
+        if max_bytes is not None and max_bytes < 1:
+            raise ValueError(
+                "The capture byte budget must be positive", max_bytes
+            )
+        if framing is not None and framing not in FRAMINGS:
+            raise ValueError(f"Unsupported framing {framing!r}", FRAMINGS)
+        if passwords not in _postgres.PASSWORD_POLICIES:
+            raise ValueError(
+                f"Unsupported password policy {passwords!r}",
+                _postgres.PASSWORD_POLICIES,
+            )
+
+        self.sample_percent = sample_percent
+        self.sample_threshold = round(sample_percent * SAMPLE_SCALE / 100.0)
+        self.allow = _parse_networks(allow)
+        self.deny = _parse_networks(deny)
+        self.max_bytes = max_bytes
+        self.framing = framing
+        self.passwords = passwords
+
+    def _is_permitted(self, client_ip):
+        if self.allow is None and self.deny is None:
+            return True
+
+        address = ipaddress.ip_address(client_ip)
+        if self.deny is not None and any(
+            address in network for network in self.deny
+        ):
+            return False
+        if self.allow is None:
+            return True
+        return any(address in network for network in self.allow)
+
+    def should_capture(self, client_addr):
+        """Decide if a newly accepted connection should be captured.
+
+        Args:
+            client_addr (str): The address (IP and port) of the client
+                socket, e.g. ``"127.0.0.1:64245"``.
+
+        Returns:
+            bool: Indicates if the connection should be captured.
+        """
+        client_ip, _, _ = client_addr.rpartition(":")
+        if not self._is_permitted(client_ip):
+            _metrics.CAPTURE_SKIPPED.inc()
+            return False
+
+        if self.sample_threshold < SAMPLE_SCALE:
+            sample = zlib.crc32(client_addr.encode("ascii")) % SAMPLE_SCALE
+            if sample >= self.sample_threshold:
+                _metrics.CAPTURE_SKIPPED.inc()
+                return False
+
+        return True
+
+    def budget(self):
+        """Create the capture budget for a new connection.
+
+        Returns:
+            Optional[Budget]: The budget, or :data:`None` if the number of
+            bytes captured per connection is not limited.
+        """
+        if self.max_bytes is None:
+            return None
+        return Budget(self.max_bytes)
+
+    def framer(self):
+        """Create the framer for the client->server stream of a connection.
+
+        Returns:
+            Optional[_postgres.MessageFramer]: The framer, or :data:`None` if
+            each TCP chunk is captured as one record.
+        """
+        if self.framing is None:
+            return None
+        return _postgres.MessageFramer(self.passwords)
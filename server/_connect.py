@@ -11,35 +11,175 @@
 # limitations under the License.
 
 import errno
+import os
 import socket
 import threading
 import time
 
 import _buffer
 import _display
+import _metrics
+import _replay_format
+import _save_replay_log
+import _tls
 
 
-def _maybe_log_line(log_queue, tcp_chunk, client_socket, server_socket):
+# Maximum time (in seconds) to wait for a connection to the server.
+CONNECT_TIMEOUT = 5.0
+
+
+def capture_log_lines(tcp_chunk, connection, direction):
+    """Determine the log lines captured for a proxied chunk.
+
+    If the connection has a capture budget, the chunk is only captured if
+    it fits in the budget. If the connection has a framer, a client->server
+    chunk is captured as the messages it completes (possibly none) rather
+    than as one log line; all of them share the same timestamp.
+
+    Args:
+        tcp_chunk (bytes): Chunk of data that was proxied. This must not be
+            modified afterwards, since captured log lines may be views of it.
+        connection (_save_replay_log.Connection): The connection the chunk
+            was proxied for.
+        direction (int): The direction the chunk was proxied in; one of
+            :data:`_replay_format.CLIENT_TO_SERVER` or
+            :data:`_replay_format.SERVER_TO_CLIENT`.
+
+    Returns:
+        Optional[List[Tuple[int, bytes, _save_replay_log.Connection, int]]]:
+        The log lines, or :data:`None` if the capture budget has been
+        exhausted.
+    """
+    budget = connection.budget
+    if budget is not None and not budget.charge(len(tcp_chunk)):
+        return None
+
+    framer = connection.framer
+    if framer is None or direction != _replay_format.CLIENT_TO_SERVER:
+        return [(time.time_ns(), tcp_chunk, connection, direction)]
+
+    time_ns = time.time_ns()
+    return [
+        (time_ns, message, connection, direction)
+        for message in framer.feed(tcp_chunk)
+    ]
+
+
+def maybe_log_line(log_queue, tcp_chunk, connection, direction):
     """Sent a log line to the log queue, if set.
 
+    The chunk is captured as the log lines from ``capture_log_lines()``.
+
     Args:
         log_queue (Optional[queue.Queue]): The queue where log lines will be
             pushed, or :data:`None`.
-        tcp_chunk (bytes): Chunk of data that was proxied.
-        client_socket (socket.socket): The client socket.
-        server_socket (socket.socket): The server socket.
+        tcp_chunk (bytes): Chunk of data that was proxied. This must not be
+            modified afterwards, since captured log lines may be views of it.
+        connection (Optional[_save_replay_log.Connection]): The connection
+            the chunk was proxied for; only used if ``log_queue`` is set.
+        direction (int): The direction the chunk was proxied in.
+
+    Returns:
+        bool: Indicates if the connection is still captured, i.e.
+        :data:`False` if ``log_queue`` is not set or the capture budget has
+        been exhausted. Once this is :data:`False`, the caller should stop
+        capturing (and may switch to a cheaper relay).
     """
     if log_queue is None:
+        return False
+
+    log_lines = capture_log_lines(tcp_chunk, connection, direction)
+    if log_lines is None:
+        return False
+    for log_line in log_lines:
+        log_queue.put(log_line)
+    return True
+
+
+def half_close(send_socket):
+    """Propagate the end of one direction of a TCP stream to its peer.
+
+    This calls ``shutdown(SHUT_WR)`` so the peer receives an EOF, while
+    chunks can still be relayed in the **other** direction (e.g. a client
+    that sends a request, shuts down its write side and then waits for the
+    response).
+
+    Args:
+        send_socket (socket.socket): The socket that was being SENT to.
+    """
+    try:
+        send_socket.shutdown(socket.SHUT_WR)
+    except OSError:
+        # The peer may have already reset (or closed) the connection.
+        pass
+
+
+def _relay_wakeups(wakeup, stop):
+    """Get the flags that a relay waits on alongside its socket.
+
+    Args:
+        wakeup (_buffer.Wakeup): The flag set when the connection is torn
+            down.
+        stop (Optional[_buffer.Wakeup]): The flag set when the proxy stops
+            relaying every connection, if any.
+
+    Returns:
+        Tuple[_buffer.Wakeup, ...]: The flags.
+    """
+    if stop is None:
+        return (wakeup,)
+    return (wakeup, stop)
+
+
+def _finish_redirect(send_socket, description, wakeup, exc):
+    """Finish one direction of a TCP stream.
+
+    If the direction ended with an EOF, the EOF is propagated with
+    ``half_close()`` and the other direction keeps running. If it failed
+    (e.g. the peer reset the connection), ``wakeup`` is set so that the other
+    direction stops as well. Since a TLS connection can't be half-closed,
+    an EOF towards a TLS socket also stops the other direction.
+
+    Args:
+        send_socket (Union[socket.socket, _tls.TLSSocket]): The socket that
+            was being SENT to.
+        description (str): A description of the RECV->SEND relationship for
+            this socket pair.
+        wakeup (_buffer.Wakeup): The flag set when the connection is torn
+            down.
+        exc (Optional[OSError]): The error that ended the direction, if any.
+    """
+    if exc is not None:
+        wakeup.set()
+        _display.display(
+            f"Aborted redirecting socket for {description}: {exc}"
+        )
         return
 
-    log_queue.put((time.time_ns(), tcp_chunk, client_socket, server_socket))
+    if isinstance(send_socket, _tls.TLSSocket):
+        wakeup.set()
+    elif not wakeup.is_set():
+        half_close(send_socket)
+    _display.display(f"Done redirecting socket for {description}")
 
 
-def redirect_socket(recv_socket, send_socket, description, log_queue):
+def redirect_socket(
+    recv_socket,
+    send_socket,
+    description,
+    log_queue,
+    connection,
+    direction,
+    wakeup,
+    stop=None,
+):
     """Redirect a TCP stream from one socket to another.
 
     This only redirects in **one** direction, i.e. it RECVs from
-    ``recv_socket`` and SENDs to ``send_socket``.
+    ``recv_socket`` and SENDs to ``send_socket``. The size of each read is
+    adapted to the size of the chunks in the stream. Neither socket is
+    closed; see ``_finish_redirect()`` for how the end of the stream is
+    handled.
 
     Args:
         recv_socket (socket.socket): The socket that will be RECV-ed from.
@@ -48,30 +188,296 @@ def redirect_socket(recv_socket, send_socket, description, log_queue):
             this socket pair.
         log_queue (Optional[queue.Queue]): The queue where log lines will be
             pushed, or :data:`None`.
+        connection (Optional[_save_replay_log.Connection]): The connection
+            being relayed; only used if ``log_queue`` is set.
+        direction (int): The direction being relayed; used to capture log
+            lines and to select the relay metrics to update.
+        wakeup (_buffer.Wakeup): The flag set when the connection is torn
+            down.
+        stop (Optional[_buffer.Wakeup]): The flag set when the proxy stops
+            relaying every connection, if any.
     """
-    tcp_chunk = _buffer.recv(recv_socket, send_socket)
-    while tcp_chunk != b"":
-        _maybe_log_line(log_queue, tcp_chunk, recv_socket, send_socket)
+    relay_metrics = _metrics.RELAY[direction].shard()
+    wakeups = _relay_wakeups(wakeup, stop)
+    buffer_size = _buffer.DEFAULT_BUFFER_SIZE
+    try:
+        tcp_chunk = _buffer.recv(recv_socket, wakeups, buffer_size)
+        while tcp_chunk != b"":
+            received_ns = time.perf_counter_ns()
+            if not maybe_log_line(log_queue, tcp_chunk, connection, direction):
+                log_queue = None
+
+            _buffer.send(send_socket, tcp_chunk, wakeups)
+            relay_metrics.observe(
+                len(tcp_chunk), time.perf_counter_ns() - received_ns
+            )
+            # Read the next chunk from the socket.
+            buffer_size = _buffer.next_buffer_size(buffer_size, len(tcp_chunk))
+            tcp_chunk = _buffer.recv(recv_socket, wakeups, buffer_size)
+    except OSError as exc:
+        _finish_redirect(send_socket, description, wakeup, exc)
+    else:
+        _finish_redirect(send_socket, description, wakeup, None)
+    finally:
+        _metrics.RELAY[direction].close(relay_metrics)
+
+
+def _splice_all(recv_socket, send_socket, relay_metrics, wakeups):
+    pipe_fds = os.pipe()
+    try:
+        # NOTE: The time a spliced chunk spends in the proxy can't be
+        #       separated from the time spent waiting for it, so only its
+        #       size is recorded.
+        moved = _buffer.splice(recv_socket, send_socket, pipe_fds, wakeups)
+        while moved != 0:
+            relay_metrics.count(moved)
+            moved = _buffer.splice(recv_socket, send_socket, pipe_fds, wakeups)
+    finally:
+        os.close(pipe_fds[0])
+        os.close(pipe_fds[1])
+
 
-        _buffer.send(send_socket, tcp_chunk)
+def _relay_zero_copy(
+    recv_socket,
+    send_socket,
+    log_queue,
+    connection,
+    direction,
+    relay_metrics,
+    wakeups,
+):
+    if log_queue is None and _buffer.can_splice(recv_socket, send_socket):
+        _splice_all(recv_socket, send_socket, relay_metrics, wakeups)
+        return
+
+    buffer_view = memoryview(bytearray(_buffer.DEFAULT_BUFFER_SIZE))
+    size = _buffer.recv_into(recv_socket, wakeups, buffer_view)
+    while size != 0:
+        received_ns = time.perf_counter_ns()
+        is_full = size == len(buffer_view)
+        if log_queue is None:
+            _buffer.send(send_socket, buffer_view[:size], wakeups)
+            relayed = size
+        else:
+            tcp_chunks = [buffer_view[:size]]
+            if is_full:
+                tcp_chunks.extend(_buffer.drain(recv_socket, size))
+            if not maybe_log_line(
+                log_queue, b"".join(tcp_chunks), connection, direction
+            ):
+                log_queue = None
+            for tcp_chunk in tcp_chunks:
+                _buffer.send(send_socket, tcp_chunk, wakeups)
+            relayed = sum(len(tcp_chunk) for tcp_chunk in tcp_chunks)
+        relay_metrics.observe(relayed, time.perf_counter_ns() - received_ns)
+
+        if log_queue is None and _buffer.can_splice(recv_socket, send_socket):
+            # The capture budget was exhausted, so the rest of the stream
+            # doesn't need to pass through Python at all.
+            _splice_all(recv_socket, send_socket, relay_metrics, wakeups)
+            return
+
+        if is_full and size < _buffer.MAX_BUFFER_SIZE:
+            buffer_view = memoryview(bytearray(2 * size))
         # Read the next chunk from the socket.
-        tcp_chunk = _buffer.recv(recv_socket, send_socket)
+        size = _buffer.recv_into(recv_socket, wakeups, buffer_view)
+
+
+def redirect_socket_zero_copy(
+    recv_socket,
+    send_socket,
+    description,
+    log_queue,
+    connection,
+    direction,
+    wakeup,
+    stop=None,
+):
+    """Redirect a TCP stream from one socket to another, avoiding copies.
+
+    If the direction is **not** captured (i.e. ``log_queue`` is :data:`None`)
+    and ``splice(2)`` is available (and neither socket is a TLS socket),
+    each chunk is moved between the sockets
+    through a pipe without ever being copied into Python. Otherwise, each
+    chunk is read into a single preallocated buffer (reused for the lifetime
+    of the connection) and sent directly from a view of that buffer; a
+    captured chunk is still copied once, so that the log line can outlive
+    the buffer. If the capture budget of a captured direction is exhausted,
+    the rest of the stream is moved with ``splice(2)`` (where available).
+
+    The buffer grows (up to ``_buffer.MAX_BUFFER_SIZE``) each time a read
+    fills it. For a captured direction, a read that fills the buffer is
+    also followed by ``_buffer.drain()`` so that one logical write is
+    captured as one chunk.
+
+    Args:
+        recv_socket (socket.socket): The socket that will be RECV-ed from.
+        send_socket (socket.socket): The socket that will be SENT to.
+        description (str): A description of the RECV->SEND relationship for
+            this socket pair.
+        log_queue (Optional[queue.Queue]): The queue where log lines will be
+            pushed, or :data:`None`.
+        connection (Optional[_save_replay_log.Connection]): The connection
+            being relayed; only used if ``log_queue`` is set.
+        direction (int): The direction being relayed; used to capture log
+            lines and to select the relay metrics to update.
+        wakeup (_buffer.Wakeup): The flag set when the connection is torn
+            down.
+        stop (Optional[_buffer.Wakeup]): The flag set when the proxy stops
+            relaying every connection, if any.
+    """
+    relay_metrics = _metrics.RELAY[direction].shard()
+    wakeups = _relay_wakeups(wakeup, stop)
+    try:
+        _relay_zero_copy(
+            recv_socket,
+            send_socket,
+            log_queue,
+            connection,
+            direction,
+            relay_metrics,
+            wakeups,
+        )
+    except OSError as exc:
+        _finish_redirect(send_socket, description, wakeup, exc)
+    else:
+        _finish_redirect(send_socket, description, wakeup, None)
+    finally:
+        _metrics.RELAY[direction].close(relay_metrics)
+
+
+def open_upstream(server_host, server_port, timeout=CONNECT_TIMEOUT):
+    """Open a (non-blocking) connection to the server.
+
+    Unlike a bare ``connect_ex()``, this waits for the connection to
+    complete (or fail) so that the socket is ready to be relayed to as soon
+    as it is returned.
+
+    Args:
+        server_host (str): The host name where the "server" process is running
+            (i.e. the server that is being proxied).
+        server_port (int): A port number for a running "server" process.
+        timeout (Optional[float]): The maximum time (in seconds) to wait for
+            the connection to complete.
+
+    Returns:
+        socket.socket: The connected (non-blocking) socket.
+
+    Raises:
+        OSError: If the connection fails or times out.
+    """
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # See: https://docs.python.org/3/library/socket.html#timeouts-and-the-accept-method
+    server_socket.setblocking(0)
+    try:
+        indicator = server_socket.connect_ex((server_host, server_port))
+        if indicator == errno.EINPROGRESS:
+            if not _buffer.wait_writable(server_socket, timeout):
+                raise TimeoutError(
+                    errno.ETIMEDOUT, "Timed out connecting to server"
+                )
+            indicator = server_socket.getsockopt(
+                socket.SOL_SOCKET, socket.SO_ERROR
+            )
+        if indicator != 0:
+            raise OSError(indicator, os.strerror(indicator))
+    except OSError:
+        server_socket.close()
+        raise
+
+    return server_socket
+
+
+def capture_connection(
+    log_queue, client_socket, server_socket, capture_policy=None
+):
+    """Create the connection that captured log lines are attributed to.
+
+    Args:
+        log_queue (Optional[queue.Queue]): The queue where log lines will be
+            pushed, or :data:`None` if the connection isn't captured.
+        client_socket (socket.socket): The client socket.
+        server_socket (socket.socket): The (connected) server socket.
+        capture_policy (Optional[_capture_policy.CapturePolicy]): The policy
+            providing the connection's capture budget and framer, if any.
+
+    Returns:
+        Optional[_save_replay_log.Connection]: The connection, or
+        :data:`None` if ``log_queue`` is not set (resolving the addresses is
+        only needed for capture).
+
+    Raises:
+        OSError: If either socket is no longer connected (e.g. the client
+            reset the connection right after it was accepted).
+    """
+    if log_queue is None:
+        return None
+
+    if capture_policy is None:
+        return _save_replay_log.Connection(client_socket, server_socket)
+
+    return _save_replay_log.Connection(
+        client_socket,
+        server_socket,
+        budget=capture_policy.budget(),
+        framer=capture_policy.framer(),
+    )
 
-    _display.display(f"Done redirecting socket for {description}")
-    recv_socket.close()
+
+def should_capture(log_queue, client_addr, capture_policy):
+    """Decide if a newly accepted connection should be captured.
+
+    Args:
+        log_queue (Optional[queue.Queue]): The queue where log lines will be
+            pushed, or :data:`None` if capture is off.
+        client_addr (str): The address of the client socket.
+        capture_policy (Optional[_capture_policy.CapturePolicy]): The capture
+            policy, if any.
+
+    Returns:
+        bool: Indicates if the connection should be captured.
+    """
+    if log_queue is None:
+        return False
+    if capture_policy is None:
+        return True
+    return capture_policy.should_capture(client_addr)
 
 
 def connect_socket_pair(
-    log_queue, client_socket, client_addr, server_host, server_port
+    log_queue,
+    client_socket,
+    client_addr,
+    server_host,
+    server_port,
+    zero_copy=False,
+    capture_responses=False,
+    upstream_pool=None,
+    stop=None,
+    capture_policy=None,
+    client_tls=None,
+    upstream_tls=None,
 ):
     """Connect two socket pairs for bidirectional RECV<->SEND.
 
     Since calls to RECV (both on the client and the server sockets) can block,
     this will spawn two threads that simultaneously read (via RECV) from one
-    socket and write (via SEND) into the other socket.
+    socket and write (via SEND) into the other socket. If the server can't
+    be reached, the failure is reported and the client socket is closed.
+
+    An EOF in one direction is propagated to the peer as a half-close and
+    the other direction keeps running; an error in one direction (or
+    ``stop`` being set) wakes up and stops both. Once both directions are
+    done, both sockets are closed.
+
+    If ``capture_policy`` decides the connection isn't captured, both
+    directions are relayed with ``redirect_socket_zero_copy()`` (i.e. with
+    ``splice(2)`` where available) without touching the capture path. (With
+    ``log_queue`` unset, ``zero_copy`` picks the relay as usual.)
 
     Args:
-        log_queue (queue.Queue): The queue where log lines will be pushed.
+        log_queue (Optional[queue.Queue]): The queue where log lines will be
+            pushed, or :data:`None` to relay without capturing.
         client_socket (socket.socket): An already open socket from a client
             that has made a request directly to a running
             ``tcp-replay-reverse-proxy`` proxy.
@@ -82,26 +488,108 @@ def connect_socket_pair(
         server_host (str): The host name where the "server" process is running
             (i.e. the server that is being proxied).
         server_port (int): A port number for a running "server" process.
+        zero_copy (Optional[bool]): Indicates if each direction should be
+            relayed with ``redirect_socket_zero_copy()`` rather than
+            ``redirect_socket()``.
+        capture_responses (Optional[bool]): Indicates if the chunks sent
+            from the server to the client should also be logged. (Otherwise,
+            only the chunks sent **to** the server are logged.)
+        upstream_pool (Optional[_upstream_pool.UpstreamPool]): A pool of
+            already connected server sockets to take from. If not set (or if
+            the pool is empty), a new connection is opened.
+        stop (Optional[_buffer.Wakeup]): A flag that is set when the proxy
+            stops relaying every connection.
+        capture_policy (Optional[_capture_policy.CapturePolicy]): Decides if
+            (and how much of) the connection is captured. If not set, the
+            whole connection is captured.
+        client_tls (Optional[_tls.ClientTLS]): Terminates TLS from the
+            client, if set. The negotiation and handshake are completed
+            before connecting to the server, so chunks are relayed (and
+            captured) as plaintext.
+        upstream_tls (Optional[_tls.UpstreamTLS]): Originates TLS to the
+            server, if set.
     """
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    # See: https://docs.python.org/3/library/socket.html#timeouts-and-the-accept-method
-    server_socket.setblocking(0)
-    indicator = server_socket.connect_ex((server_host, server_port))
-    if indicator not in (0, errno.EINPROGRESS):
-        err_name = errno.errorcode.get(indicator, "UNKNOWN")
-        raise BlockingIOError(indicator, f"Error: {err_name}")
+    if client_tls is not None:
+        try:
+            client_socket = client_tls.accept(client_socket)
+        except OSError as exc:
+            _display.display(
+                f"Failed TLS handshake with client({client_addr}): {exc}"
+            )
+            return
+
+    if not should_capture(log_queue, client_addr, capture_policy):
+        # NOTE: Only a connection the policy skipped is forced onto the
+        #       zero-copy relay; with capture off altogether, ``zero_copy``
+        #       is honored as given.
+        if log_queue is not None:
+            zero_copy = True
+        log_queue = None
 
     server_addr = f"{server_host}:{server_port}"
+    server_socket = None
+    if upstream_pool is not None:
+        server_socket = upstream_pool.get()
+    if server_socket is None:
+        try:
+            server_socket = open_upstream(server_host, server_port)
+        except OSError as exc:
+            _metrics.CONNECT_FAILURES.inc()
+            _display.display(
+                f"Failed to connect to server({server_addr}): {exc}"
+            )
+            client_socket.close()
+            return
+
+    if upstream_tls is not None:
+        try:
+            server_socket = upstream_tls.wrap(server_socket)
+        except OSError as exc:
+            _display.display(
+                f"Failed TLS handshake with server({server_addr}): {exc}"
+            )
+            client_socket.close()
+            return
+
+    try:
+        connection = capture_connection(
+            log_queue, client_socket, server_socket, capture_policy
+        )
+    except OSError as exc:
+        _display.display(f"Client({client_addr}) disconnected: {exc}")
+        client_socket.close()
+        server_socket.close()
+        return
+
+    wakeup = _buffer.Wakeup()
     read_description = f"client({client_addr})->proxy->server({server_addr})"
-    # Only log the lines sent **to** the server.
+    redirect = redirect_socket_zero_copy if zero_copy else redirect_socket
     t_read = threading.Thread(
-        target=redirect_socket,
-        args=(client_socket, server_socket, read_description, log_queue),
+        target=redirect,
+        args=(
+            client_socket,
+            server_socket,
+            read_description,
+            log_queue,
+            connection,
+            _replay_format.CLIENT_TO_SERVER,
+            wakeup,
+            stop,
+        ),
     )
     write_description = f"server({server_addr})->proxy->client({client_addr})"
     t_write = threading.Thread(
-        target=redirect_socket,
-        args=(server_socket, client_socket, write_description, None),
+        target=redirect,
+        args=(
+            server_socket,
+            client_socket,
+            write_description,
+            log_queue if capture_responses else None,
+            connection,
+            _replay_format.SERVER_TO_CLIENT,
+            wakeup,
+            stop,
+        ),
     )
 
     t_read.start()
@@ -109,3 +597,8 @@ def connect_socket_pair(
 
     t_read.join()
     t_write.join()
+    if upstream_tls is not None:
+        upstream_tls.save_session(server_socket)
+    client_socket.close()
+    server_socket.close()
+    wakeup.close()
@@ -0,0 +1,149 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import array
+
+
+# Each power of two is split into ``2**(SUB_BUCKET_BITS - 1)`` buckets, so a
+# recorded value is reported within ~3% of its true value.
+SUB_BUCKET_BITS = 5
+_SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+_HALF_SUB_BUCKETS = _SUB_BUCKETS >> 1
+_NUM_BUCKETS = (64 - SUB_BUCKET_BITS + 2) * _HALF_SUB_BUCKETS
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def _bucket_index(value):
+    if value < _SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    return shift * _HALF_SUB_BUCKETS + (value >> shift)
+
+
+def _bucket_upper(index):
+    if index < _SUB_BUCKETS:
+        return index
+    shift = index // _HALF_SUB_BUCKETS - 1
+    mantissa = index - shift * _HALF_SUB_BUCKETS
+    return ((mantissa + 1) << shift) - 1
+
+
+class Histogram:
+    """A fixed-size, log-linear histogram of non-negative integers.
+
+    Recording a value is constant time and the memory used doesn't depend on
+    the number of values recorded, so this is suitable for latencies
+    observed over the lifetime of a long-running proxy.
+    """
+
+    def __init__(self):
+        self.counts = array.array("Q", bytes(8 * _NUM_BUCKETS))
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, value):
+        """Record a value.
+
+        Args:
+            value (int): The value; negative values are recorded as ``0``.
+        """
+        value = max(value, 0)
+        self.counts[_bucket_index(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Add the values recorded by another histogram to this one.
+
+        Args:
+            other (Histogram): The histogram to merge.
+        """
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        if self.min is None:
+            self.min = other.min
+        elif other.min is not None:
+            self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percentile):
+        """Estimate a percentile of the recorded values.
+
+        Args:
+            percentile (float): The percentile, between ``0`` and ``100``.
+
+        Returns:
+            int: The (upper bound of the bucket holding the) percentile; ``0``
+            if no values have been recorded.
+        """
+        if self.count == 0:
+            return 0
+
+        rank = max(1, round(self.count * percentile / 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(_bucket_upper(index), self.max)
+        return self.max
+
+    def cumulative_counts(self, bounds):
+        """Count the recorded values at or below each of several bounds.
+
+        Args:
+            bounds (Sequence[int]): The bounds, in increasing order.
+
+        Returns:
+            List[int]: The number of values in the buckets up to (and
+            including) the bucket holding each bound.
+        """
+        result = []
+        seen = 0
+        index = 0
+        for bound in bounds:
+            last = min(_bucket_index(max(bound, 0)), _NUM_BUCKETS - 1)
+            while index <= last:
+                seen += self.counts[index]
+                index += 1
+            result.append(seen)
+        return result
+
+    def summary(self, scale=1):
+        """Summarize the recorded values.
+
+        Args:
+            scale (Optional[float]): A divisor applied to each value, e.g.
+                ``1e6`` to report nanoseconds as milliseconds.
+
+        Returns:
+            Dict[str, float]: The count, mean, min, max and each of the
+            :data:`PERCENTILES` (e.g. ``"p99"``).
+        """
+        result = {"count": self.count}
+        if self.count == 0:
+            return result
+
+        result["mean"] = self.total / self.count / scale
+        result["min"] = self.min / scale
+        for percentile in PERCENTILES:
+            result[f"p{percentile:g}"] = self.percentile(percentile) / scale
+        result["max"] = self.max / scale
+        return result
@@ -0,0 +1,225 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import array
+import bisect
+import itertools
+import pathlib
+import struct
+
+import _read_replay_log
+import _replay_format
+
+
+MAGIC = b"TRRPIDX\x00"
+VERSION = 1
+HEADER_STRUCT = struct.Struct(">8sI")
+# Each entry is the byte offset of a record, its timestamp and the id of
+# its connection. When written during capture, the ids of a version 1 replay
+# log are unique within the capturing process (see
+# ``_save_replay_log.Connection``), while those of a version 2 replay log are
+# the per-file ids of its connection table. A merged replay log's ids are
+# unique within the merged file.
+ENTRY_STRUCT = struct.Struct(">QQI")
+HEADER = HEADER_STRUCT.pack(MAGIC, VERSION)
+
+
+def index_filename(replay_log):
+    """Determine the sidecar index file for a replay log.
+
+    Args:
+        replay_log (pathlib.Path): The replay log (or replay log segment).
+
+    Returns:
+        pathlib.Path: The index file.
+    """
+    replay_log = pathlib.Path(replay_log)
+    return replay_log.with_name(f"{replay_log.name}.idx")
+
+
+class ReplayLogIndex:
+    """A loaded sidecar index for a replay log.
+
+    Args:
+        offsets (array.array): The byte offset of each record.
+        timestamps (array.array): The timestamp of each record.
+        connection_ids (array.array): The connection id of each record;
+            ids tell connections apart within the replay log (but are not
+            meaningful across replay logs).
+    """
+
+    def __init__(self, offsets, timestamps, connection_ids):
+        self.offsets = offsets
+        self.timestamps = timestamps
+        self.connection_ids = connection_ids
+        # Records are only **roughly** ordered by timestamp (log lines from
+        # different connections can be reordered slightly), so seeks use
+        # the running maximum, which is sorted.
+        self._max_timestamps = array.array(
+            "Q", itertools.accumulate(timestamps, max)
+        )
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def seek_time(self, time_ns):
+        """Find where to start reading for records at or after a time.
+
+        Every record before the returned position has a timestamp before
+        ``time_ns``; a few records after it may as well, so callers should
+        still filter on the timestamp.
+
+        Args:
+            time_ns (int): A timestamp in nanoseconds since the epoch.
+
+        Returns:
+            Tuple[int, int]: The position of the record in the index and its
+            byte offset (or the number of records and :data:`None` if every
+            record is before ``time_ns``).
+        """
+        position = bisect.bisect_left(self._max_timestamps, time_ns)
+        if position == len(self.offsets):
+            return position, None
+        return position, self.offsets[position]
+
+    def connection_offsets(self, connection_id):
+        """Find the byte offset of every record for a connection.
+
+        Args:
+            connection_id (int): The connection id.
+
+        Returns:
+            List[int]: The byte offsets.
+        """
+        return [
+            offset
+            for offset, current_id in zip(self.offsets, self.connection_ids)
+            if current_id == connection_id
+        ]
+
+    def split(self, parts, file_size):
+        """Split the replay log into byte ranges at record boundaries.
+
+        Args:
+            parts (int): The (maximum) number of ranges.
+            file_size (int): The size of the replay log.
+
+        Returns:
+            List[Tuple[int, int]]: Non-empty ``(start, end)`` byte ranges
+            which cover every record in the replay log (i.e. everything
+            after the header) and are roughly equal in size.
+        """
+        # NOTE: The first range starts at the first record rather than at
+        #       ``0``, since the replay log may start with a header.
+        boundaries = [self.offsets[0] if self.offsets else file_size]
+        for part in range(1, parts):
+            target = file_size * part // parts
+            position = bisect.bisect_left(self.offsets, target)
+            if position < len(self.offsets):
+                offset = self.offsets[position]
+                if offset > boundaries[-1]:
+                    boundaries.append(offset)
+        boundaries.append(file_size)
+        return [
+            (start, end)
+            for start, end in zip(boundaries, boundaries[1:])
+            if end > start
+        ]
+
+
+def load_index(filename):
+    """Load a sidecar index.
+
+    Args:
+        filename (pathlib.Path): The index file.
+
+    Returns:
+        ReplayLogIndex: The loaded index.
+
+    Raises:
+        ValueError: If the file is not a (supported) replay log index.
+    """
+    with open(filename, "rb") as file_obj:
+        data = file_obj.read()
+
+    magic, version = HEADER_STRUCT.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a supported replay log index", filename)
+
+    body = memoryview(data)[HEADER_STRUCT.size :]
+    # Ignore a partially written entry at the end.
+    body = body[: len(body) - len(body) % ENTRY_STRUCT.size]
+    offsets = array.array("Q")
+    timestamps = array.array("Q")
+    connection_ids = array.array("I")
+    for offset, time_ns, connection_id in ENTRY_STRUCT.iter_unpack(body):
+        offsets.append(offset)
+        timestamps.append(time_ns)
+        connection_ids.append(connection_id)
+
+    return ReplayLogIndex(offsets, timestamps, connection_ids)
+
+
+def _index_v2(replay_log, index_obj):
+    with _read_replay_log.ReplayLog(replay_log) as log:
+        columns = log.columns()
+    entries = zip(
+        columns["offsets"], columns["timestamps"], columns["connection_ids"]
+    )
+    for entry in entries:
+        index_obj.write(ENTRY_STRUCT.pack(*entry))
+    return len(columns["offsets"])
+
+
+def build_index(replay_log, filename=None):
+    """Build a sidecar index for an existing replay log.
+
+    Since a version 1 replay log doesn't record connection ids, each
+    distinct ``(client address, server address)`` pair is given an id in
+    the order it first appears. (A client port that is reused for a later
+    connection will share the earlier connection's id; an index written
+    during capture, or by :func:`_merge_replay_log.merge_replay_logs`,
+    doesn't have this problem.) A version 2 replay log is indexed with the
+    connection ids it records.
+
+    Args:
+        replay_log (pathlib.Path): The replay log.
+        filename (Optional[pathlib.Path]): The index file; defaults to
+            ``index_filename(replay_log)``.
+
+    Returns:
+        int: The number of records indexed.
+    """
+    if filename is None:
+        filename = index_filename(replay_log)
+
+    connection_ids = {}
+    count = 0
+    with open(replay_log, "rb") as log_obj, open(filename, "wb") as index_obj:
+        index_obj.write(HEADER)
+        version, flags = _replay_format.read_header(log_obj)
+        if version == _replay_format.VERSION_2:
+            return _index_v2(replay_log, index_obj)
+
+        dictionary = {}
+        offset = log_obj.tell()
+        record = _read_replay_log.read_record(log_obj, flags, dictionary)
+        while record is not None:
+            time_ns, client_addr, server_addr, _, _ = record
+            key = client_addr, server_addr
+            connection_id = connection_ids.setdefault(key, len(connection_ids))
+            index_obj.write(ENTRY_STRUCT.pack(offset, time_ns, connection_id))
+            count += 1
+            offset = log_obj.tell()
+            record = _read_replay_log.read_record(log_obj, flags, dictionary)
+
+    return count
@@ -0,0 +1,307 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import heapq
+
+import _index
+import _read_replay_log
+import _replay_format
+import _save_replay_log
+
+
+def _row_timestamp(row):
+    record, _ = row
+    return record[0]
+
+
+def _index_ids(replay_log, version):
+    """Load the connection ids for a version 1 replay log from its index.
+
+    Returns:
+        Optional[array.array]: The connection id of each record, if
+        ``replay_log`` is a version 1 replay log with a sidecar index.
+    """
+    index_file = _index.index_filename(replay_log)
+    if version == _replay_format.VERSION_2 or not index_file.exists():
+        return None
+    return _index.load_index(index_file).connection_ids
+
+
+def _keyed_rows(file_obj, version, flags, source_index=0, index_ids=None):
+    """Pair each row of a replay log with the key of its connection.
+
+    A connection in a version 2 replay log is keyed by its connection id
+    (along with ``source_index``, since ids are only unique within a file,
+    or within a process for the ids in the index of a version 1 replay
+    log). A version 1 replay log doesn't record connection ids, so unless
+    they are given as ``index_ids``, a connection is keyed by its
+    ``(client address, server address)`` pair instead.
+
+    Yields:
+        Tuple[Tuple[int, str, str, bytes, int], Hashable]: Each row and the
+        key of its connection.
+    """
+    rows = _read_replay_log.read_records(
+        file_obj, version, flags, with_ids=True
+    )
+    for position, (record, connection_id) in enumerate(rows):
+        if connection_id is None and index_ids is not None:
+            # NOTE: An index written by a proxy that was stopped abruptly
+            #       may be missing the entries for the last few records.
+            if position < len(index_ids):
+                connection_id = index_ids[position]
+        if connection_id is None:
+            yield record, (record[1], record[2])
+        else:
+            yield record, (source_index, connection_id)
+
+
+class _RecordEncoder:
+    """Encodes rows read from any replay log in the format of the output.
+
+    Args:
+        version (int): The format version of the output.
+        flags (int): The format flags of the output.
+    """
+
+    def __init__(self, version, flags):
+        self.directions = bool(flags & _replay_format.FLAG_DIRECTION)
+        self.deduplicator = None
+        if flags & _replay_format.FLAG_DEDUP:
+            self.deduplicator = _save_replay_log.Deduplicator()
+        self.v2 = version == _replay_format.VERSION_2
+        self.connections = _save_replay_log.ConnectionTable()
+
+    def encode(self, record, key):
+        """Encode a row.
+
+        Each distinct connection ``key`` is given a connection id in the
+        order it first appears; in a version 2 output, this is the id
+        recorded in the connection table.
+
+        Args:
+            record (Tuple[int, str, str, bytes, int]): The timestamp, client
+                address, server address, TCP chunk and direction.
+            key (Hashable): Identifies the connection of the row (see
+                :func:`_keyed_rows`).
+
+        Returns:
+            Tuple[bytes, bytes, int]: The entry in the connection table that
+            must be written first (empty unless this is the first record of
+            a connection in a version 2 output), the encoded record and the
+            id of its connection.
+        """
+        time_ns, client_addr, server_addr, tcp_chunk, direction = record
+        connection_id, is_new = self.connections.lookup(key)
+        if not self.v2:
+            encoded = _save_replay_log.encode_record(
+                time_ns,
+                client_addr,
+                server_addr,
+                tcp_chunk,
+                direction if self.directions else None,
+                self.deduplicator,
+            )
+            return b"", encoded, connection_id
+
+        encoded = _save_replay_log.encode_record_v2(
+            time_ns, connection_id, direction, tcp_chunk
+        )
+        if not is_new:
+            return b"", encoded, connection_id
+        entry = _save_replay_log.encode_record_v2(
+            time_ns,
+            connection_id,
+            _replay_format.CONNECTION_ENTRY,
+            _replay_format.encode_addresses(client_addr, server_addr),
+        )
+        return entry, encoded, connection_id
+
+
+def _write_records(rows, file_obj, version, flags, index_obj=None):
+    """Write a header and rows (see :func:`_keyed_rows`) to a replay log.
+
+    If ``index_obj`` is set, a sidecar index entry is written to it for each
+    record (with the connection ids assigned by :class:`_RecordEncoder`).
+
+    Returns:
+        int: The number of records written.
+    """
+    encoder = _RecordEncoder(version, flags)
+    header = _replay_format.encode_header(flags, version)
+    file_obj.write(header)
+    if index_obj is not None:
+        index_obj.write(_index.HEADER)
+    offset = len(header)
+    count = 0
+    for record, key in rows:
+        entry, encoded, connection_id = encoder.encode(record, key)
+        offset += len(entry)
+        if index_obj is not None:
+            index_obj.write(
+                _index.ENTRY_STRUCT.pack(offset, record[0], connection_id)
+            )
+        file_obj.write(entry + encoded)
+        offset += len(encoded)
+        count += 1
+    return count
+
+
+def merge_replay_logs(shards, filename, index=False):
+    """Merge replay log shards into a single timestamp-ordered replay log.
+
+    Each shard is read in a streaming fashion, so memory usage is bounded by
+    the number of shards rather than their size. If any shard has records
+    with a direction, so does the merged replay log (and it starts with the
+    corresponding header). Likewise, if any shard is deduplicated (see
+    :data:`_replay_format.FLAG_DEDUP`), the merged replay log is
+    deduplicated too (with a dictionary of its own). If any shard is a
+    version 2 replay log, so is the merged replay log (with a connection
+    table of its own, see :class:`_RecordEncoder`); it is never
+    deduplicated. Connections from a version 2 shard (or a version 1 shard
+    with a sidecar index) keep their identity, even if they share their
+    addresses with another connection (see :func:`_keyed_rows`).
+
+    .. note::
+
+        Each shard is **assumed** to already be (roughly) ordered by
+        timestamp; this is true of a shard written by a single
+        ``save_log_worker``, up to the small amount of reordering that can
+        happen when two connections push to the same log queue at nearly the
+        same time.
+
+    Args:
+        shards (Iterable[pathlib.Path]): The replay log shards to merge.
+        filename (pathlib.Path): The file where the merged replay log will be
+            written.
+        index (Optional[bool]): Indicates if a sidecar index should be
+            written for the merged replay log. Each connection is given a
+            new id, unique within the merged replay log, rather than one
+            derived from its addresses.
+
+    Returns:
+        int: The number of records written.
+    """
+    with contextlib.ExitStack() as stack:
+        version = _replay_format.VERSION
+        flags = 0
+        streams = []
+        for shard_index, shard in enumerate(shards):
+            shard_obj = stack.enter_context(open(shard, "rb"))
+            shard_version, shard_flags = _replay_format.read_header(shard_obj)
+            version = max(version, shard_version)
+            flags |= shard_flags
+            streams.append(
+                _keyed_rows(
+                    shard_obj,
+                    shard_version,
+                    shard_flags,
+                    shard_index,
+                    _index_ids(shard, shard_version),
+                )
+            )
+
+        if version == _replay_format.VERSION_2:
+            flags &= _replay_format.V2_FLAGS
+        file_obj = stack.enter_context(open(filename, "wb"))
+        index_obj = None
+        if index:
+            index_obj = stack.enter_context(
+                open(_index.index_filename(filename), "wb")
+            )
+        return _write_records(
+            heapq.merge(*streams, key=_row_timestamp),
+            file_obj,
+            version,
+            flags,
+            index_obj,
+        )
+
+
+def expand_replay_log(source, filename):
+    """Expand a deduplicated replay log back to the plain format.
+
+    Each chunk stored as a reference (see
+    :data:`_replay_format.FLAG_DEDUP`) is replaced by the chunk it refers
+    to, so the expanded replay log can be read by tools that don't support
+    deduplication. The replay log is read in a streaming fashion; memory
+    usage is bounded by its dictionary.
+
+    Args:
+        source (pathlib.Path): The replay log to expand.
+        filename (pathlib.Path): The file where the expanded replay log will
+            be written.
+
+    Returns:
+        int: The number of records written.
+    """
+    with open(source, "rb") as source_obj, open(filename, "wb") as file_obj:
+        version, flags = _replay_format.read_header(source_obj)
+        return _write_records(
+            _keyed_rows(source_obj, version, flags),
+            file_obj,
+            version,
+            flags & ~_replay_format.FLAG_DEDUP,
+        )
+
+
+def convert_replay_log(source, filename, version):
+    """Convert a replay log to another format version.
+
+    A version 1 replay log is converted to version 2 (see
+    :data:`_replay_format.VERSION_2`) by giving each connection (see
+    :func:`_keyed_rows`) an id in a connection table and writing each record
+    with a fixed-width header; deduplicated chunks are expanded. A version
+    2 replay log is converted back to version 1 with the direction flag
+    (if it is set in the source) and the same records. The replay log is
+    read in a streaming fashion; memory usage is bounded by the number of
+    connections.
+
+    Args:
+        source (pathlib.Path): The replay log to convert.
+        filename (pathlib.Path): The file where the converted replay log
+            will be written.
+        version (int): The format version of the converted replay log; one
+            of :data:`_replay_format.VERSIONS`.
+
+    Returns:
+        int: The number of records written.
+
+    Raises:
+        ValueError: If ``version`` is not one of
+            :data:`_replay_format.VERSIONS`.
+    """
+    if version not in _replay_format.VERSIONS:
+        raise ValueError(
+            f"Unsupported replay log version {version!r}",
+            _replay_format.VERSIONS,
+        )
+
+    with open(source, "rb") as source_obj, open(filename, "wb") as file_obj:
+        source_version, source_flags = _replay_format.read_header(
+            source_obj
+        )
+        flags = source_flags & _replay_format.V2_FLAGS
+        if version == _replay_format.VERSION:
+            flags = source_flags
+        return _write_records(
+            _keyed_rows(
+                source_obj,
+                source_version,
+                source_flags,
+                index_ids=_index_ids(source, source_version),
+            ),
+            file_obj,
+            version,
+            flags,
+        )
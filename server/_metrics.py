@@ -0,0 +1,814 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import http.server
+import json
+import threading
+import time
+
+import _display
+import _histogram
+
+
+METRICS_HOST = "127.0.0.1"
+# How often (in seconds) snapshots are taken by ``start_snapshots()``.
+SNAPSHOT_INTERVAL = 10.0
+# Upper bounds (in seconds) of the Prometheus histogram buckets.
+LATENCY_BUCKETS = (
+    0.00001,
+    0.000025,
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Counter:
+    """A monotonically increasing count."""
+
+    kind = "counter"
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """Increase the count.
+
+        Args:
+            amount (Optional[int]): The amount to increase by.
+        """
+        with self._lock:
+            self.value += amount
+
+    def sample(self):
+        return self.value
+
+
+class Gauge(Counter):
+    """A value that can go up and down."""
+
+    kind = "gauge"
+
+    def dec(self, amount=1):
+        """Decrease the value.
+
+        Args:
+            amount (Optional[int]): The amount to decrease by.
+        """
+        with self._lock:
+            self.value -= amount
+
+
+class Callback:
+    """A metric whose value is computed when it is collected.
+
+    Args:
+        kind (str): One of ``"counter"``, ``"gauge"`` or ``"histogram"``.
+        func (Callable[[], Any]): Computes the current value; for a
+            histogram, a sample as returned by :func:`sample_histogram`.
+    """
+
+    def __init__(self, kind, func):
+        self.kind = kind
+        self.func = func
+
+    def sample(self):
+        return self.func()
+
+
+class Histogram:
+    """A distribution of durations, recorded in nanoseconds.
+
+    The durations are reported in seconds.
+
+    Args:
+        histogram (Optional[_histogram.Histogram]): An existing histogram to
+            report, e.g. one updated along with other values.
+        lock (Optional[threading.Lock]): The lock held while ``histogram``
+            is updated.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, histogram=None, lock=None):
+        if histogram is None:
+            histogram = _histogram.Histogram()
+        self.histogram = histogram
+        self._lock = threading.Lock() if lock is None else lock
+
+    def observe(self, value_ns):
+        """Record a duration.
+
+        Args:
+            value_ns (int): The duration, in nanoseconds.
+        """
+        with self._lock:
+            self.histogram.record(value_ns)
+
+    def sample(self):
+        with self._lock:
+            return sample_histogram(self.histogram)
+
+
+def sample_histogram(histogram):
+    """Sample a histogram of durations for collection.
+
+    Args:
+        histogram (_histogram.Histogram): The durations, in nanoseconds.
+
+    Returns:
+        Dict[str, Any]: The cumulative bucket counts, count and sum (in
+        seconds) used for the Prometheus format and a summary (in seconds)
+        used for snapshots.
+    """
+    bounds_ns = [int(bound * 1e9) for bound in LATENCY_BUCKETS]
+    buckets = histogram.cumulative_counts(bounds_ns)
+    return {
+        "buckets": dict(zip(LATENCY_BUCKETS, buckets)),
+        "count": histogram.count,
+        "sum": histogram.total / 1e9,
+        "summary": histogram.summary(scale=1e9),
+    }
+
+
+class RelayShard:
+    """The relay metrics for one direction of one connection.
+
+    A shard is only updated by the relay for its connection, so its lock is
+    only ever contended by a scrape. The bytes, chunks and relay latency for
+    a chunk are updated together, since they are updated once per relayed
+    chunk.
+    """
+
+    def __init__(self):
+        self.bytes = 0
+        self.chunks = 0
+        self.latency = _histogram.Histogram()
+        self.lock = threading.Lock()
+
+    def observe(self, size, latency_ns):
+        """Record a relayed chunk.
+
+        Args:
+            size (int): The size of the chunk.
+            latency_ns (int): The time from receiving the chunk until it was
+                sent (including the time to capture it), in nanoseconds.
+        """
+        with self.lock:
+            self.bytes += size
+            self.chunks += 1
+            self.latency.record(latency_ns)
+
+    def count(self, size):
+        """Record a relayed chunk without its relay latency.
+
+        Args:
+            size (int): The size of the chunk.
+        """
+        with self.lock:
+            self.bytes += size
+            self.chunks += 1
+
+
+class RelayMetrics:
+    """The metrics for one direction of the relay.
+
+    Rather than updating one process-wide total for every relayed chunk
+    (which would make every relay thread contend for one lock), each
+    connection updates its own :class:`RelayShard`. A shard is folded into
+    the totals when its connection is done; until then, it is added in
+    whenever the metrics are collected.
+    """
+
+    def __init__(self):
+        self.totals = RelayShard()
+        # The sum taken by the most recent ``refresh()``.
+        self.collected = RelayShard()
+        self._shards = set()
+        self._lock = threading.Lock()
+
+    def shard(self):
+        """Start the metrics for one direction of a connection.
+
+        Returns:
+            RelayShard: The shard to update; it must be passed to
+            :meth:`close` once the connection is done.
+        """
+        shard = RelayShard()
+        with self._lock:
+            self._shards.add(shard)
+        return shard
+
+    def close(self, shard):
+        """Fold the metrics for a finished connection into the totals.
+
+        Args:
+            shard (RelayShard): A shard returned by :meth:`shard`.
+        """
+        with self._lock:
+            self._shards.discard(shard)
+            with shard.lock, self.totals.lock:
+                self.totals.bytes += shard.bytes
+                self.totals.chunks += shard.chunks
+                self.totals.latency.merge(shard.latency)
+
+    def collect(self):
+        """Add up the totals and the shards of every active connection.
+
+        Returns:
+            RelayShard: A new shard holding the sum.
+        """
+        result = RelayShard()
+        with self._lock:
+            for shard in (self.totals, *self._shards):
+                with shard.lock:
+                    result.bytes += shard.bytes
+                    result.chunks += shard.chunks
+                    result.latency.merge(shard.latency)
+        return result
+
+    def refresh(self):
+        """Update ``collected``, e.g. once at the start of a collection."""
+        self.collected = self.collect()
+
+
+class TLSMetrics:
+    """The metrics for TLS handshakes on one side of the proxy."""
+
+    def __init__(self):
+        self.handshakes = Counter()
+        self.resumed = Counter()
+        self.failures = Counter()
+        self.latency = Histogram()
+
+
+class _Family:
+    """Every metric with the same name (one per set of label values)."""
+
+    def __init__(self, name, kind, help_text):
+        self.name = name
+        self.kind = kind
+        self.help_text = help_text
+        self.children = {}
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    parts = ",".join(f'{key}="{value}"' for key, value in labels)
+    return "{" + parts + "}"
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Registry:
+    """A collection of named metrics.
+
+    Metrics can be rendered in the Prometheus text exposition format or
+    taken as a JSON-serializable snapshot. Metrics are cheap to update (the
+    metrics updated for every relayed chunk are kept per connection, see
+    :class:`RelayMetrics`), so metrics are always collected.
+    """
+
+    def __init__(self):
+        self.families = {}
+        self._before_collect = []
+        self._lock = threading.Lock()
+        # Held for a whole collection, so that the values prepared by the
+        # ``before_collect()`` hooks are sampled by one collection at a time.
+        self._collect_lock = threading.Lock()
+
+    def register(self, name, help_text, metric, labels=None):
+        """Register a metric.
+
+        Registering a metric with the same name and labels as an existing
+        metric replaces the existing metric.
+
+        Args:
+            name (str): The metric name.
+            help_text (str): A description of the metric.
+            metric (Union[Counter, Gauge, Callback, Histogram]): The metric.
+            labels (Optional[Dict[str, str]]): The label values.
+
+        Returns:
+            Union[Counter, Gauge, Callback, Histogram]: The ``metric``.
+
+        Raises:
+            ValueError: If ``name`` is already registered with another kind.
+        """
+        key = tuple(sorted((labels or {}).items()))
+        with self._lock:
+            family = self.families.get(name)
+            if family is None:
+                family = _Family(name, metric.kind, help_text)
+                self.families[name] = family
+            elif family.kind != metric.kind:
+                raise ValueError(
+                    f"Metric {name} is already a {family.kind}", metric.kind
+                )
+            family.children[key] = metric
+        return metric
+
+    def before_collect(self, func):
+        """Add a hook called once at the start of every collection.
+
+        This lets several metrics be sampled from a single (consistent)
+        computation, rather than each repeating it.
+
+        Args:
+            func (Callable[[], None]): The hook.
+        """
+        with self._lock:
+            self._before_collect.append(func)
+
+    def _collect(self):
+        with self._collect_lock:
+            with self._lock:
+                hooks = list(self._before_collect)
+                families = list(self.families.values())
+                children = [
+                    list(family.children.items()) for family in families
+                ]
+            for func in hooks:
+                func()
+            collected = []
+            for family, items in zip(families, children):
+                samples = [
+                    (labels, metric.sample()) for labels, metric in items
+                ]
+                collected.append((family, samples))
+            return collected
+
+    def render(self):
+        """Render every metric in the Prometheus text exposition format.
+
+        Returns:
+            str: The rendered metrics.
+        """
+        lines = []
+        for family, samples in self._collect():
+            lines.append(f"# HELP {family.name} {family.help_text}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            for labels, value in samples:
+                if family.kind != "histogram":
+                    lines.append(
+                        f"{family.name}{_format_labels(labels)} "
+                        f"{_format_value(value)}"
+                    )
+                    continue
+
+                for bound, count in value["buckets"].items():
+                    bucket_labels = labels + (("le", f"{bound:g}"),)
+                    lines.append(
+                        f"{family.name}_bucket{_format_labels(bucket_labels)} "
+                        f"{count}"
+                    )
+                bucket_labels = labels + (("le", "+Inf"),)
+                lines.append(
+                    f"{family.name}_bucket{_format_labels(bucket_labels)} "
+                    f"{value['count']}"
+                )
+                lines.append(
+                    f"{family.name}_sum{_format_labels(labels)} "
+                    f"{_format_value(value['sum'])}"
+                )
+                lines.append(
+                    f"{family.name}_count{_format_labels(labels)} "
+                    f"{value['count']}"
+                )
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """Take a snapshot of every metric.
+
+        Returns:
+            Dict[str, Any]: The time of the snapshot (in seconds since the
+            epoch) and each metric, keyed by name and then by labels (e.g.
+            ``"direction=client_to_server"``). Histograms are summarized as
+            a count, mean, min, max and percentiles (in seconds).
+        """
+        metrics = {}
+        for family, samples in self._collect():
+            values = {}
+            for labels, value in samples:
+                key = ",".join(f"{name}={label}" for name, label in labels)
+                if family.kind == "histogram":
+                    value = value["summary"]
+                values[key] = value
+            metrics[family.name] = values
+        return {"time": time.time(), "metrics": metrics}
+
+
+REGISTRY = Registry()
+
+
+def _register_relay(direction):
+    relay_metrics = RelayMetrics()
+    labels = {"direction": direction}
+    # NOTE: The shards are added up once per collection and all three
+    #       metrics are sampled from that sum.
+    REGISTRY.before_collect(relay_metrics.refresh)
+    REGISTRY.register(
+        "tcp_replay_relayed_bytes_total",
+        "Bytes relayed by the proxy.",
+        Callback("counter", lambda: relay_metrics.collected.bytes),
+        labels,
+    )
+    REGISTRY.register(
+        "tcp_replay_relayed_chunks_total",
+        "Chunks relayed by the proxy.",
+        Callback("counter", lambda: relay_metrics.collected.chunks),
+        labels,
+    )
+    REGISTRY.register(
+        "tcp_replay_relay_latency_seconds",
+        "Time from receiving a chunk until it has been sent.",
+        Callback(
+            "histogram",
+            lambda: sample_histogram(relay_metrics.collected.latency),
+        ),
+        labels,
+    )
+    return relay_metrics
+
+
+def _register_tls(side):
+    tls_metrics = TLSMetrics()
+    labels = {"side": side}
+    REGISTRY.register(
+        "tcp_replay_tls_handshakes_total",
+        "Completed TLS handshakes.",
+        tls_metrics.handshakes,
+        labels,
+    )
+    REGISTRY.register(
+        "tcp_replay_tls_resumed_total",
+        "Completed TLS handshakes that resumed a previous session.",
+        tls_metrics.resumed,
+        labels,
+    )
+    REGISTRY.register(
+        "tcp_replay_tls_handshake_failures_total",
+        "TLS handshakes that failed or timed out.",
+        tls_metrics.failures,
+        labels,
+    )
+    REGISTRY.register(
+        "tcp_replay_tls_handshake_seconds",
+        "Time to complete a TLS handshake.",
+        tls_metrics.latency,
+        labels,
+    )
+    return tls_metrics
+
+
+CONNECTIONS_ACTIVE = REGISTRY.register(
+    "tcp_replay_connections_active",
+    "Connections currently being relayed.",
+    Gauge(),
+)
+CONNECTIONS_TOTAL = REGISTRY.register(
+    "tcp_replay_connections_total",
+    "Connections admitted by the proxy.",
+    Counter(),
+)
+CONNECTIONS_REJECTED = REGISTRY.register(
+    "tcp_replay_connections_rejected_total",
+    "Connections rejected because too many connections were active.",
+    Counter(),
+)
+ACCEPT_LATENCY = REGISTRY.register(
+    "tcp_replay_accept_latency_seconds",
+    "Time from the listening socket becoming readable until a connection was "
+    "accepted and handed to its handler.",
+    Histogram(),
+)
+CONNECT_FAILURES = REGISTRY.register(
+    "tcp_replay_connect_failures_total",
+    "Failed connections to the upstream server.",
+    Counter(),
+)
+CAPTURE_SKIPPED = REGISTRY.register(
+    "tcp_replay_capture_skipped_connections_total",
+    "Connections relayed without being captured because of the capture "
+    "sampling or client filters.",
+    Counter(),
+)
+CAPTURE_BUDGET_EXHAUSTED = REGISTRY.register(
+    "tcp_replay_capture_budget_exhausted_total",
+    "Connections whose capture stopped because they exceeded the captured "
+    "bytes budget.",
+    Counter(),
+)
+# Indexed by direction (see ``_replay_format``).
+RELAY = (
+    _register_relay("client_to_server"),
+    _register_relay("server_to_client"),
+)
+# Keyed by the side of the proxy: TLS terminated for clients ("client") or
+# originated to the server ("upstream").
+TLS = {
+    "client": _register_tls("client"),
+    "upstream": _register_tls("upstream"),
+}
+RECORDS_WRITTEN = REGISTRY.register(
+    "tcp_replay_records_written_total",
+    "Records encoded into the replay log.",
+    Counter(),
+)
+BYTES_WRITTEN = REGISTRY.register(
+    "tcp_replay_written_bytes_total",
+    "Bytes of records encoded into the replay log.",
+    Counter(),
+)
+WRITER_LAG = REGISTRY.register(
+    "tcp_replay_writer_lag_seconds",
+    "Time from capturing the oldest log line in a batch until it was taken "
+    "by the replay log writer.",
+    Histogram(),
+)
+
+
+def register_capture_buffer(log_queue):
+    """Register the metrics for a capture buffer.
+
+    Args:
+        log_queue (_capture_buffer.CaptureBuffer): The buffer where log lines
+            are pushed.
+    """
+    REGISTRY.register(
+        "tcp_replay_capture_buffer_items",
+        "Log lines held in memory, waiting to be written.",
+        Callback("gauge", log_queue.qsize),
+    )
+    REGISTRY.register(
+        "tcp_replay_capture_buffer_bytes",
+        "Approximate bytes of log lines held in memory.",
+        Callback("gauge", lambda: log_queue.num_bytes),
+    )
+    REGISTRY.register(
+        "tcp_replay_dropped_records_total",
+        "Log lines dropped because the capture buffer was full.",
+        Callback("counter", lambda: log_queue.dropped_records),
+    )
+    REGISTRY.register(
+        "tcp_replay_spilled_records_total",
+        "Log lines spilled to disk because the capture buffer was full.",
+        Callback("counter", lambda: log_queue.spilled_records),
+    )
+
+
+def register_stream_sink(stream_sink):
+    """Register the metrics for a sink streaming to a collector.
+
+    Args:
+        stream_sink (_stream_sink.StreamSink): The sink.
+    """
+    labels = {"collector": stream_sink.addr}
+    REGISTRY.register(
+        "tcp_replay_stream_connected",
+        "Indicates if the sink is connected to the collector (1) or not (0).",
+        Callback("gauge", lambda: int(stream_sink.connected)),
+        labels,
+    )
+    REGISTRY.register(
+        "tcp_replay_stream_buffer_bytes",
+        "Approximate bytes of log lines held in memory, waiting to be sent.",
+        Callback("gauge", lambda: stream_sink.buffered_bytes),
+        labels,
+    )
+    REGISTRY.register(
+        "tcp_replay_stream_sent_records_total",
+        "Log lines sent to the collector.",
+        Callback("counter", lambda: stream_sink.sent_records),
+        labels,
+    )
+    REGISTRY.register(
+        "tcp_replay_stream_sent_bytes_total",
+        "Bytes (of frames) sent to the collector.",
+        Callback("counter", lambda: stream_sink.sent_bytes),
+        labels,
+    )
+    REGISTRY.register(
+        "tcp_replay_stream_dropped_records_total",
+        "Log lines dropped because the stream buffer was full.",
+        Callback("counter", lambda: stream_sink.dropped_records),
+        labels,
+    )
+    REGISTRY.register(
+        "tcp_replay_stream_spilled_records_total",
+        "Log lines spilled to disk because the stream buffer was full.",
+        Callback("counter", lambda: stream_sink.spilled_records),
+        labels,
+    )
+    REGISTRY.register(
+        "tcp_replay_stream_connect_failures_total",
+        "Failed attempts to connect to the collector.",
+        Callback("counter", lambda: stream_sink.connect_failures),
+        labels,
+    )
+    REGISTRY.register(
+        "tcp_replay_stream_disconnects_total",
+        "Connections to the collector lost while sending.",
+        Callback("counter", lambda: stream_sink.disconnects),
+        labels,
+    )
+
+
+def register_listener(queue_length, queue_limit, overflows=None):
+    """Register the metrics for the listening socket of the proxy.
+
+    Args:
+        queue_length (Callable[[], int]): Gets the number of connections
+            waiting in the accept queue.
+        queue_limit (Callable[[], int]): Gets the maximum length of the accept
+            queue (i.e. the effective listen backlog).
+        overflows (Optional[Callable[[], int]]): Gets the number of times a
+            connection was dropped because an accept queue was full, if
+            available.
+    """
+    REGISTRY.register(
+        "tcp_replay_accept_queue_length",
+        "Connections waiting in the accept queue of the listening socket.",
+        Callback("gauge", queue_length),
+    )
+    REGISTRY.register(
+        "tcp_replay_accept_queue_limit",
+        "Maximum length of the accept queue of the listening socket.",
+        Callback("gauge", queue_limit),
+    )
+    if overflows is not None:
+        REGISTRY.register(
+            "tcp_replay_listen_overflows_total",
+            "Connections dropped because an accept queue was full (for every "
+            "listening socket on the host).",
+            Callback("counter", overflows),
+        )
+
+
+def register_upstream_pool(upstream_pool, labels=None):
+    """Register the metrics for a pool of connections to the server.
+
+    Args:
+        upstream_pool (_upstream_pool.UpstreamPool): The pool of idle
+            connections to the server.
+        labels (Optional[Dict[str, str]]): The label values (e.g. the server
+            the pool connects to).
+    """
+    REGISTRY.register(
+        "tcp_replay_upstream_pool_idle",
+        "Idle connections to the server, waiting for a client.",
+        Callback("gauge", upstream_pool.qsize),
+        labels,
+    )
+    REGISTRY.register(
+        "tcp_replay_upstream_pool_hits_total",
+        "Clients handed an idle connection from the pool.",
+        Callback("counter", lambda: upstream_pool.hits),
+        labels,
+    )
+    REGISTRY.register(
+        "tcp_replay_upstream_pool_misses_total",
+        "Clients that found the pool empty and connected directly.",
+        Callback("counter", lambda: upstream_pool.misses),
+        labels,
+    )
+    REGISTRY.register(
+        "tcp_replay_upstream_pool_expired_total",
+        "Idle connections closed because they were too old or had been "
+        "closed by the server.",
+        Callback("counter", lambda: upstream_pool.expired),
+        labels,
+    )
+
+
+def _register_upstream(upstream):
+    labels = {"upstream": upstream.addr}
+    REGISTRY.register(
+        "tcp_replay_upstream_connections_active",
+        "Connections currently relayed to the server.",
+        Callback("gauge", lambda: upstream.active),
+        labels,
+    )
+    REGISTRY.register(
+        "tcp_replay_upstream_healthy",
+        "Indicates if the server is in rotation (1) or not (0).",
+        Callback("gauge", lambda: int(upstream.healthy)),
+        labels,
+    )
+    REGISTRY.register(
+        "tcp_replay_upstream_health_check_failures_total",
+        "Failed health checks of the server.",
+        Callback("counter", lambda: upstream.health_check_failures),
+        labels,
+    )
+    if upstream.pool is not None:
+        register_upstream_pool(upstream.pool, labels)
+
+
+def register_upstreams(upstream_group):
+    """Register the metrics for the servers connections are balanced across.
+
+    Args:
+        upstream_group (_upstreams.UpstreamGroup): The servers.
+    """
+    for upstream in upstream_group.upstreams:
+        _register_upstream(upstream)
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = REGISTRY.render().encode("utf-8")
+            content_type = CONTENT_TYPE
+        elif self.path == "/snapshot":
+            body = json.dumps(REGISTRY.snapshot()).encode("utf-8")
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are frequent; don't log each one.
+        pass
+
+
+def start_http_server(port, host=METRICS_HOST):
+    """Serve the metrics over HTTP from a background thread.
+
+    ``GET /metrics`` returns the Prometheus text format and
+    ``GET /snapshot`` returns a JSON snapshot.
+
+    Args:
+        port (int): The port to serve on.
+        host (Optional[str]): The host to bind; defaults to the loopback
+            interface.
+
+    Returns:
+        http.server.ThreadingHTTPServer: The running server; call
+        ``shutdown()`` to stop it.
+    """
+    server = http.server.ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    _display.display(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+
+def start_snapshots(callback, interval=SNAPSHOT_INTERVAL):
+    """Periodically pass a snapshot of the metrics to a callback.
+
+    Args:
+        callback (Callable[[Dict[str, Any]], None]): Called (from a
+            background thread) with each snapshot from
+            :meth:`Registry.snapshot`.
+        interval (Optional[float]): The time (in seconds) between snapshots.
+
+    Returns:
+        threading.Event: An event that stops the snapshots when set.
+    """
+    stop_event = threading.Event()
+
+    def _run():
+        while not stop_event.wait(interval):
+            callback(REGISTRY.snapshot())
+
+    thread = threading.Thread(target=_run, daemon=True)
+    thread.start()
+    return stop_event
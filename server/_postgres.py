@@ -0,0 +1,310 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import struct
+
+
+LENGTH_STRUCT = struct.Struct(">I")
+# The startup packet (and the requests that may precede it) have no type
+# byte: ``[LENGTH][CODE]...``.
+STARTUP_HEADER_SIZE = 4
+# Every other frontend message is ``[TYPE][LENGTH]...``.
+MESSAGE_HEADER_SIZE = 5
+# See: https://github.com/postgres/postgres/blob/REL_13_1/src/include/libpq/pqcomm.h
+MAX_STARTUP_PACKET_LENGTH = 10000
+PROTOCOL_VERSION_3 = 0x30000
+CANCEL_REQUEST_CODE = 80877102
+SSL_REQUEST_CODE = 80877103
+GSSENC_REQUEST_CODE = 80877104
+# Requests that are followed by another packet without a type byte.
+PRE_STARTUP_CODES = (
+    CANCEL_REQUEST_CODE,
+    SSL_REQUEST_CODE,
+    GSSENC_REQUEST_CODE,
+)
+# `PasswordMessage`, `GSSResponse`, `SASLInitialResponse` and `SASLResponse`
+# all share this type byte.
+PASSWORD_TYPE = ord("p")
+# Messages that carry the text of a query: `Query` is ``[TYPE][LENGTH]`` then
+# the query and `Parse` is ``[TYPE][LENGTH]`` then the statement name and the
+# query (each NUL-terminated).
+QUERY_TYPE = ord("Q")
+PARSE_TYPE = ord("P")
+# Messages larger than this are not buffered until complete; they are
+# captured in pieces as they arrive.
+MAX_FRAMED_SIZE = 0x1000000
+# What to do with password / SASL messages:
+# - "keep": capture them unchanged
+# - "redact": capture the type byte and length, with the rest zeroed
+# - "skip": don't capture them at all
+PASSWORD_POLICIES = ("keep", "redact", "skip")
+
+
+def query_text(message):
+    """Extract the text of the query in a (complete) frontend message.
+
+    Args:
+        message (Union[bytes, memoryview]): A single frontend message, e.g.
+            a capture record written with ``capture_framing="postgres"``.
+
+    Returns:
+        Optional[bytes]: The query text (without its NUL terminator) of a
+        ``Query`` or ``Parse`` message; :data:`None` for any other message.
+    """
+    if len(message) < MESSAGE_HEADER_SIZE:
+        return None
+
+    body = bytes(message[MESSAGE_HEADER_SIZE:])
+    if message[0] == PARSE_TYPE:
+        # Skip the (NUL-terminated) statement name.
+        name_end = body.find(b"\0")
+        if name_end == -1:
+            return None
+        body = body[name_end + 1 :]
+    elif message[0] != QUERY_TYPE:
+        return None
+
+    query_end = body.find(b"\0")
+    if query_end == -1:
+        return None
+    return body[:query_end]
+
+
+class MessageFramer:
+    """Splits a client->server PostgreSQL stream into messages.
+
+    Captured TCP chunks don't line up with PostgreSQL messages: one chunk may
+    hold part of a message or several messages. The framer is fed each chunk
+    and returns the messages it completes, so that every capture record holds
+    exactly one message.
+
+    Messages are delimited using only their length prefix (and, for the
+    startup packet and the requests that precede it, the code following the
+    length), so payloads are never decoded. A message that is contained in a
+    single chunk is returned as a view of that chunk (without copying it);
+    only a message that spans chunks is assembled in a buffer.
+
+    If the stream stops looking like the PostgreSQL protocol (e.g. after an
+    ``SSLRequest`` is accepted and the client starts a TLS handshake), the
+    framer gives up and each chunk is returned as is.
+
+    Args:
+        passwords (Optional[str]): What to do with password / SASL messages;
+            one of :data:`PASSWORD_POLICIES`.
+
+    Raises:
+        ValueError: If ``passwords`` is not one of :data:`PASSWORD_POLICIES`.
+    """
+
+    def __init__(self, passwords="redact"):
+        if passwords not in PASSWORD_POLICIES:
+            raise ValueError(
+                f"Unsupported password policy {passwords!r}",
+                PASSWORD_POLICIES,
+            )
+
+        self.passwords = passwords
+        # Indicates the startup packet hasn't been seen yet.
+        self.startup = True
+        # Indicates the stream couldn't be framed; chunks are returned as is.
+        self.raw = False
+        # A message that spans chunks (and its full size, once known).
+        self._pending = bytearray()
+        self._pending_size = None
+        # Bytes of the current message to return as they arrive (an
+        # oversized message), to return zeroed as they arrive (an oversized
+        # redacted message) or to drop (a skipped / redacted message).
+        self._passthrough = 0
+        self._zero_fill = 0
+        self._discard = 0
+
+    def _header_size(self):
+        if self.startup:
+            return STARTUP_HEADER_SIZE
+        return MESSAGE_HEADER_SIZE
+
+    def _message_size(self, header):
+        """Determine the size of a message from its header.
+
+        Args:
+            header (memoryview): The header of the message.
+
+        Returns:
+            Optional[int]: The size of the message (including the header), or
+            :data:`None` if the header is invalid.
+        """
+        if self.startup:
+            (length,) = LENGTH_STRUCT.unpack_from(header)
+            if not 8 <= length <= MAX_STARTUP_PACKET_LENGTH:
+                return None
+            return length
+
+        (length,) = LENGTH_STRUCT.unpack_from(header, 1)
+        if length < 4:
+            return None
+        return 1 + length
+
+    def _complete(self, message, messages):
+        """Handle a complete message.
+
+        Args:
+            message (Union[bytes, memoryview]): The complete message.
+            messages (List[Union[bytes, memoryview]]): The messages to be
+                captured, to append to.
+        """
+        if self.startup:
+            (code,) = LENGTH_STRUCT.unpack_from(message, 4)
+            if code >> 16 == PROTOCOL_VERSION_3 >> 16:
+                self.startup = False
+            elif code not in PRE_STARTUP_CODES:
+                self.raw = True
+        messages.append(message)
+
+    def _start(self, header, size, messages):
+        """Handle a message whose header has been read.
+
+        Args:
+            header (memoryview): The header of the message.
+            size (int): The size of the message.
+            messages (List[Union[bytes, memoryview]]): The messages to be
+                captured, to append to.
+
+        Returns:
+            bool: Indicates if the message was handled, i.e. its remaining
+            bytes will be returned or dropped as they arrive rather than
+            assembled into a message.
+        """
+        body_size = size - len(header)
+        password = self.passwords != "keep" and (
+            not self.startup and header[0] == PASSWORD_TYPE
+        )
+        if size > MAX_FRAMED_SIZE:
+            # NOTE: ``size`` comes straight from the client, so the body of
+            #       an oversized message is never allocated up front; it is
+            #       captured (or zeroed, or dropped) piece by piece.
+            if password and self.passwords == "skip":
+                self._discard = body_size
+                return True
+            messages.append(bytes(header))
+            if password:
+                self._zero_fill = body_size
+            else:
+                self._passthrough = body_size
+            return True
+
+        if password:
+            if self.passwords == "redact":
+                messages.append(bytes(header) + bytes(body_size))
+            self._discard = body_size
+            return True
+
+        return False
+
+    def _give_up(self, view, messages):
+        self.raw = True
+        if self._pending:
+            messages.append(bytes(self._pending))
+            self._pending.clear()
+        if view:
+            messages.append(view)
+
+    def feed(self, tcp_chunk):
+        """Feed a captured TCP chunk to the framer.
+
+        Args:
+            tcp_chunk (bytes): The next chunk of the client->server stream.
+                Since views of the chunk may be returned, the chunk must not
+                be modified afterwards.
+
+        Returns:
+            List[Union[bytes, memoryview]]: The messages (possibly none)
+            completed by this chunk, or the chunk itself if the stream can't
+            be framed.
+        """
+        if self.raw:
+            return [tcp_chunk]
+
+        messages = []
+        view = memoryview(tcp_chunk)
+        while view:
+            if self._discard:
+                taken = min(self._discard, len(view))
+                self._discard -= taken
+                view = view[taken:]
+                continue
+
+            if self._passthrough:
+                taken = min(self._passthrough, len(view))
+                self._passthrough -= taken
+                messages.append(view[:taken])
+                view = view[taken:]
+                continue
+
+            if self._zero_fill:
+                taken = min(self._zero_fill, len(view))
+                self._zero_fill -= taken
+                messages.append(bytes(taken))
+                view = view[taken:]
+                continue
+
+            header_size = self._header_size()
+            if not self._pending and len(view) >= header_size:
+                # Fast path: the header is contained in this chunk.
+                size = self._message_size(view[:header_size])
+                if size is None:
+                    self._give_up(view, messages)
+                    break
+                if self._start(view[:header_size], size, messages):
+                    view = view[header_size:]
+                    continue
+                if len(view) >= size:
+                    self._complete(view[:size], messages)
+                    view = view[size:]
+                    if self.raw:
+                        self._give_up(view, messages)
+                        break
+                    continue
+                self._pending += view
+                self._pending_size = size
+                break
+
+            # Slow path: assemble the message across chunks.
+            if self._pending_size is None:
+                taken = min(header_size - len(self._pending), len(view))
+                self._pending += view[:taken]
+                view = view[taken:]
+                if len(self._pending) < header_size:
+                    break
+                header = memoryview(bytes(self._pending))
+                size = self._message_size(header)
+                if size is None:
+                    self._give_up(view, messages)
+                    break
+                if self._start(header, size, messages):
+                    self._pending.clear()
+                    continue
+                self._pending_size = size
+
+            taken = min(self._pending_size - len(self._pending), len(view))
+            self._pending += view[:taken]
+            view = view[taken:]
+            if len(self._pending) < self._pending_size:
+                break
+            message = bytes(self._pending)
+            self._pending.clear()
+            self._pending_size = None
+            self._complete(message, messages)
+            if self.raw:
+                self._give_up(view, messages)
+                break
+
+        return messages
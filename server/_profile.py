@@ -0,0 +1,575 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import concurrent.futures
+import multiprocessing
+
+import _display
+import _histogram
+import _postgres
+import _read_replay_log
+import _replay_format
+
+
+# A connection with no records for this many nanoseconds is considered
+# closed (the replay log doesn't record when connections close).
+CONNECTION_IDLE_NS = 60_000_000_000
+# Number of bytes of each client->server chunk (or query text) that are
+# counted as its prefix.
+PREFIX_BYTES = 64
+# Number of prefixes counted at once; the counts of the ``TOP_N`` most
+# frequent prefixes are accurate (to within ``1 / PREFIX_COUNTERS`` of the
+# number of chunks) as long as this is much larger than ``TOP_N``.
+PREFIX_COUNTERS = 1024
+TOP_N = 20
+NANOS_PER_SECOND = 1_000_000_000
+DIRECTION_NAMES = {
+    _replay_format.CLIENT_TO_SERVER: "client_to_server",
+    _replay_format.SERVER_TO_CLIENT: "server_to_client",
+}
+
+
+def _format_summary(values):
+    parts = []
+    for key, value in values.items():
+        if isinstance(value, float):
+            parts.append(f"{key}={value:.3f}")
+        else:
+            parts.append(f"{key}={value}")
+    return ", ".join(parts)
+
+
+class _Connection:
+    """Running totals for a single connection."""
+
+    __slots__ = (
+        "first_ns",
+        "last_ns",
+        "first_client_ns",
+        "last_client_ns",
+        "chunks",
+        "num_bytes",
+        "from_start",
+    )
+
+    def __init__(self, time_ns, from_start):
+        self.first_ns = time_ns
+        self.last_ns = time_ns
+        self.first_client_ns = None
+        self.last_client_ns = None
+        self.chunks = 0
+        self.num_bytes = 0
+        # Indicates if the connection may have started before the byte range
+        # being profiled (i.e. it is continued from the previous range).
+        self.from_start = from_start
+
+    def extend(self, other):
+        """Add the totals from the next byte range of the same connection."""
+        self.first_ns = min(self.first_ns, other.first_ns)
+        self.last_ns = max(self.last_ns, other.last_ns)
+        if self.first_client_ns is None:
+            self.first_client_ns = other.first_client_ns
+        if other.last_client_ns is not None:
+            self.last_client_ns = other.last_client_ns
+        self.chunks += other.chunks
+        self.num_bytes += other.num_bytes
+
+
+class FrequentItems:
+    """Approximate counts of the most frequent items in a stream.
+
+    This is the Misra-Gries summary: at most ``capacity`` items are counted
+    at once, so memory is bounded no matter how many distinct items there
+    are. When a new item doesn't fit, every count is decremented (and items
+    whose count reaches zero are dropped). Each count is a lower bound,
+    short by at most ``n / (capacity + 1)`` for a stream of ``n`` items, and
+    two summaries can be merged.
+
+    Args:
+        capacity (Optional[int]): The number of items counted at once.
+    """
+
+    def __init__(self, capacity=PREFIX_COUNTERS):
+        self.capacity = capacity
+        self.counts = {}
+
+    def add(self, item):
+        """Count an item.
+
+        Args:
+            item (Hashable): The item.
+        """
+        counts = self.counts
+        if item in counts:
+            counts[item] += 1
+        elif len(counts) < self.capacity:
+            counts[item] = 1
+        else:
+            self.counts = {
+                key: count - 1 for key, count in counts.items() if count > 1
+            }
+
+    def merge(self, other):
+        """Add the items counted by another summary to this one.
+
+        Args:
+            other (FrequentItems): The summary to merge.
+        """
+        counts = self.counts
+        for item, count in other.counts.items():
+            counts[item] = counts.get(item, 0) + count
+        if len(counts) > self.capacity:
+            ordered = sorted(counts.values(), reverse=True)
+            threshold = ordered[self.capacity]
+            self.counts = {
+                key: count - threshold
+                for key, count in counts.items()
+                if count > threshold
+            }
+
+    def top(self, n):
+        """Get the most frequent items.
+
+        Args:
+            n (int): The number of items.
+
+        Returns:
+            List[Tuple[Hashable, int]]: Up to ``n`` items and their
+            (approximate) counts, most frequent first.
+        """
+        return sorted(
+            self.counts.items(), key=lambda pair: pair[1], reverse=True
+        )[:n]
+
+
+class Profile:
+    """Workload statistics for (a byte range of) a replay log.
+
+    The statistics are collected in a single pass over the records, with
+    memory bounded by the number of connections active within
+    ``CONNECTION_IDLE_NS`` of each other (plus one counter per second
+    of the capture): chunk sizes and inter-arrival times are kept in
+    fixed-size histograms and payload prefixes in a :class:`FrequentItems`
+    summary.
+
+    Since the replay log doesn't record when a connection closes, a
+    connection is considered closed once it has been idle for
+    ``CONNECTION_IDLE_NS``. A connection in a version 2 replay log is
+    identified by its client address and connection id. (A version 1 replay
+    log doesn't record connection ids, so a connection is identified by its
+    client and server addresses and a client port reused sooner than that
+    is counted as the same connection.)
+
+    Profiles of consecutive byte ranges can be merged (in order) with
+    ``merge()``; connections that span the boundary between two ranges are
+    held back (in ``head`` and ``tail``) until then, so they are counted
+    once. ``close()`` must be called once every record (or range) has been
+    added.
+
+    Args:
+        prefix_bytes (Optional[int]): The number of bytes of each
+            client->server chunk counted as its prefix.
+        postgres (Optional[bool]): Indicates if the query text of PostgreSQL
+            ``Query`` / ``Parse`` messages should be counted instead of raw
+            prefixes (for a replay log captured with
+            ``capture_framing="postgres"``).
+    """
+
+    def __init__(self, prefix_bytes=PREFIX_BYTES, postgres=False):
+        self.prefix_bytes = prefix_bytes
+        self.postgres = postgres
+        self.records = 0
+        self.num_bytes = {direction: 0 for direction in DIRECTION_NAMES}
+        self.chunk_sizes = {
+            direction: _histogram.Histogram() for direction in DIRECTION_NAMES
+        }
+        self.first_ns = None
+        self.last_ns = None
+        # The timestamps of the first / last record in file order.
+        self.start_ns = None
+        self.end_ns = None
+        self.record_gaps = _histogram.Histogram()
+        self.think_times = _histogram.Histogram()
+        self.connections = 0
+        self.connection_starts = collections.Counter()
+        self.connection_durations = _histogram.Histogram()
+        self.connection_bytes = _histogram.Histogram()
+        self.connection_chunks = _histogram.Histogram()
+        self.prefixes = FrequentItems()
+        # Connections that went idle but may have started in the previous
+        # byte range, and connections still active at the end of the range.
+        self.head = {}
+        self.tail = {}
+        # Active connections; the least recently active is first.
+        self._active = collections.OrderedDict()
+
+    def _finalize(self, connection):
+        self.connections += 1
+        self.connection_starts[connection.first_ns // NANOS_PER_SECOND] += 1
+        self.connection_durations.record(
+            connection.last_ns - connection.first_ns
+        )
+        self.connection_bytes.record(connection.num_bytes)
+        self.connection_chunks.record(connection.chunks)
+
+    def _expire(self, now_ns):
+        active = self._active
+        deadline = now_ns - CONNECTION_IDLE_NS
+        while active:
+            key, connection = next(iter(active.items()))
+            if connection.last_ns >= deadline:
+                break
+            del active[key]
+            if connection.from_start and key not in self.head:
+                self.head[key] = connection
+            else:
+                self._finalize(connection)
+
+    def _prefix(self, tcp_chunk):
+        if self.postgres:
+            query = _postgres.query_text(tcp_chunk)
+            if query is None:
+                return None
+            return query[: self.prefix_bytes]
+        return bytes(tcp_chunk[: self.prefix_bytes])
+
+    def observe(self, time_ns, key, tcp_chunk, direction):
+        """Add a record to the profile.
+
+        Args:
+            time_ns (int): The timestamp of the record.
+            key (Hashable): Identifies the connection, e.g. the client and
+                server addresses.
+            tcp_chunk (Union[bytes, memoryview]): The captured TCP chunk.
+            direction (int): The direction of the chunk.
+        """
+        chunk_size = len(tcp_chunk)
+        self.records += 1
+        self.num_bytes[direction] += chunk_size
+        self.chunk_sizes[direction].record(chunk_size)
+        if self.start_ns is None:
+            self.start_ns = time_ns
+            self.first_ns = time_ns
+            self.last_ns = time_ns
+        else:
+            self.record_gaps.record(time_ns - self.end_ns)
+            self.first_ns = min(self.first_ns, time_ns)
+            if time_ns > self.last_ns:
+                self.last_ns = time_ns
+                self._expire(time_ns)
+        self.end_ns = time_ns
+
+        connection = self._active.get(key)
+        if connection is None:
+            from_start = time_ns < self.start_ns + CONNECTION_IDLE_NS
+            connection = _Connection(time_ns, from_start)
+            self._active[key] = connection
+        else:
+            self._active.move_to_end(key)
+        connection.last_ns = max(connection.last_ns, time_ns)
+        connection.chunks += 1
+        connection.num_bytes += chunk_size
+
+        if direction != _replay_format.CLIENT_TO_SERVER:
+            return
+        if connection.last_client_ns is not None:
+            self.think_times.record(time_ns - connection.last_client_ns)
+        else:
+            connection.first_client_ns = time_ns
+        connection.last_client_ns = time_ns
+        prefix = self._prefix(tcp_chunk)
+        if prefix is not None:
+            self.prefixes.add(prefix)
+
+    def finish(self):
+        """Hold back the connections still active at the end of the range."""
+        self.tail.update(self._active)
+        self._active.clear()
+
+    def _join(self, previous, connection):
+        """Join the parts of a connection from two consecutive ranges."""
+        if (
+            previous.last_client_ns is not None
+            and connection.first_client_ns is not None
+        ):
+            self.think_times.record(
+                connection.first_client_ns - previous.last_client_ns
+            )
+        previous.extend(connection)
+        return previous
+
+    def merge(self, other):
+        """Add the profile of the next byte range to this one.
+
+        Both profiles must have been finished (see ``finish()``).
+
+        Args:
+            other (Profile): The profile of the byte range that immediately
+                follows this one.
+        """
+        self.records += other.records
+        for direction in DIRECTION_NAMES:
+            self.num_bytes[direction] += other.num_bytes[direction]
+            self.chunk_sizes[direction].merge(other.chunk_sizes[direction])
+        if other.start_ns is not None:
+            if self.start_ns is None:
+                self.start_ns = other.start_ns
+                self.first_ns = other.first_ns
+                self.last_ns = other.last_ns
+            else:
+                self.record_gaps.record(other.start_ns - self.end_ns)
+                self.first_ns = min(self.first_ns, other.first_ns)
+                self.last_ns = max(self.last_ns, other.last_ns)
+            self.end_ns = other.end_ns
+        self.record_gaps.merge(other.record_gaps)
+        self.think_times.merge(other.think_times)
+        self.connections += other.connections
+        self.connection_starts.update(other.connection_starts)
+        self.connection_durations.merge(other.connection_durations)
+        self.connection_bytes.merge(other.connection_bytes)
+        self.connection_chunks.merge(other.connection_chunks)
+        self.prefixes.merge(other.prefixes)
+
+        # NOTE: A connection held back at the end of this range continues
+        #       in the next range only if it shows up at the start of it.
+        carry = self.tail
+        for key, connection in other.head.items():
+            previous = carry.pop(key, None)
+            if previous is not None:
+                connection = self._join(previous, connection)
+            self._finalize(connection)
+        tail = {}
+        for key, connection in other.tail.items():
+            previous = carry.pop(key, None) if connection.from_start else None
+            if previous is not None:
+                connection = self._join(previous, connection)
+            tail[key] = connection
+        for connection in carry.values():
+            self._finalize(connection)
+        self.tail = tail
+
+    def close(self):
+        """Count the connections that were held back."""
+        self.finish()
+        for connection in self.head.values():
+            self._finalize(connection)
+        for connection in self.tail.values():
+            self._finalize(connection)
+        self.head = {}
+        self.tail = {}
+
+    def _connections_per_second(self):
+        per_second = _histogram.Histogram()
+        if self.first_ns is None:
+            return per_second
+
+        first = self.first_ns // NANOS_PER_SECOND
+        last = self.last_ns // NANOS_PER_SECOND
+        for second in range(first, last + 1):
+            per_second.record(self.connection_starts.get(second, 0))
+        return per_second
+
+    def summary(self, top=TOP_N):
+        """Summarize the profile as a JSON-serializable dictionary.
+
+        Args:
+            top (Optional[int]): The number of most frequent prefixes.
+
+        Returns:
+            Dict[str, Any]: The record and connection counts, the duration
+            of the capture, distributions of connections per second,
+            connection durations (in milliseconds), bytes and chunks per
+            connection, chunk sizes (per direction), record inter-arrival
+            and client think times (in milliseconds), and the most frequent
+            prefixes.
+        """
+        duration = 0.0
+        if self.first_ns is not None:
+            duration = (self.last_ns - self.first_ns) / NANOS_PER_SECOND
+        return {
+            "records": self.records,
+            "bytes": {
+                name: self.num_bytes[direction]
+                for direction, name in DIRECTION_NAMES.items()
+            },
+            "duration_seconds": duration,
+            "connections": self.connections,
+            "connections_per_second": (
+                self._connections_per_second().summary()
+            ),
+            "connection_duration_ms": self.connection_durations.summary(1e6),
+            "connection_bytes": self.connection_bytes.summary(),
+            "connection_chunks": self.connection_chunks.summary(),
+            "chunk_bytes": {
+                name: self.chunk_sizes[direction].summary()
+                for direction, name in DIRECTION_NAMES.items()
+            },
+            "record_interarrival_ms": self.record_gaps.summary(1e6),
+            "client_think_time_ms": self.think_times.summary(1e6),
+            "top_prefixes": [
+                {
+                    # NOTE: Escape non-printable bytes as in ``repr()``.
+                    "prefix": repr(prefix)[2:-1],
+                    "count": count,
+                }
+                for prefix, count in self.prefixes.top(top)
+            ],
+        }
+
+    def display(self, top=TOP_N):
+        """Display a summary of the profile.
+
+        Args:
+            top (Optional[int]): The number of most frequent prefixes.
+        """
+        summary = self.summary(top=top)
+        _display.display(
+            f"{summary['records']} records over {summary['connections']} "
+            f"connections in {summary['duration_seconds']:.3f}s; "
+            + ", ".join(
+                f"{name}={num_bytes} bytes"
+                for name, num_bytes in summary["bytes"].items()
+            )
+        )
+        distributions = (
+            ("Connections per second", summary["connections_per_second"]),
+            ("Connection duration (ms)", summary["connection_duration_ms"]),
+            ("Bytes per connection", summary["connection_bytes"]),
+            ("Chunks per connection", summary["connection_chunks"]),
+            (
+                "Chunk size, client to server",
+                summary["chunk_bytes"]["client_to_server"],
+            ),
+            (
+                "Chunk size, server to client",
+                summary["chunk_bytes"]["server_to_client"],
+            ),
+            ("Record inter-arrival (ms)", summary["record_interarrival_ms"]),
+            ("Client think time (ms)", summary["client_think_time_ms"]),
+        )
+        for name, values in distributions:
+            _display.display(f"{name}: {_format_summary(values)}")
+        for entry in summary["top_prefixes"]:
+            _display.display(f"{entry['count']:>10d}  {entry['prefix']}")
+
+
+def profile_range(filename, start, end, prefix_bytes, postgres):
+    """Profile a byte range of a replay log.
+
+    Args:
+        filename (pathlib.Path): The replay log.
+        start (int): The offset of the first record in the range.
+        end (int): The offset where the range stops; a record boundary.
+        prefix_bytes (int): The number of bytes of each client->server
+            chunk counted as its prefix.
+        postgres (bool): Indicates if PostgreSQL query texts should be
+            counted instead of raw prefixes.
+
+    Returns:
+        Profile: The (finished, but not closed) profile of the range.
+    """
+    profile = Profile(prefix_bytes=prefix_bytes, postgres=postgres)
+    with _read_replay_log.ReplayLog(filename) as replay_log:
+        v2 = replay_log.version == _replay_format.VERSION_2
+        for record in replay_log.records(start=start, end=end):
+            if v2:
+                key = record.client_addr, record.connection_id
+            else:
+                key = record.client_addr, record.server_addr
+            profile.observe(
+                record.time_ns, key, record.tcp_chunk, record.direction
+            )
+    profile.finish()
+    return profile
+
+
+def split_replay_log(filename, parts):
+    """Split a replay log into byte ranges at record boundaries.
+
+    Args:
+        filename (pathlib.Path): The replay log.
+        parts (int): The (maximum) number of ranges.
+
+    Returns:
+        List[Tuple[int, int]]: Non-empty ``(start, end)`` byte ranges which
+        cover every record in the replay log and are roughly equal in size.
+        A deduplicated replay log (see :data:`_replay_format.FLAG_DEDUP`)
+        can't be split, so it is a single range.
+    """
+    with _read_replay_log.ReplayLog(filename) as replay_log:
+        size = len(replay_log)
+        boundaries = [min(replay_log.header_size, size)]
+        if not replay_log.flags & _replay_format.FLAG_DEDUP:
+            for part in range(1, parts):
+                offset = replay_log.find_record(size * part // parts)
+                if offset > boundaries[-1]:
+                    boundaries.append(offset)
+        boundaries.append(size)
+
+    return [
+        (start, end)
+        for start, end in zip(boundaries, boundaries[1:])
+        if end > start
+    ]
+
+
+def profile_replay_log(
+    filename, processes=1, prefix_bytes=PREFIX_BYTES, postgres=False
+):
+    """Profile the workload captured in a replay log.
+
+    The replay log is split into (roughly) equal byte ranges, one per
+    process; each range is profiled in a single streaming pass by a process
+    in a pool and the partial profiles are merged in order.
+
+    Args:
+        filename (pathlib.Path): The replay log.
+        processes (Optional[int]): The number of processes.
+        prefix_bytes (Optional[int]): The number of bytes of each
+            client->server chunk (or query text) counted as its prefix.
+        postgres (Optional[bool]): Indicates if PostgreSQL query texts
+            should be counted instead of raw prefixes.
+
+    Returns:
+        Profile: The (closed) profile.
+
+    Raises:
+        ValueError: If ``processes`` is not positive.
+    """
+    if processes < 1:
+        raise ValueError("At least one process is required", processes)
+
+    ranges = split_replay_log(filename, processes)
+    if len(ranges) <= 1:
+        partials = [
+            profile_range(filename, start, end, prefix_bytes, postgres)
+            for start, end in ranges
+        ]
+    else:
+        context = multiprocessing.get_context("fork")
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=len(ranges), mp_context=context
+        ) as executor:
+            futures = [
+                executor.submit(
+                    profile_range, filename, start, end, prefix_bytes, postgres
+                )
+                for start, end in ranges
+            ]
+            partials = [future.result() for future in futures]
+
+    profile = Profile(prefix_bytes=prefix_bytes, postgres=postgres)
+    for partial in partials:
+        profile.merge(partial)
+    profile.close()
+    return profile
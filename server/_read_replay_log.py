@@ -0,0 +1,1127 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import array
+import mmap
+import struct
+import time
+
+import _replay_format
+
+
+TIMESTAMP_STRUCT = struct.Struct(">Q")
+LENGTH_STRUCT = struct.Struct(">I")
+# An address is an IPv4 / IPv6 address and a port; this is a generous
+# upper bound used to detect a corrupt (or misaligned) replay log.
+MAX_ADDRESS_LENGTH = 64
+# Number of consecutive records that must decode (with plausible timestamps
+# and addresses) for an offset to be taken as a record boundary.
+RESYNC_RECORDS = 16
+# Timestamps more than this many nanoseconds before the first record (or
+# after the current time) are implausible.
+RESYNC_SLACK_NS = 3_600_000_000_000
+
+
+def _read_exact(file_obj, size):
+    """Read exactly ``size`` bytes from a file.
+
+    Args:
+        file_obj (io.BufferedReader): The file being read.
+        size (int): The number of bytes to read.
+
+    Returns:
+        bytes: The bytes read.
+
+    Raises:
+        EOFError: If the file ends before ``size`` bytes could be read.
+    """
+    value = file_obj.read(size)
+    if len(value) != size:
+        raise EOFError("Replay log ended in the middle of a record")
+    return value
+
+
+def _read_address(file_obj):
+    """Read a space-terminated address from a file.
+
+    Args:
+        file_obj (io.BufferedReader): The file being read.
+
+    Returns:
+        str: The address, without the terminating space.
+
+    Raises:
+        EOFError: If the file ends before the space terminator.
+        ValueError: If the address exceeds ``MAX_ADDRESS_LENGTH``.
+    """
+    parts = []
+    total = 0
+    while True:
+        buffered = file_obj.peek(MAX_ADDRESS_LENGTH + 1)
+        if not buffered:
+            raise EOFError("Replay log ended in the middle of a record")
+
+        index = buffered.find(b" ", 0, MAX_ADDRESS_LENGTH + 1 - total)
+        if index != -1:
+            parts.append(file_obj.read(index))
+            file_obj.read(1)
+            return b"".join(parts).decode("ascii")
+
+        chunk = file_obj.read(len(buffered))
+        parts.append(chunk)
+        total += len(chunk)
+        if total > MAX_ADDRESS_LENGTH:
+            raise ValueError("Address in replay log is too long")
+
+
+def _read_chunk(file_obj, dictionary):
+    """Read a TCP chunk stored with a ``KIND`` byte.
+
+    Args:
+        file_obj (io.BufferedReader): The file being read, positioned at the
+            ``KIND`` byte.
+        dictionary (Dict[int, bytes]): The chunks in each dictionary slot;
+            updated if the chunk is stored in a slot.
+
+    Returns:
+        bytes: The TCP chunk.
+
+    Raises:
+        EOFError: If the file ends in the middle of the chunk.
+        ValueError: If the kind is not known.
+        ValueError: If the chunk refers to an empty dictionary slot.
+    """
+    (kind,) = _read_exact(file_obj, _replay_format.KIND_STRUCT.size)
+    if kind == _replay_format.CHUNK_LITERAL:
+        slot = None
+    elif kind in (_replay_format.CHUNK_DEFINE, _replay_format.CHUNK_REFERENCE):
+        (slot,) = _replay_format.SLOT_STRUCT.unpack(
+            _read_exact(file_obj, _replay_format.SLOT_STRUCT.size)
+        )
+    else:
+        raise ValueError("Unsupported chunk kind in replay log", kind)
+
+    if kind == _replay_format.CHUNK_REFERENCE:
+        tcp_chunk = dictionary.get(slot)
+        if tcp_chunk is None:
+            raise ValueError("Replay log refers to an empty slot", slot)
+        return tcp_chunk
+
+    (chunk_length,) = LENGTH_STRUCT.unpack(
+        _read_exact(file_obj, LENGTH_STRUCT.size)
+    )
+    tcp_chunk = _read_exact(file_obj, chunk_length)
+    if slot is not None:
+        dictionary[slot] = tcp_chunk
+    return tcp_chunk
+
+
+def read_record(file_obj, flags=0, dictionary=None):
+    """Read the next "row" from a replay log.
+
+    Args:
+        file_obj (io.BufferedReader): The replay log, opened in binary mode
+            and positioned after the header (if any).
+        flags (Optional[int]): The format flags from the header of the
+            replay log (see :func:`_replay_format.read_header`).
+        dictionary (Optional[Dict[int, bytes]]): The chunks in each
+            dictionary slot, if :data:`_replay_format.FLAG_DEDUP` is set.
+            This starts empty and is updated as records are read, so the
+            same ``dict`` must be passed for every record (in order) from the
+            start of the replay log.
+
+    Returns:
+        Optional[Tuple[int, str, str, bytes, int]]: Either :data:`None` at
+        the end of the file or a tuple of:
+        * The timestamp (in nanoseconds since the epoch)
+        * The client address
+        * The server address
+        * The captured TCP chunk
+        * The direction of the chunk (always
+          :data:`_replay_format.CLIENT_TO_SERVER` unless
+          :data:`_replay_format.FLAG_DIRECTION` is set)
+
+    Raises:
+        EOFError: If the file ends in the middle of a record.
+        ValueError: If :data:`_replay_format.FLAG_DEDUP` is set but
+            ``dictionary`` is not.
+        ValueError: If the TCP chunk of a deduplicated record is corrupt.
+    """
+    dedup = flags & _replay_format.FLAG_DEDUP
+    if dedup and dictionary is None:
+        raise ValueError("Deduplicated replay logs require a dictionary")
+
+    ts_bytes = file_obj.read(TIMESTAMP_STRUCT.size)
+    if ts_bytes == b"":
+        return None
+    if len(ts_bytes) != TIMESTAMP_STRUCT.size:
+        raise EOFError("Replay log ended in the middle of a record")
+
+    (time_ns,) = TIMESTAMP_STRUCT.unpack(ts_bytes)
+    direction = _replay_format.CLIENT_TO_SERVER
+    if flags & _replay_format.FLAG_DIRECTION:
+        (direction,) = _read_exact(
+            file_obj, _replay_format.DIRECTION_STRUCT.size
+        )
+    client_addr = _read_address(file_obj)
+    server_addr = _read_address(file_obj)
+    if dedup:
+        tcp_chunk = _read_chunk(file_obj, dictionary)
+        return time_ns, client_addr, server_addr, tcp_chunk, direction
+
+    (chunk_length,) = LENGTH_STRUCT.unpack(
+        _read_exact(file_obj, LENGTH_STRUCT.size)
+    )
+    tcp_chunk = _read_exact(file_obj, chunk_length)
+    return time_ns, client_addr, server_addr, tcp_chunk, direction
+
+
+def read_record_v2(file_obj, connections):
+    """Read the next "row" from a version 2 replay log.
+
+    Entries in the connection table (see
+    :data:`_replay_format.CONNECTION_ENTRY`) before the row are read along
+    the way.
+
+    Args:
+        file_obj (io.BufferedReader): The replay log, opened in binary mode
+            and positioned after the header.
+        connections (Dict[int, Tuple[str, str]]): The client and server
+            address of each connection in the connection table. This starts
+            empty and is updated as records are read, so the same ``dict``
+            must be passed for every record (in order) from the start of the
+            replay log.
+
+    Returns:
+        Optional[Tuple[int, str, str, bytes, int]]: Either :data:`None` at
+        the end of the file or a tuple of the timestamp, the client address,
+        the server address, the captured TCP chunk and its direction (as
+        for :func:`read_record`).
+
+    Raises:
+        EOFError: If the file ends in the middle of a record.
+        ValueError: If an entry in the connection table is corrupt.
+        ValueError: If the row refers to a connection that is not in the
+            connection table.
+    """
+    row = _read_row_v2(file_obj, connections)
+    if row is None:
+        return None
+    return row[0]
+
+
+def _read_row_v2(file_obj, connections):
+    record_struct = _replay_format.RECORD_V2_STRUCT
+    while True:
+        header = file_obj.read(record_struct.size)
+        if header == b"":
+            return None
+        if len(header) != record_struct.size:
+            raise EOFError("Replay log ended in the middle of a record")
+
+        time_ns, connection_id, direction, length = record_struct.unpack(
+            header
+        )
+        payload = _read_exact(file_obj, length)
+        if direction != _replay_format.CONNECTION_ENTRY:
+            break
+        connections[connection_id] = _replay_format.decode_addresses(
+            payload, 0, length
+        )
+
+    addresses = connections.get(connection_id)
+    if addresses is None:
+        raise ValueError(
+            "Replay log refers to an unknown connection", connection_id
+        )
+    client_addr, server_addr = addresses
+    record = time_ns, client_addr, server_addr, payload, direction
+    return record, connection_id
+
+
+def read_records(file_obj, version, flags, with_ids=False):
+    """Iterate over every "row" after the header of a replay log.
+
+    Args:
+        file_obj (io.BufferedReader): The replay log, opened in binary mode
+            and positioned after the header (if any).
+        version (int): The format version from the header of the replay log
+            (see :func:`_replay_format.read_header`).
+        flags (int): The format flags from the header of the replay log.
+        with_ids (Optional[bool]): Indicates if each row should be paired
+            with the id of its connection in a version 2 replay log (or
+            :data:`None` in a version 1 replay log, which doesn't record
+            connection ids).
+
+    Yields:
+        Union[Tuple[int, str, str, bytes, int], Tuple[tuple, Optional[int]]]:
+        The timestamp, client address, server address, TCP chunk and
+        direction for each record (paired with its connection id if
+        ``with_ids`` is set). A chunk stored as a reference (see
+        :data:`_replay_format.FLAG_DEDUP`) is expanded to the chunk it
+        refers to.
+    """
+    state = {}
+    if version == _replay_format.VERSION_2:
+        row = _read_row_v2(file_obj, state)
+        while row is not None:
+            yield row if with_ids else row[0]
+            row = _read_row_v2(file_obj, state)
+        return
+
+    record = read_record(file_obj, flags, state)
+    while record is not None:
+        yield (record, None) if with_ids else record
+        record = read_record(file_obj, flags, state)
+
+
+def iter_records(file_obj):
+    """Iterate over every "row" in a replay log.
+
+    Args:
+        file_obj (io.BufferedReader): The replay log, opened in binary mode
+            and positioned at the start of the file.
+
+    Yields:
+        Tuple[int, str, str, bytes, int]: The timestamp, client address,
+        server address, TCP chunk and direction for each record (see
+        :func:`read_records`).
+    """
+    version, flags = _replay_format.read_header(file_obj)
+    yield from read_records(file_obj, version, flags)
+
+
+class Record:
+    """A replay log record backed by a memory-mapped replay log.
+
+    The TCP chunk is a zero-copy ``memoryview`` into the mapped file, and
+    the addresses are only decoded when they are accessed. For a chunk
+    stored as a reference (see :data:`_replay_format.FLAG_DEDUP`), this is a
+    view of the earlier record where the chunk is stored.
+
+    Args:
+        data (memoryview): The entire mapped replay log.
+        offset (int): The offset of the record.
+        time_ns (int): The timestamp of the record.
+        direction (int): The direction of the TCP chunk.
+        client_start (int): The offset of the client address.
+        client_end (int): The offset of the space after the client address.
+        server_end (int): The offset of the space after the server address.
+        chunk_start (int): The offset of the TCP chunk.
+        chunk_length (int): The length of the TCP chunk.
+        end (int): The offset just past the end of the record.
+    """
+
+    __slots__ = (
+        "_data",
+        "offset",
+        "time_ns",
+        "direction",
+        "_client_start",
+        "_client_end",
+        "_server_end",
+        "tcp_chunk",
+        "end",
+    )
+
+    def __init__(
+        self,
+        data,
+        offset,
+        time_ns,
+        direction,
+        client_start,
+        client_end,
+        server_end,
+        chunk_start,
+        chunk_length,
+        end,
+    ):
+        self._data = data
+        self.offset = offset
+        self.time_ns = time_ns
+        self.direction = direction
+        self._client_start = client_start
+        self._client_end = client_end
+        self._server_end = server_end
+        self.tcp_chunk = data[chunk_start : chunk_start + chunk_length]
+        self.end = end
+
+    @property
+    def client_addr(self):
+        """str: The client address."""
+        return bytes(self._data[self._client_start : self._client_end]).decode(
+            "ascii"
+        )
+
+    @property
+    def server_addr(self):
+        """str: The server address."""
+        start = self._client_end + 1
+        return bytes(self._data[start : self._server_end]).decode("ascii")
+
+
+class RecordV2:
+    """A record of a memory-mapped version 2 replay log.
+
+    The TCP chunk is a zero-copy ``memoryview`` into the mapped file, and
+    the addresses are only looked up (in the connection table of the
+    replay log) when they are accessed.
+
+    Args:
+        replay_log (ReplayLog): The replay log.
+        offset (int): The offset of the record.
+        time_ns (int): The timestamp of the record.
+        connection_id (int): The id of the connection in the replay log.
+        direction (int): The direction of the TCP chunk.
+        chunk_start (int): The offset of the TCP chunk.
+        chunk_length (int): The length of the TCP chunk.
+    """
+
+    __slots__ = (
+        "_replay_log",
+        "offset",
+        "time_ns",
+        "connection_id",
+        "direction",
+        "tcp_chunk",
+        "end",
+    )
+
+    def __init__(
+        self,
+        replay_log,
+        offset,
+        time_ns,
+        connection_id,
+        direction,
+        chunk_start,
+        chunk_length,
+    ):
+        self._replay_log = replay_log
+        self.offset = offset
+        self.time_ns = time_ns
+        self.connection_id = connection_id
+        self.direction = direction
+        self.end = chunk_start + chunk_length
+        self.tcp_chunk = replay_log.data[chunk_start : self.end]
+
+    @property
+    def client_addr(self):
+        """str: The client address."""
+        return self._replay_log.addresses(self.connection_id)[0]
+
+    @property
+    def server_addr(self):
+        """str: The server address."""
+        return self._replay_log.addresses(self.connection_id)[1]
+
+
+class ReplayLog:
+    """A memory-mapped replay log.
+
+    This is intended to be used as a context manager; records (and their
+    ``memoryview`` chunks) must not be used after the replay log is closed.
+    The header (if any) is parsed when the replay log is opened; records
+    start at ``header_size``.
+
+    If :data:`_replay_format.FLAG_DEDUP` is set, a chunk stored as a
+    reference can only be resolved by scanning the records before it, so
+    records can't be decoded from the middle of the replay log (e.g. from
+    an offset in a sidecar index).
+
+    A version 2 replay log yields :class:`RecordV2` records. Their
+    addresses are looked up in the connection table, which is filled in as
+    records are decoded; if a record's connection entry was skipped (e.g.
+    when starting from the middle of the replay log), the entire connection
+    table is read once, by hopping from header to header.
+
+    Args:
+        filename (pathlib.Path): The replay log.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file_obj = open(filename, "rb")
+        size = self._file_obj.seek(0, 2)
+        self._mmap = None
+        if size == 0:
+            # An empty file can't be mapped.
+            self.data = memoryview(b"")
+        else:
+            self._mmap = mmap.mmap(
+                self._file_obj.fileno(), 0, access=mmap.ACCESS_READ
+            )
+            self.data = memoryview(self._mmap)
+        header = self.data[: _replay_format.HEADER_STRUCT.size]
+        self.header_size, self.version, self.flags = (
+            _replay_format.parse_header(header)
+        )
+        self._direction_size = 0
+        if self.flags & _replay_format.FLAG_DIRECTION:
+            self._direction_size = _replay_format.DIRECTION_STRUCT.size
+        self._dedup = bool(self.flags & _replay_format.FLAG_DEDUP)
+        self._v2 = self.version == _replay_format.VERSION_2
+        # Maps the id of each connection in the connection table (of a
+        # version 2 replay log) to the offsets of its addresses.
+        self._entries = {}
+        self._addresses = {}
+        self._scanned_entries = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Unmap and close the replay log.
+
+        If any ``memoryview`` chunks are still referenced, the mapping is
+        left for the garbage collector to close instead.
+        """
+        self.data.release()
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass
+        self._file_obj.close()
+
+    def __len__(self):
+        return len(self.data)
+
+    def _find_space(self, start):
+        index = self._mmap.find(b" ", start, start + MAX_ADDRESS_LENGTH + 1)
+        if index == -1:
+            raise ValueError(
+                "Replay log is corrupt or misaligned at offset", start
+            )
+        return index
+
+    def _check_range(self, start, end):
+        """Fill in and validate a byte range of records.
+
+        Args:
+            start (Optional[int]): The offset of the first record, if set.
+            end (Optional[int]): The offset where the range stops, if set.
+
+        Returns:
+            Tuple[int, int]: The validated ``(start, end)`` range.
+
+        Raises:
+            ValueError: If ``start`` is inside the header.
+            ValueError: If ``start`` is after the first record of a
+                deduplicated replay log.
+            ValueError: If ``end`` is past the end of the replay log.
+        """
+        if start is None:
+            start = self.header_size
+        if end is None:
+            end = len(self.data)
+
+        if start < self.header_size:
+            raise ValueError(
+                "Start is inside the replay log header",
+                start,
+                self.header_size,
+            )
+        if self._dedup and start != self.header_size:
+            raise ValueError(
+                "Deduplicated replay logs must be read from the first record",
+                start,
+            )
+        if end > len(self.data):
+            raise ValueError("End is past the end of the replay log", end)
+        return start, end
+
+    def _header(self, offset, dictionary):
+        """Decode the header of the record at ``offset``.
+
+        Args:
+            offset (int): The offset of the record.
+            dictionary (Dict[int, Tuple[int, int]]): The offset and length of
+                the chunk in each dictionary slot, if
+                :data:`_replay_format.FLAG_DEDUP` is set; updated if the
+                chunk is stored in a slot.
+
+        Returns:
+            Tuple[int, int, int, int, int, int, int, int]: The timestamp, the
+            direction, the offset of the client address, the offsets of the
+            spaces after the client and server addresses, the offset and
+            length of the TCP chunk and the offset just past the end of the
+            record.
+
+        Raises:
+            EOFError: If the replay log ends in the middle of the record.
+            ValueError: If the record is corrupt.
+        """
+        size = len(self.data)
+        client_start = offset + TIMESTAMP_STRUCT.size + self._direction_size
+        if client_start > size:
+            raise EOFError("Replay log ended in the middle of a record")
+
+        (time_ns,) = TIMESTAMP_STRUCT.unpack_from(self._mmap, offset)
+        direction = _replay_format.CLIENT_TO_SERVER
+        if self._direction_size:
+            direction = self._mmap[offset + TIMESTAMP_STRUCT.size]
+        client_end = self._find_space(client_start)
+        server_end = self._find_space(client_end + 1)
+        length_start = server_end + 1
+        kind = slot = None
+        if self._dedup:
+            length_start, kind, slot = self._chunk_kind(length_start)
+        if kind == _replay_format.CHUNK_REFERENCE:
+            chunk_start, chunk_length = self._lookup(dictionary, slot)
+            end = length_start
+        else:
+            if length_start + LENGTH_STRUCT.size > size:
+                raise EOFError("Replay log ended in the middle of a record")
+
+            (chunk_length,) = LENGTH_STRUCT.unpack_from(
+                self._mmap, length_start
+            )
+            chunk_start = length_start + LENGTH_STRUCT.size
+            end = chunk_start + chunk_length
+            if end > size:
+                raise EOFError("Replay log ended in the middle of a record")
+            if slot is not None:
+                dictionary[slot] = chunk_start, chunk_length
+
+        return (
+            time_ns,
+            direction,
+            client_start,
+            client_end,
+            server_end,
+            chunk_start,
+            chunk_length,
+            end,
+        )
+
+    def _chunk_kind(self, offset):
+        """Decode the ``KIND`` byte (and slot) of a deduplicated chunk.
+
+        Returns:
+            Tuple[int, int, Optional[int]]: The offset after the kind (and
+            slot), the kind and the slot (:data:`None` for a literal chunk).
+
+        Raises:
+            EOFError: If the replay log ends in the middle of the record.
+            ValueError: If the kind is not known.
+        """
+        size = len(self.data)
+        if offset + _replay_format.KIND_STRUCT.size > size:
+            raise EOFError("Replay log ended in the middle of a record")
+
+        kind = self._mmap[offset]
+        offset += _replay_format.KIND_STRUCT.size
+        if kind == _replay_format.CHUNK_LITERAL:
+            return offset, kind, None
+        if kind not in (
+            _replay_format.CHUNK_DEFINE,
+            _replay_format.CHUNK_REFERENCE,
+        ):
+            raise ValueError("Unsupported chunk kind in replay log", kind)
+
+        if offset + _replay_format.SLOT_STRUCT.size > size:
+            raise EOFError("Replay log ended in the middle of a record")
+        (slot,) = _replay_format.SLOT_STRUCT.unpack_from(self._mmap, offset)
+        return offset + _replay_format.SLOT_STRUCT.size, kind, slot
+
+    @staticmethod
+    def _lookup(dictionary, slot):
+        location = dictionary.get(slot)
+        if location is None:
+            raise ValueError("Replay log refers to an empty slot", slot)
+        return location
+
+    def _header_v2(self, offset):
+        """Decode the header of the version 2 record at ``offset``.
+
+        Returns:
+            Tuple[int, int, int, int, int]: The timestamp, the connection id,
+            the direction, the offset and the length of the payload.
+
+        Raises:
+            EOFError: If the replay log ends in the middle of the record.
+        """
+        record_struct = _replay_format.RECORD_V2_STRUCT
+        payload_start = offset + record_struct.size
+        if payload_start > len(self.data):
+            raise EOFError("Replay log ended in the middle of a record")
+
+        time_ns, connection_id, direction, length = record_struct.unpack_from(
+            self._mmap, offset
+        )
+        if payload_start + length > len(self.data):
+            raise EOFError("Replay log ended in the middle of a record")
+        return time_ns, connection_id, direction, payload_start, length
+
+    def _scan_entries(self):
+        """Read the entire connection table of a version 2 replay log."""
+        offset = self.header_size
+        size = len(self.data)
+        while offset < size:
+            _, connection_id, direction, payload_start, length = (
+                self._header_v2(offset)
+            )
+            offset = payload_start + length
+            if direction == _replay_format.CONNECTION_ENTRY:
+                self._entries[connection_id] = payload_start, offset
+        self._scanned_entries = True
+
+    def addresses(self, connection_id):
+        """Look up a connection in the connection table.
+
+        Args:
+            connection_id (int): The id of the connection in a version 2
+                replay log.
+
+        Returns:
+            Tuple[str, str]: The client address and the server address.
+
+        Raises:
+            ValueError: If the connection is not in the connection table.
+        """
+        addresses = self._addresses.get(connection_id)
+        if addresses is not None:
+            return addresses
+
+        if connection_id not in self._entries and not self._scanned_entries:
+            self._scan_entries()
+        entry = self._entries.get(connection_id)
+        if entry is None:
+            raise ValueError(
+                "Replay log refers to an unknown connection", connection_id
+            )
+        addresses = _replay_format.decode_addresses(self._mmap, *entry)
+        self._addresses[connection_id] = addresses
+        return addresses
+
+    def records(self, start=None, end=None):
+        """Iterate over the records in (a byte range of) the replay log.
+
+        Args:
+            start (Optional[int]): The offset of the first record, e.g. from a
+                sidecar index. Defaults to the first record after the
+                header.
+            end (Optional[int]): The offset where iteration stops; must be a
+                record boundary. Defaults to the end of the replay log.
+
+        Yields:
+            Record: Each record in the range.
+
+        Raises:
+            ValueError: If ``start`` is inside the header.
+            ValueError: If ``start`` is after the first record of a
+                deduplicated replay log.
+            ValueError: If ``end`` is past the end of the replay log.
+        """
+        start, end = self._check_range(start, end)
+        if self._v2:
+            yield from self._records_v2(start, end)
+            return
+
+        dictionary = {}
+        offset = start
+        while offset < end:
+            header = self._header(offset, dictionary)
+            time_ns, direction, client_start, client_end = header[:4]
+            server_end, chunk_start, chunk_length, record_end = header[4:]
+            record = Record(
+                self.data,
+                offset,
+                time_ns,
+                direction,
+                client_start,
+                client_end,
+                server_end,
+                chunk_start,
+                chunk_length,
+                record_end,
+            )
+            yield record
+            offset = record_end
+
+    __iter__ = records
+
+    def _records_v2(self, start, end):
+        offset = start
+        while offset < end:
+            time_ns, connection_id, direction, payload_start, length = (
+                self._header_v2(offset)
+            )
+            if direction == _replay_format.CONNECTION_ENTRY:
+                self._entries[connection_id] = (
+                    payload_start,
+                    payload_start + length,
+                )
+            else:
+                yield RecordV2(
+                    self,
+                    offset,
+                    time_ns,
+                    connection_id,
+                    direction,
+                    payload_start,
+                    length,
+                )
+            offset = payload_start + length
+
+    def _is_address(self, start, end):
+        address = self._mmap[start:end]
+        return (
+            b":" in address
+            and address.isascii()
+            and address.decode("ascii").isprintable()
+        )
+
+    def _is_boundary(self, offset, min_ns, max_ns):
+        """Check if ``RESYNC_RECORDS`` records decode from ``offset``.
+
+        Fewer records are checked if the replay log ends first.
+        """
+        size = len(self.data)
+        for _ in range(RESYNC_RECORDS):
+            if offset == size:
+                return True
+            try:
+                header = self._header(offset, None)
+            except (EOFError, ValueError):
+                return False
+
+            time_ns, direction, client_start, client_end = header[:4]
+            server_end = header[4]
+            if not min_ns <= time_ns <= max_ns:
+                return False
+            if direction not in (
+                _replay_format.CLIENT_TO_SERVER,
+                _replay_format.SERVER_TO_CLIENT,
+            ):
+                return False
+            if not self._is_address(client_start, client_end):
+                return False
+            if not self._is_address(client_end + 1, server_end):
+                return False
+            offset = header[7]
+        return True
+
+    def _is_boundary_v2(self, offset, min_ns, max_ns):
+        """Check if ``RESYNC_RECORDS`` (version 2) records decode from there.
+
+        Fewer records are checked if the replay log ends first.
+        """
+        size = len(self.data)
+        for _ in range(RESYNC_RECORDS):
+            if offset == size:
+                return True
+            try:
+                time_ns, _, direction, payload_start, length = (
+                    self._header_v2(offset)
+                )
+            except EOFError:
+                return False
+
+            if not min_ns <= time_ns <= max_ns:
+                return False
+            end = payload_start + length
+            if direction == _replay_format.CONNECTION_ENTRY:
+                try:
+                    _replay_format.decode_addresses(
+                        self._mmap, payload_start, end
+                    )
+                except ValueError:
+                    return False
+            elif direction not in (
+                _replay_format.CLIENT_TO_SERVER,
+                _replay_format.SERVER_TO_CLIENT,
+            ):
+                return False
+            offset = end
+        return True
+
+    def _find_record_v2(self, offset, min_ns, max_ns):
+        # Each candidate record starts with the high byte of a plausible
+        # timestamp.
+        markers = [
+            bytes([high_byte])
+            for high_byte in range(min_ns >> 56, (max_ns >> 56) + 1)
+        ]
+        size = len(self.data)
+        position = offset
+        while True:
+            candidates = [
+                index
+                for index in (
+                    self._mmap.find(marker, position) for marker in markers
+                )
+                if index != -1
+            ]
+            if not candidates:
+                return size
+            candidate = min(candidates)
+            if self._is_boundary_v2(candidate, min_ns, max_ns):
+                return candidate
+            position = candidate + 1
+
+    def find_record(self, offset):
+        """Find the first record boundary at or after an offset.
+
+        Records carry no sync marker, so this searches for an offset where
+        ``RESYNC_RECORDS`` consecutive records decode with plausible
+        timestamps (near the first record's) and addresses (or, in a version
+        2 replay log, directions and connection entries). It is intended
+        for splitting a replay log into byte ranges without a sidecar
+        index; a false match is very unlikely but not impossible.
+
+        Args:
+            offset (int): The offset to search from.
+
+        Returns:
+            int: The offset of the first record boundary found, or the size
+            of the replay log if there is none.
+
+        Raises:
+            ValueError: If the replay log is deduplicated (records can't be
+                decoded from the middle of it).
+        """
+        if self._dedup:
+            raise ValueError(
+                "Deduplicated replay logs must be read from the first record",
+                offset,
+            )
+
+        size = len(self.data)
+        if offset <= self.header_size or size <= self.header_size:
+            return min(self.header_size, size)
+
+        if self._v2:
+            first_ns = self._header_v2(self.header_size)[0]
+        else:
+            first_ns = self._header(self.header_size, None)[0]
+        min_ns = max(first_ns - RESYNC_SLACK_NS, 0)
+        max_ns = time.time_ns() + RESYNC_SLACK_NS
+        if self._v2:
+            return self._find_record_v2(offset, min_ns, max_ns)
+
+        skip = TIMESTAMP_STRUCT.size + self._direction_size
+        position = offset
+        while True:
+            # Each candidate client address ends at a space; it starts within
+            # the run of printable bytes before that space.
+            space = self._mmap.find(b" ", position)
+            if space == -1:
+                return size
+            run_start = space
+            while (
+                run_start > position
+                and space - run_start < MAX_ADDRESS_LENGTH
+                and 0x20 < self._mmap[run_start - 1] < 0x7F
+            ):
+                run_start -= 1
+            for client_start in range(max(run_start, offset + skip), space):
+                candidate = client_start - skip
+                if self._is_boundary(candidate, min_ns, max_ns):
+                    return candidate
+            position = space + 1
+
+    def columns(self, start=None, end=None):
+        """Decode the headers of every record into compact arrays.
+
+        The TCP chunks are skipped (not copied), so this runs at close to
+        the speed the headers can be scanned.
+
+        Args:
+            start (Optional[int]): The offset of the first record. Defaults to
+                the first record after the header.
+            end (Optional[int]): The offset where decoding stops; must be a
+                record boundary. Defaults to the end of the replay log.
+
+        Returns:
+            Dict[str, array.array]: Arrays (one entry per record) for
+            ``"offsets"`` (of each record), ``"timestamps"``,
+            ``"directions"``, ``"chunk_offsets"`` and ``"chunk_lengths"``;
+            for a version 2 replay log, also ``"connection_ids"``.
+
+        Raises:
+            ValueError: If ``start`` is inside the header.
+            ValueError: If ``start`` is after the first record of a
+                deduplicated replay log.
+            ValueError: If ``end`` is past the end of the replay log.
+        """
+        start, end = self._check_range(start, end)
+        if self._dedup:
+            return self._dedup_columns(start, end)
+        if self._v2:
+            return self._v2_columns(start, end)
+
+        offsets = []
+        timestamps = []
+        directions = []
+        chunk_offsets = []
+        chunk_lengths = []
+        # NOTE: This is the hot loop for bulk decoding, so the per-record
+        #       work of ``_header()`` is inlined (an empty replay log has no
+        #       ``mmap`` but also never enters the loop).
+        data = self._mmap
+        find = getattr(data, "find", None)
+        unpack_timestamp = TIMESTAMP_STRUCT.unpack_from
+        unpack_length = LENGTH_STRUCT.unpack_from
+        width = MAX_ADDRESS_LENGTH + 1
+        skip = TIMESTAMP_STRUCT.size + self._direction_size
+        offset = start
+        while offset < end:
+            if offset + skip > end:
+                raise EOFError("Replay log ended in the middle of a record")
+            (time_ns,) = unpack_timestamp(data, offset)
+            if skip != 8:
+                directions.append(data[offset + 8])
+            client_end = find(b" ", offset + skip, offset + skip + width)
+            server_end = find(b" ", client_end + 1, client_end + 1 + width)
+            if client_end == -1 or server_end == -1:
+                raise ValueError(
+                    "Replay log is corrupt or misaligned at offset", offset
+                )
+            if server_end + 5 > end:
+                raise EOFError("Replay log ended in the middle of a record")
+            (chunk_length,) = unpack_length(data, server_end + 1)
+            offsets.append(offset)
+            timestamps.append(time_ns)
+            offset = server_end + 5
+            chunk_offsets.append(offset)
+            chunk_lengths.append(chunk_length)
+            offset += chunk_length
+
+        if offset > end:
+            raise EOFError("Replay log ended in the middle of a record")
+
+        if skip == 8:
+            directions = bytes(len(offsets))
+        return self._pack_columns(
+            offsets, timestamps, directions, chunk_offsets, chunk_lengths
+        )
+
+    def _dedup_columns(self, start, end):
+        """Decode the headers of every record in a deduplicated replay log.
+
+        This is the (slower) counterpart of ``columns()`` that decodes each
+        header with ``_header()``; for a chunk stored as a reference, the
+        chunk offset is that of the earlier record where the chunk is
+        stored.
+        """
+        offsets = []
+        timestamps = []
+        directions = []
+        chunk_offsets = []
+        chunk_lengths = []
+        dictionary = {}
+        offset = start
+        while offset < end:
+            header = self._header(offset, dictionary)
+            offsets.append(offset)
+            timestamps.append(header[0])
+            directions.append(header[1])
+            chunk_offsets.append(header[5])
+            chunk_lengths.append(header[6])
+            offset = header[7]
+
+        if offset > end:
+            raise EOFError("Replay log ended in the middle of a record")
+
+        return self._pack_columns(
+            offsets, timestamps, directions, chunk_offsets, chunk_lengths
+        )
+
+    def _v2_columns(self, start, end):
+        """Decode the headers of every record in a version 2 replay log.
+
+        Every record header has the same width, so this is a straight
+        strided decode: one ``unpack_from()`` per record, then a jump over
+        the payload. Entries in the connection table are added to the
+        table rather than returned.
+        """
+        offsets = []
+        timestamps = []
+        connection_ids = []
+        directions = []
+        chunk_offsets = []
+        chunk_lengths = []
+        entries = self._entries
+        data = self._mmap
+        unpack_header = _replay_format.RECORD_V2_STRUCT.unpack_from
+        header_size = _replay_format.RECORD_V2_STRUCT.size
+        connection_entry = _replay_format.CONNECTION_ENTRY
+        offset = start
+        while offset < end:
+            if offset + header_size > end:
+                raise EOFError("Replay log ended in the middle of a record")
+            time_ns, connection_id, direction, length = unpack_header(
+                data, offset
+            )
+            chunk_start = offset + header_size
+            if direction == connection_entry:
+                entries[connection_id] = chunk_start, chunk_start + length
+            else:
+                offsets.append(offset)
+                timestamps.append(time_ns)
+                connection_ids.append(connection_id)
+                directions.append(direction)
+                chunk_offsets.append(chunk_start)
+                chunk_lengths.append(length)
+            offset = chunk_start + length
+
+        if offset > end:
+            raise EOFError("Replay log ended in the middle of a record")
+
+        columns = self._pack_columns(
+            offsets, timestamps, directions, chunk_offsets, chunk_lengths
+        )
+        columns["connection_ids"] = array.array("I", connection_ids)
+        return columns
+
+    @staticmethod
+    def _pack_columns(
+        offsets, timestamps, directions, chunk_offsets, chunk_lengths
+    ):
+        offsets = array.array("Q", offsets)
+        timestamps = array.array("Q", timestamps)
+        directions = array.array("B", directions)
+        chunk_offsets = array.array("Q", chunk_offsets)
+        chunk_lengths = array.array("I", chunk_lengths)
+        return {
+            "offsets": offsets,
+            "timestamps": timestamps,
+            "directions": directions,
+            "chunk_offsets": chunk_offsets,
+            "chunk_lengths": chunk_lengths,
+        }
+
+    def numpy_columns(self, start=None, end=None):
+        """Decode the headers of every record into NumPy arrays.
+
+        Args:
+            start (Optional[int]): The offset of the first record.
+            end (Optional[int]): The offset where decoding stops.
+
+        Returns:
+            Dict[str, numpy.ndarray]: The same arrays as ``columns()``.
+
+        Raises:
+            ImportError: If NumPy is not installed.
+        """
+        import numpy as np
+
+        return {
+            name: np.frombuffer(values, dtype=values.typecode)
+            for name, values in self.columns(start=start, end=end).items()
+        }
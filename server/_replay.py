@@ -0,0 +1,461 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import array
+import asyncio
+import socket
+import time
+
+import _buffer
+import _display
+import _index
+import _read_replay_log
+import _replay_format
+
+
+CONNECT_TIMEOUT = 10.0
+# The default amount of time to wait for the first byte of a response (to a
+# chunk that got one in the capture) before moving on to the next chunk.
+RESPONSE_TIMEOUT = 1.0
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class ReplayStats:
+    """Counters and latencies collected while replaying a log.
+
+    Latencies are measured from the moment the first chunk of a request is
+    sent until the first byte of the response arrives, in nanoseconds. A
+    request starts with the first chunk sent on a connection after its
+    previous response (or the first chunk overall).
+    """
+
+    def __init__(self):
+        self.connections = 0
+        self.failed_connections = 0
+        self.chunks_sent = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.no_response = 0
+        self.max_lag_ns = 0
+        self.latencies_ns = array.array("Q")
+        self.elapsed = 0.0
+
+    def percentiles(self):
+        """Compute latency percentiles.
+
+        Returns:
+            Dict[float, int]: The latency (in nanoseconds) at each of the
+            ``PERCENTILES``; empty if no latencies were recorded.
+        """
+        if not self.latencies_ns:
+            return {}
+
+        ordered = sorted(self.latencies_ns)
+        last = len(ordered) - 1
+        return {
+            percentile: ordered[round(last * percentile / 100)]
+            for percentile in PERCENTILES
+        }
+
+    def summary(self):
+        """Summarize the replay as a JSON-serializable dictionary.
+
+        Returns:
+            Dict[str, Any]: The counters, the achieved throughput and the
+            latency percentiles (in milliseconds).
+        """
+        elapsed = max(self.elapsed, 1e-9)
+        latencies = {
+            f"p{percentile:g}": value / 1e6
+            for percentile, value in self.percentiles().items()
+        }
+        if self.latencies_ns:
+            latencies["max"] = max(self.latencies_ns) / 1e6
+        return {
+            "connections": self.connections,
+            "failed_connections": self.failed_connections,
+            "chunks_sent": self.chunks_sent,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "no_response": self.no_response,
+            "elapsed_seconds": self.elapsed,
+            "chunks_per_second": self.chunks_sent / elapsed,
+            "bytes_per_second": self.bytes_sent / elapsed,
+            "max_lag_ms": self.max_lag_ns / 1e6,
+            "latency_ms": latencies,
+        }
+
+    def display(self):
+        """Display a summary of the replay."""
+        summary = self.summary()
+        _display.display(
+            f"Replayed {summary['chunks_sent']} chunks over "
+            f"{summary['connections']} connections in "
+            f"{summary['elapsed_seconds']:.3f}s "
+            f"({summary['chunks_per_second']:.1f} chunks/s, "
+            f"{summary['bytes_per_second']:.1f} B/s); "
+            f"{summary['failed_connections']} failed connections, "
+            f"{summary['no_response']} chunks without a response"
+        )
+        latencies = ", ".join(
+            f"{name}={value:.3f}ms"
+            for name, value in summary["latency_ms"].items()
+        )
+        if latencies:
+            _display.display(f"Response latency: {latencies}")
+
+
+class _Clock:
+    """Maps capture timestamps onto the replay's monotonic clock.
+
+    Args:
+        first_ns (int): The timestamp of the first record in the capture.
+        speed (Optional[float]): The speed multiplier; :data:`None` means as
+            fast as possible.
+    """
+
+    def __init__(self, first_ns, speed):
+        self.first_ns = first_ns
+        self.speed = speed
+        self.start_ns = time.perf_counter_ns()
+
+    def delay(self, time_ns):
+        """Compute how long to wait before sending a chunk.
+
+        Args:
+            time_ns (int): The capture timestamp of the chunk.
+
+        Returns:
+            int: The number of nanoseconds until the chunk is due; negative
+            if the replay is running behind.
+        """
+        if self.speed is None:
+            return 0
+        due_ns = self.start_ns + (time_ns - self.first_ns) / self.speed
+        return int(due_ns) - time.perf_counter_ns()
+
+
+class _Session:
+    """The replay of one captured client connection.
+
+    Args:
+        chunks (List[List[int, memoryview, bool]]): The timestamp and TCP
+            chunk of each record sent by the client, and an indication if
+            the chunk got a response in the capture.
+        response_timeout (float): The maximum time (in seconds) to wait for
+            a response to each chunk that got one in the capture; ``0``
+            sends each chunk without waiting for a response.
+        drain (Optional[bool]): Indicates if, after the last chunk, the
+            session should wait (up to ``response_timeout``) for the
+            response to the outstanding request, if any, before closing the
+            connection. This is for sessions where it isn't known which
+            chunks got a response.
+    """
+
+    def __init__(self, chunks, response_timeout=RESPONSE_TIMEOUT, drain=False):
+        self.chunks = chunks
+        self.response_timeout = response_timeout
+        self.drain = drain
+        # When the first chunk of the outstanding request (if any) was sent.
+        self.request_ns = None
+        self.responded = asyncio.Event()
+        self.closed = False
+
+    async def _read_responses(self, loop, server_socket, stats):
+        buffer_size = _buffer.DEFAULT_BUFFER_SIZE
+        while True:
+            try:
+                tcp_chunk = await loop.sock_recv(server_socket, buffer_size)
+            except OSError:
+                tcp_chunk = b""
+            if tcp_chunk == b"":
+                self.closed = True
+                self.responded.set()
+                return
+
+            stats.bytes_received += len(tcp_chunk)
+            if self.request_ns is not None:
+                stats.latencies_ns.append(
+                    time.perf_counter_ns() - self.request_ns
+                )
+                self.request_ns = None
+                self.responded.set()
+            buffer_size = _buffer.next_buffer_size(buffer_size, len(tcp_chunk))
+
+    async def run(self, loop, clock, server_host, server_port, stats):
+        """Replay the session against a server.
+
+        Each chunk is sent at its (scaled) capture time, but a chunk that
+        got a response in the capture must get a response (or
+        ``response_timeout`` must expire) before the next chunk is sent,
+        which keeps a request / response protocol in order. Chunks that got
+        no response (e.g. a PostgreSQL ``Parse`` before its ``Sync``) are
+        followed immediately by the next chunk.
+
+        A request whose response times out stays outstanding, so a late
+        response is measured against it (rather than against a later
+        chunk).
+
+        Args:
+            loop (asyncio.AbstractEventLoop): The running event loop.
+            clock (_Clock): The replay clock.
+            server_host (str): The host of the server being replayed against.
+            server_port (int): The port of the server being replayed against.
+            stats (ReplayStats): The stats for the replay.
+        """
+        delay_ns = clock.delay(self.chunks[0][0])
+        if delay_ns > 0:
+            await asyncio.sleep(delay_ns / 1e9)
+
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setblocking(0)
+        try:
+            await asyncio.wait_for(
+                loop.sock_connect(server_socket, (server_host, server_port)),
+                CONNECT_TIMEOUT,
+            )
+        except (OSError, asyncio.TimeoutError) as exc:
+            _display.display(
+                f"Failed to connect to server({server_host}:{server_port}): "
+                f"{exc!r}"
+            )
+            stats.failed_connections += 1
+            server_socket.close()
+            return
+
+        stats.connections += 1
+        reader = asyncio.create_task(
+            self._read_responses(loop, server_socket, stats)
+        )
+        try:
+            for time_ns, tcp_chunk, expects_response in self.chunks:
+                if self.closed:
+                    break
+
+                delay_ns = clock.delay(time_ns)
+                if delay_ns > 0:
+                    await asyncio.sleep(delay_ns / 1e9)
+                else:
+                    stats.max_lag_ns = max(stats.max_lag_ns, -delay_ns)
+
+                self.responded.clear()
+                if self.request_ns is None:
+                    self.request_ns = time.perf_counter_ns()
+                await loop.sock_sendall(server_socket, tcp_chunk)
+                stats.chunks_sent += 1
+                stats.bytes_sent += len(tcp_chunk)
+                if not expects_response or self.response_timeout == 0:
+                    continue
+                try:
+                    await asyncio.wait_for(
+                        self.responded.wait(), self.response_timeout
+                    )
+                except asyncio.TimeoutError:
+                    stats.no_response += 1
+
+            if (
+                self.drain
+                and self.request_ns is not None
+                and self.response_timeout > 0
+                and not self.closed
+            ):
+                self.responded.clear()
+                try:
+                    await asyncio.wait_for(
+                        self.responded.wait(), self.response_timeout
+                    )
+                except asyncio.TimeoutError:
+                    pass
+        except OSError as exc:
+            _display.display(f"Error replaying to server: {exc!r}")
+        finally:
+            reader.cancel()
+            await asyncio.gather(reader, return_exceptions=True)
+            server_socket.close()
+
+
+def _load_connection_ids(filename):
+    """Load the connection id of each record from a sidecar index.
+
+    Args:
+        filename (pathlib.Path): The replay log.
+
+    Returns:
+        Optional[array.array]: The connection id of each record, or
+        :data:`None` if the replay log has no sidecar index.
+    """
+    index_file = _index.index_filename(filename)
+    if not index_file.exists():
+        return None
+    return _index.load_index(index_file).connection_ids
+
+
+def load_sessions(
+    replay_log, connection_ids=None, response_timeout=RESPONSE_TIMEOUT
+):
+    """Group the records in a replay log by client connection.
+
+    Only the chunks sent by clients are replayed. If responses were
+    captured (see :data:`_replay_format.FLAG_DIRECTION`), they mark the
+    client chunks that got a response, i.e. the last client chunk before
+    each run of server->client chunks; only those chunks wait for a
+    response during the replay. Without captured responses, no chunk waits;
+    each connection only waits for the response to its last request before
+    it is closed.
+
+    A version 2 replay log records the connection id of each record, so a
+    connection is identified by its client address **and** that id.
+    Otherwise, without connection ids, a connection is identified by its
+    client address alone, so two connections that (at different times) used
+    the same client address and port are replayed as one.
+
+    Args:
+        replay_log (_read_replay_log.ReplayLog): An open replay log.
+        connection_ids (Optional[Sequence[int]]): The connection id of each
+            record (e.g. from a sidecar index written during capture). If
+            set, connections are identified by client address **and** id.
+            Ignored for a version 2 replay log.
+        response_timeout (Optional[float]): The maximum time (in seconds) to
+            wait for a response to each chunk.
+
+    Returns:
+        Tuple[int, List[_Session]]: The timestamp of the first record and the
+        sessions, ordered by the timestamp of their first chunk.
+
+    Raises:
+        ValueError: If ``connection_ids`` doesn't have one id per record.
+    """
+    v2 = replay_log.version == _replay_format.VERSION_2
+    if v2:
+        connection_ids = None
+    by_client = {}
+    first_ns = None
+    count = 0
+    for count, record in enumerate(replay_log, start=1):
+        key = record.client_addr
+        if v2:
+            key = key, record.connection_id
+        elif connection_ids is not None:
+            if count > len(connection_ids):
+                raise ValueError("Too few connection ids", len(connection_ids))
+            key = key, connection_ids[count - 1]
+        if record.direction != _replay_format.CLIENT_TO_SERVER:
+            chunks = by_client.get(key)
+            if chunks:
+                chunks[-1][2] = True
+            continue
+
+        if first_ns is None:
+            first_ns = record.time_ns
+        chunks = by_client.setdefault(key, [])
+        chunks.append([record.time_ns, record.tcp_chunk, False])
+
+    if connection_ids is not None and count != len(connection_ids):
+        raise ValueError(
+            "Expected one connection id per record", count, len(connection_ids)
+        )
+
+    drain = not replay_log.flags & _replay_format.FLAG_DIRECTION
+    sessions = [
+        _Session(chunks, response_timeout, drain=drain)
+        for chunks in by_client.values()
+    ]
+    sessions.sort(key=lambda session: session.chunks[0][0])
+    return first_ns, sessions
+
+
+async def _replay(
+    replay_log,
+    connection_ids,
+    server_host,
+    server_port,
+    speed,
+    response_timeout,
+):
+    loop = asyncio.get_running_loop()
+    stats = ReplayStats()
+    first_ns, sessions = load_sessions(
+        replay_log, connection_ids, response_timeout
+    )
+    if not sessions:
+        return stats
+
+    clock = _Clock(first_ns, speed)
+    await asyncio.gather(
+        *(
+            session.run(loop, clock, server_host, server_port, stats)
+            for session in sessions
+        )
+    )
+    stats.elapsed = (time.perf_counter_ns() - clock.start_ns) / 1e9
+    return stats
+
+
+def replay(
+    *,
+    filename,
+    server_host,
+    server_port,
+    speed=1.0,
+    response_timeout=RESPONSE_TIMEOUT,
+):
+    """Replay a captured log against a server.
+
+    One connection is opened to the server for each captured client
+    connection and the client's chunks are resent with their original
+    inter-arrival timing. If the replay log is version 2 (or has a sidecar
+    index), captured connections are told apart by their connection ids (so
+    a reused client address and port starts a new connection); otherwise
+    they are identified by the client address alone.
+
+    Args:
+        filename (pathlib.Path): The replay log.
+        server_host (str): The host of the server being replayed against.
+        server_port (int): The port of the server being replayed against.
+        speed (Optional[float]): The speed multiplier applied to the original
+            timing, e.g. ``2.0`` replays twice as fast. If :data:`None`, each
+            chunk is sent as soon as the previous one has a response (if it
+            got one in the capture) or immediately.
+        response_timeout (Optional[float]): The maximum time (in seconds) to
+            wait for the first byte of a response to a chunk that got one in
+            the capture, before sending the next chunk. Only replay logs with
+            captured responses (see :data:`_replay_format.FLAG_DIRECTION`)
+            tell which chunks got a response; otherwise chunks are sent
+            without waiting. If ``0``, chunks are sent without waiting for
+            responses. Latencies are recorded either way.
+
+    Returns:
+        ReplayStats: The counters and latencies collected during the replay.
+
+    Raises:
+        ValueError: If ``speed`` is not positive.
+        ValueError: If ``response_timeout`` is negative.
+    """
+    if speed is not None and speed <= 0:
+        raise ValueError("Speed must be positive", speed)
+    if response_timeout < 0:
+        raise ValueError(
+            "Response timeout can't be negative", response_timeout
+        )
+
+    connection_ids = _load_connection_ids(filename)
+    with _read_replay_log.ReplayLog(filename) as replay_log:
+        return asyncio.run(
+            _replay(
+                replay_log,
+                connection_ids,
+                server_host,
+                server_port,
+                speed,
+                response_timeout,
+            )
+        )
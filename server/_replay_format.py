@@ -0,0 +1,228 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+import struct
+
+
+# A replay log may start with a header identifying its format. The first
+# byte can't start a headerless (legacy) replay log, since it would be the
+# high byte of a timestamp more than 300 years after the epoch.
+MAGIC = b"\x89TRPLOG\n"
+VERSION = 1
+# A version 2 replay log always has a header and stores each record with a
+# fixed-width header (see ``RECORD_V2_STRUCT``).
+VERSION_2 = 2
+VERSIONS = (VERSION, VERSION_2)
+HEADER_STRUCT = struct.Struct(">8sBB")
+# Each record has a ``DIRECTION`` byte after its timestamp.
+FLAG_DIRECTION = 0x01
+# Each record has a ``KIND`` byte before its TCP chunk and repeated chunks are
+# only stored once (see :class:`_save_replay_log.Deduplicator`).
+FLAG_DEDUP = 0x02
+KNOWN_FLAGS = FLAG_DIRECTION | FLAG_DEDUP
+DIRECTION_STRUCT = struct.Struct(">B")
+CLIENT_TO_SERVER = 0
+SERVER_TO_CLIENT = 1
+# With ``FLAG_DEDUP``, the kind of each record's TCP chunk:
+# - ``CHUNK_LITERAL``: ``[LENGTH][TCP PACKET]``, as without the flag
+# - ``CHUNK_DEFINE``: ``[SLOT][LENGTH][TCP PACKET]``; the chunk is also stored
+#   in dictionary slot ``SLOT`` (replacing whatever was there)
+# - ``CHUNK_REFERENCE``: ``[SLOT]``; the chunk is the one in dictionary slot
+#   ``SLOT``
+KIND_STRUCT = struct.Struct(">B")
+SLOT_STRUCT = struct.Struct(">I")
+CHUNK_LITERAL = 0
+CHUNK_DEFINE = 1
+CHUNK_REFERENCE = 2
+# Each version 2 record is ``[TIMESTAMP][CONNECTION][DIRECTION][LENGTH]``
+# followed by ``LENGTH`` bytes of payload, so the record headers can be
+# decoded without searching for delimiters. ``CONNECTION`` is a small integer
+# id, defined by an entry in the connection table.
+RECORD_V2_STRUCT = struct.Struct(">QIBI")
+# A version 2 record with this ``DIRECTION`` is an entry in the connection
+# table: its payload is the client address followed by the server address of
+# connection ``CONNECTION``, each ``[FAMILY][IP][PORT]``. An entry comes
+# before the first record of its connection in each file (or segment).
+CONNECTION_ENTRY = 0xFF
+FAMILY_STRUCT = struct.Struct(">B")
+PORT_STRUCT = struct.Struct(">H")
+# Maps each ``FAMILY`` to its socket address family and the size of ``IP``.
+FAMILIES = {
+    4: (socket.AF_INET, 4),
+    6: (socket.AF_INET6, 16),
+}
+# In a version 2 replay log every record has a direction; the direction flag
+# only indicates that server->client chunks were captured.
+V2_FLAGS = FLAG_DIRECTION
+
+
+def encode_header(flags, version=VERSION):
+    """Encode the header for a replay log.
+
+    Args:
+        flags (int): The format flags, e.g. :data:`FLAG_DIRECTION`.
+        version (Optional[int]): The format version; one of
+            :data:`VERSIONS`.
+
+    Returns:
+        bytes: The encoded header; empty for a version 1 replay log if no
+        flags are set, so that a replay log without any new features stays
+        readable by tools that only understand headerless replay logs.
+    """
+    if flags == 0 and version == VERSION:
+        return b""
+    return HEADER_STRUCT.pack(MAGIC, version, flags)
+
+
+def parse_header(data):
+    """Parse the header (if any) at the start of a replay log.
+
+    Args:
+        data (Union[bytes, memoryview, mmap.mmap]): The start of the replay
+            log; must hold at least ``HEADER_STRUCT.size`` bytes if the
+            replay log is that large.
+
+    Returns:
+        Tuple[int, int, int]: The size of the header (``0`` for a headerless
+        replay log), the format version and the format flags.
+
+    Raises:
+        EOFError: If the replay log ends in the middle of the header.
+        ValueError: If the version or flags are not supported.
+    """
+    if bytes(data[: len(MAGIC)]) != MAGIC:
+        return 0, VERSION, 0
+    if len(data) < HEADER_STRUCT.size:
+        raise EOFError("Replay log ended in the middle of the header")
+
+    _, version, flags = HEADER_STRUCT.unpack_from(data)
+    if version not in VERSIONS:
+        raise ValueError("Unsupported replay log version", version)
+    known_flags = V2_FLAGS if version == VERSION_2 else KNOWN_FLAGS
+    if flags & ~known_flags:
+        raise ValueError("Unsupported replay log flags", flags)
+    return HEADER_STRUCT.size, version, flags
+
+
+def read_header(file_obj):
+    """Read the header (if any) at the start of a replay log.
+
+    Args:
+        file_obj (io.BufferedReader): The replay log, opened in binary mode
+            and positioned at the start of the file.
+
+    Returns:
+        Tuple[int, int]: The format version and the format flags; ``1`` and
+        ``0`` for a headerless replay log.
+
+    Raises:
+        EOFError: If the replay log ends in the middle of the header.
+        ValueError: If the version or flags are not supported.
+    """
+    header_size, version, flags = parse_header(
+        file_obj.peek(HEADER_STRUCT.size)
+    )
+    file_obj.read(header_size)
+    return version, flags
+
+
+def encode_address(address):
+    """Encode an address for the connection table of a version 2 log.
+
+    Args:
+        address (str): The address (IP and port), e.g. ``127.0.0.1:5432``.
+
+    Returns:
+        bytes: The encoded ``[FAMILY][IP][PORT]``.
+
+    Raises:
+        ValueError: If the address is not an IPv4 / IPv6 address and port.
+    """
+    host, _, port = address.rpartition(":")
+    for family, (socket_family, _) in FAMILIES.items():
+        try:
+            packed = socket.inet_pton(socket_family, host)
+        except OSError:
+            continue
+        return (
+            FAMILY_STRUCT.pack(family) + packed + PORT_STRUCT.pack(int(port))
+        )
+
+    raise ValueError("Unsupported address in replay log", address)
+
+
+def encode_addresses(client_addr, server_addr):
+    """Encode the payload of an entry in the connection table.
+
+    Args:
+        client_addr (str): The address (IP and port) of the client socket.
+        server_addr (str): The address (IP and port) of the server socket.
+
+    Returns:
+        bytes: The encoded client address followed by the server address.
+    """
+    return encode_address(client_addr) + encode_address(server_addr)
+
+
+def decode_address(data, offset):
+    """Decode an address from the connection table of a version 2 log.
+
+    Args:
+        data (Union[bytes, memoryview, mmap.mmap]): The encoded addresses.
+        offset (int): The offset of the ``FAMILY`` byte.
+
+    Returns:
+        Tuple[str, int]: The address (IP and port) and the offset just past
+        the end of it.
+
+    Raises:
+        ValueError: If the family is not known or the address is truncated.
+    """
+    if offset >= len(data):
+        raise ValueError("Connection table entry is truncated", offset)
+    family = data[offset]
+    if family not in FAMILIES:
+        raise ValueError("Unsupported address family in replay log", family)
+
+    socket_family, ip_size = FAMILIES[family]
+    start = offset + FAMILY_STRUCT.size
+    end = start + ip_size + PORT_STRUCT.size
+    if end > len(data):
+        raise ValueError("Connection table entry is truncated", offset)
+    packed = bytes(data[start : start + ip_size])
+    host = socket.inet_ntop(socket_family, packed)
+    (port,) = PORT_STRUCT.unpack_from(data, start + ip_size)
+    return f"{host}:{port:d}", end
+
+
+def decode_addresses(data, start, end):
+    """Decode the payload of an entry in the connection table.
+
+    Args:
+        data (Union[bytes, memoryview, mmap.mmap]): The replay log (or the
+            payload).
+        start (int): The offset of the payload.
+        end (int): The offset just past the end of the payload.
+
+    Returns:
+        Tuple[str, str]: The client address and the server address.
+
+    Raises:
+        ValueError: If the payload is not two encoded addresses.
+    """
+    payload = data[start:end]
+    client_addr, offset = decode_address(payload, 0)
+    server_addr, offset = decode_address(payload, offset)
+    if offset != len(payload):
+        raise ValueError("Connection table entry is corrupt", start)
+    return client_addr, server_addr
@@ -10,61 +10,892 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-
-import queue
+import collections
+import hashlib
+import itertools
+import os
 import struct
 import time
 
+import _display
+import _histogram
+import _index
+import _metrics
+import _replay_format
+import _segments
+import _sinks
+
+
+# Flush the write buffer once it holds this many bytes...
+FLUSH_BYTES = 0x100000
+# ... or once it has held unwritten records for this many seconds.
+FLUSH_INTERVAL = 0.5
+# How often (in seconds) the writer reports its throughput.
+STATS_INTERVAL = 60.0
+# - "never": leave syncing to the OS
+# - "flush": call `fsync()` after every flush of the write buffer
+# - "close": call `fsync()` once, before the replay log is closed
+FSYNC_POLICIES = ("never", "flush", "close")
+TIMESTAMP_STRUCT = struct.Struct(">Q")
+LENGTH_STRUCT = struct.Struct(">I")
+# Requests whose response has been idle (or which have had no response) for
+# this many nanoseconds are no longer paired with later chunks.
+EXCHANGE_IDLE_NS = 60_000_000_000
+# Ids for connections, unique within this process.
+_CONNECTION_IDS = itertools.count()
+# Number of dictionary slots used to deduplicate chunks. A reader holds (at
+# most) one chunk per slot, so this bounds its memory along with
+# ``DEDUP_MAX_CHUNK``.
+DEDUP_ENTRIES = 4096
+# Only chunks of (inclusive) these sizes are deduplicated; a smaller chunk is
+# barely larger than a reference to it.
+DEDUP_MIN_CHUNK = 32
+DEDUP_MAX_CHUNK = 0x4000
+
+
+class Connection:
+    """A proxied connection that log lines are captured from.
+
+    The "client server" address description used in each replay log record
+    is resolved and encoded **once**, when the connection is created, rather
+    than once per captured chunk. (This also means the description doesn't
+    depend on the sockets still being open when the log line is written.)
+    The binary addresses used in the connection table of a version 2 replay
+    log are encoded at the same time. Each connection is also given a small
+    integer id, unique within the current process.
+
+    Args:
+        client_socket (socket.socket): The client socket.
+        server_socket (socket.socket): The (connected) server socket.
+        budget (Optional[_capture_policy.Budget]): The number of bytes that
+            may still be captured for the connection, if limited.
+        framer (Optional[_postgres.MessageFramer]): The framer that splits
+            the client->server stream into capture records, if any.
+    """
+
+    __slots__ = (
+        "client_socket",
+        "server_socket",
+        "description",
+        "addresses",
+        "connection_id",
+        "budget",
+        "framer",
+    )
+
+    def __init__(
+        self, client_socket, server_socket, budget=None, framer=None
+    ):
+        self.connection_id = next(_CONNECTION_IDS)
+        self.budget = budget
+        self.framer = framer
+        self.client_socket = client_socket
+        self.server_socket = server_socket
+        client_ip, client_port = client_socket.getpeername()[:2]
+        server_ip, server_port = server_socket.getpeername()[:2]
+        client_addr = f"{client_ip}:{client_port:d}"
+        server_addr = f"{server_ip}:{server_port:d}"
+        self.description = f"{client_addr} {server_addr} ".encode("ascii")
+        self.addresses = _replay_format.encode_addresses(
+            client_addr, server_addr
+        )
+
+
+class Deduplicator:
+    """Decides how each chunk is stored in a deduplicated replay log.
+
+    Each chunk is identified by a hash of its contents. A chunk seen for the
+    first time is stored in a dictionary slot (``CHUNK_DEFINE``) and a chunk
+    still in the dictionary is stored as a reference to its slot
+    (``CHUNK_REFERENCE``); see :mod:`_replay_format`. Only the hashes are
+    kept (not the chunks), in a least-recently-used order: once every slot
+    is taken, the slot of the least recently used chunk is reused.
+
+    The dictionary starts empty in each replay log file (including each
+    segment), so that every file can be read on its own.
+
+    Args:
+        entries (Optional[int]): The number of dictionary slots.
+    """
+
+    def __init__(self, entries=DEDUP_ENTRIES):
+        self.entries = entries
+        # Maps the hash of each chunk in the dictionary to its slot; the
+        # least recently used chunk is first.
+        self._slots = collections.OrderedDict()
+        self.references = 0
+        self.saved_bytes = 0
+
+    def reset(self):
+        """Empty the dictionary, e.g. at the start of a new file."""
+        self._slots.clear()
+
+    def classify(self, tcp_chunk):
+        """Determine how a chunk is stored, updating the dictionary.
+
+        Args:
+            tcp_chunk (Union[bytes, memoryview]): The captured TCP chunk.
+
+        Returns:
+            Tuple[int, Optional[int]]: The kind of chunk (one of
+            :data:`_replay_format.CHUNK_LITERAL`,
+            :data:`_replay_format.CHUNK_DEFINE` or
+            :data:`_replay_format.CHUNK_REFERENCE`) and its dictionary slot
+            (:data:`None` for a literal chunk).
+        """
+        chunk_size = len(tcp_chunk)
+        if chunk_size < DEDUP_MIN_CHUNK or chunk_size > DEDUP_MAX_CHUNK:
+            return _replay_format.CHUNK_LITERAL, None
+
+        digest = hashlib.blake2b(tcp_chunk, digest_size=16).digest()
+        slot = self._slots.get(digest)
+        if slot is not None:
+            self._slots.move_to_end(digest)
+            self.references += 1
+            self.saved_bytes += chunk_size
+            return _replay_format.CHUNK_REFERENCE, slot
+
+        if len(self._slots) < self.entries:
+            slot = len(self._slots)
+        else:
+            _, slot = self._slots.popitem(last=False)
+        self._slots[digest] = slot
+        return _replay_format.CHUNK_DEFINE, slot
+
+
+class ConnectionTable:
+    """Assigns connection ids in a version 2 replay log.
+
+    Each connection is given the next id (starting from ``0``) the first
+    time it has a record in the current file, at which point its entry in
+    the connection table (see :data:`_replay_format.CONNECTION_ENTRY`) must
+    be written. Like the dictionary of a :class:`Deduplicator`, the table
+    starts empty in each replay log file (including each segment), so that
+    every file can be read on its own.
+    """
+
+    def __init__(self):
+        # Maps the key of each connection in the table to its id.
+        self._ids = {}
+
+    def __len__(self):
+        return len(self._ids)
+
+    def reset(self):
+        """Empty the table, e.g. at the start of a new file."""
+        self._ids.clear()
+
+    def lookup(self, key):
+        """Determine the id of a connection, adding it to the table if new.
+
+        Args:
+            key (Hashable): Identifies the connection, e.g.
+                :attr:`Connection.connection_id`.
+
+        Returns:
+            Tuple[int, bool]: The id of the connection in the current file
+            and an indication if it was just added (i.e. its entry must be
+            written before its first record).
+        """
+        connection_id = self._ids.get(key)
+        if connection_id is not None:
+            return connection_id, False
+
+        connection_id = len(self._ids)
+        self._ids[key] = connection_id
+        return connection_id, True
+
+
+def encode_record_v2(time_ns, connection_id, direction, payload):
+    """Encode a single record of a version 2 replay log.
+
+    Args:
+        time_ns (int): The timestamp (in nanoseconds since the epoch) when
+            the chunk was captured (or the connection first seen).
+        connection_id (int): The id of the connection in the current file.
+        direction (int): The direction the chunk was sent in, or
+            :data:`_replay_format.CONNECTION_ENTRY` for an entry in the
+            connection table.
+        payload (Union[bytes, memoryview]): The captured TCP chunk, or the
+            encoded addresses for an entry in the connection table.
+
+    Returns:
+        bytes: The encoded record.
+    """
+    return (
+        _replay_format.RECORD_V2_STRUCT.pack(
+            time_ns, connection_id, direction, len(payload)
+        )
+        + payload
+    )
+
+
+def encode_chunk(tcp_chunk, kind=None, slot=None):
+    """Encode the part of a "row" after the addresses.
+
+    Args:
+        tcp_chunk (Union[bytes, memoryview]): The captured TCP chunk.
+        kind (Optional[int]): The kind of chunk, for a replay log with
+            :data:`_replay_format.FLAG_DEDUP` set; :data:`None` omits the
+            kind byte.
+        slot (Optional[int]): The dictionary slot of the chunk, unless it is
+            a literal chunk.
+
+    Returns:
+        bytes: The encoded chunk (with its length).
+    """
+    if kind is None:
+        return LENGTH_STRUCT.pack(len(tcp_chunk)) + tcp_chunk
+
+    prefix = _replay_format.KIND_STRUCT.pack(kind)
+    if slot is not None:
+        prefix += _replay_format.SLOT_STRUCT.pack(slot)
+    if kind == _replay_format.CHUNK_REFERENCE:
+        return prefix
+    return prefix + LENGTH_STRUCT.pack(len(tcp_chunk)) + tcp_chunk
+
+
+def encode_record(
+    time_ns,
+    client_addr,
+    server_addr,
+    tcp_chunk,
+    direction=None,
+    deduplicator=None,
+):
+    """Encode a single "row" of the replay log.
+
+    Args:
+        time_ns (int): The timestamp (in nanoseconds since the epoch) when
+            the chunk was captured.
+        client_addr (str): The address (IP and port) of the client socket.
+        server_addr (str): The address (IP and port) of the server socket.
+        tcp_chunk (bytes): The captured TCP chunk.
+        direction (Optional[int]): The direction the chunk was sent in, for
+            a replay log with :data:`_replay_format.FLAG_DIRECTION` set;
+            :data:`None` omits the direction byte.
+        deduplicator (Optional[Deduplicator]): Decides how the chunk is
+            stored, for a replay log with :data:`_replay_format.FLAG_DEDUP`
+            set.
+
+    Returns:
+        bytes: The encoded record.
+    """
+    ts_bytes = TIMESTAMP_STRUCT.pack(time_ns)
+    if direction is not None:
+        ts_bytes += _replay_format.DIRECTION_STRUCT.pack(direction)
+    kind = slot = None
+    if deduplicator is not None:
+        kind, slot = deduplicator.classify(tcp_chunk)
+    description = f"{client_addr} {server_addr}"
+    return (
+        ts_bytes
+        + description.encode("ascii")
+        + b" "
+        + encode_chunk(tcp_chunk, kind, slot)
+    )
+
+
+class _RecordBuffer:
+    """A reusable buffer that replay log records are encoded into.
+
+    Args:
+        output (Union[_segments.PlainOutput, _segments.SegmentedOutput]): The
+            replay log output.
+        fsync_policy (str): One of :data:`FSYNC_POLICIES`.
+        index (bool): Indicates if sidecar index entries should be written
+            for each record.
+        directions (bool): Indicates if each record has a direction byte
+            (i.e. :data:`_replay_format.FLAG_DIRECTION` is set).
+        deduplicator (Optional[Deduplicator]): Decides how each chunk is
+            stored, if :data:`_replay_format.FLAG_DEDUP` is set.
+        header_size (Optional[int]): The size of the header at the start of
+            each replay log file; the dictionary of ``deduplicator`` (and
+            ``connections``) is emptied at the start of each file.
+        connections (Optional[ConnectionTable]): Assigns connection ids, if
+            records are encoded in the version 2 format.
+    """
+
+    def __init__(
+        self,
+        output,
+        fsync_policy,
+        index,
+        directions,
+        deduplicator=None,
+        header_size=0,
+        connections=None,
+    ):
+        self.output = output
+        self.fsync_policy = fsync_policy
+        self.directions = directions
+        self.deduplicator = deduplicator
+        self.header_size = header_size
+        self.connections = connections
+        # Index entries for the buffered records, with offsets relative to
+        # the start of the buffer.
+        self.index_entries = [] if index else None
+        self.buffer = bytearray(FLUSH_BYTES)
+        self.view = memoryview(self.buffer)
+        self.position = 0
+        self.first_ts = None
+        self.last_ts = None
+        self.count = 0
+        self.last_flush = time.monotonic()
+        self.flush_at = self._flush_limit()
+
+    def _flush_limit(self):
+        """Determine the buffer position that triggers a flush.
+
+        If the output rotates by size, the buffer is flushed as soon as it
+        holds enough to fill the current segment, so that a segment only
+        exceeds ``segment_bytes`` by (at most) one record.
+
+        Returns:
+            int: The position in the buffer.
+        """
+        room = self.output.room()
+        if room is None:
+            return len(self.buffer)
+        return max(room, 1)
+
+    def append(self, time_ns, connection, tcp_chunk, direction):
+        """Encode a record into the buffer.
+
+        Args:
+            time_ns (int): The timestamp (in nanoseconds since the epoch)
+                when the chunk was captured.
+            connection (Connection): The connection the chunk was captured
+                from.
+            tcp_chunk (bytes): The captured TCP chunk.
+            direction (int): The direction the chunk was sent in; ignored
+                unless the records have a direction byte.
 
-# Block a `get()` from the queue for 2 seconds.
-QUEUE_GET_TIMEOUT = 2.0
-QUEUE_EMPTY = object()  # Sentinel
+        Returns:
+            int: The size of the encoded record.
+        """
+        if self.connections is not None:
+            return self._append_v2(time_ns, connection, tcp_chunk, direction)
 
+        description = connection.description
+        chunk_size = len(tcp_chunk)
+        header_size = (
+            TIMESTAMP_STRUCT.size
+            + self.directions
+            + len(description)
+            + LENGTH_STRUCT.size
+        )
+        deduplicator = self.deduplicator
+        if deduplicator is not None:
+            # NOTE: Until the chunk is classified, assume it is stored in
+            #       full (the largest it can be).
+            header_size += (
+                _replay_format.KIND_STRUCT.size
+                + _replay_format.SLOT_STRUCT.size
+            )
+        record_size = header_size + chunk_size
+        if self.position + record_size > len(self.buffer):
+            self.flush()
+
+        kind = slot = None
+        if deduplicator is not None:
+            if self.position == 0 and self.output.offset == self.header_size:
+                # Nothing has been written to the current file (or segment)
+                # yet, so it starts with an empty dictionary.
+                deduplicator.reset()
+            kind, slot = deduplicator.classify(tcp_chunk)
+            if slot is None:
+                header_size -= _replay_format.SLOT_STRUCT.size
+            if kind == _replay_format.CHUNK_REFERENCE:
+                header_size -= LENGTH_STRUCT.size
+                chunk_size = 0
+            record_size = header_size + chunk_size
+
+        if record_size > len(self.buffer):
+            # Too large for the buffer; write it directly.
+            if self.index_entries is not None:
+                self.output.write_index(
+                    _index.ENTRY_STRUCT.pack(
+                        self.output.offset, time_ns, connection.connection_id
+                    )
+                )
+            ts_bytes = TIMESTAMP_STRUCT.pack(time_ns)
+            if self.directions:
+                ts_bytes += _replay_format.DIRECTION_STRUCT.pack(direction)
+            self._write(ts_bytes + description)
+            self._write(encode_chunk(tcp_chunk, kind, slot))
+            self.output.end_batch(time_ns, time_ns, 1)
+            self.flush_at = self._flush_limit()
+            return record_size
+
+        position = self.position
+        if self.index_entries is not None:
+            self.index_entries.append(
+                (position, time_ns, connection.connection_id)
+            )
+        TIMESTAMP_STRUCT.pack_into(self.buffer, position, time_ns)
+        position += TIMESTAMP_STRUCT.size
+        if self.directions:
+            self.buffer[position] = direction
+            position += 1
+        self.buffer[position : position + len(description)] = description
+        position += len(description)
+        if kind is not None:
+            self.buffer[position] = kind
+            position += 1
+            if slot is not None:
+                _replay_format.SLOT_STRUCT.pack_into(
+                    self.buffer, position, slot
+                )
+                position += _replay_format.SLOT_STRUCT.size
+        if kind != _replay_format.CHUNK_REFERENCE:
+            LENGTH_STRUCT.pack_into(self.buffer, position, chunk_size)
+            position += LENGTH_STRUCT.size
+            self.buffer[position : position + chunk_size] = tcp_chunk
+        self.position = position + chunk_size
+        self._appended(time_ns)
+        return record_size
+
+    def _append_v2(self, time_ns, connection, tcp_chunk, direction):
+        """Encode a version 2 record (and connection entry) into the buffer.
+
+        Returns:
+            int: The size of the encoded record(s).
+        """
+        record_struct = _replay_format.RECORD_V2_STRUCT
+        addresses = connection.addresses
+        chunk_size = len(tcp_chunk)
+        # NOTE: Until the connection is looked up, assume its entry in the
+        #       connection table must be written first.
+        record_size = 2 * record_struct.size + len(addresses) + chunk_size
+        if self.position + record_size > len(self.buffer):
+            self.flush()
+
+        connections = self.connections
+        if self.position == 0 and self.output.offset == self.header_size:
+            # Nothing has been written to the current file (or segment) yet,
+            # so it starts with an empty connection table.
+            connections.reset()
+        connection_id, is_new = connections.lookup(connection.connection_id)
+        entry = b""
+        if is_new:
+            entry = encode_record_v2(
+                time_ns,
+                connection_id,
+                _replay_format.CONNECTION_ENTRY,
+                addresses,
+            )
+        record_size = len(entry) + record_struct.size + chunk_size
+
+        if record_size > len(self.buffer):
+            # Too large for the buffer; write it directly.
+            if self.index_entries is not None:
+                self.output.write_index(
+                    _index.ENTRY_STRUCT.pack(
+                        self.output.offset + len(entry),
+                        time_ns,
+                        connection_id,
+                    )
+                )
+            self._write(
+                entry
+                + record_struct.pack(
+                    time_ns, connection_id, direction, chunk_size
+                )
+            )
+            self._write(tcp_chunk)
+            self.output.end_batch(time_ns, time_ns, 1)
+            self.flush_at = self._flush_limit()
+            return record_size
+
+        position = self.position
+        if entry:
+            self.buffer[position : position + len(entry)] = entry
+            position += len(entry)
+        if self.index_entries is not None:
+            self.index_entries.append((position, time_ns, connection_id))
+        record_struct.pack_into(
+            self.buffer,
+            position,
+            time_ns,
+            connection_id,
+            direction,
+            chunk_size,
+        )
+        position += record_struct.size
+        self.buffer[position : position + chunk_size] = tcp_chunk
+        self.position = position + chunk_size
+        self._appended(time_ns)
+        return record_size
+
+    def _appended(self, time_ns):
+        if self.count == 0:
+            self.first_ts = time_ns
+        self.last_ts = time_ns
+        self.count += 1
+        if self.position >= self.flush_at:
+            self.flush()
+
+    def _write(self, data):
+        view = memoryview(data)
+        while view:
+            view = view[self.output.write(view) :]
+
+    def _write_index(self):
+        base_offset = self.output.offset
+        self.output.write_index(
+            b"".join(
+                _index.ENTRY_STRUCT.pack(
+                    base_offset + position, time_ns, connection_id
+                )
+                for position, time_ns, connection_id in self.index_entries
+            )
+        )
+        self.index_entries.clear()
+
+    def due(self):
+        """Determine if the buffer should be flushed.
+
+        Returns:
+            bool: Indicates if the buffer holds ``FLUSH_BYTES`` or has held
+            unwritten records for ``FLUSH_INTERVAL`` seconds.
+        """
+        if self.position == 0:
+            return False
+        if self.position >= FLUSH_BYTES:
+            return True
+        return time.monotonic() - self.last_flush >= FLUSH_INTERVAL
+
+    def flush(self):
+        """Write the contents of the buffer to the file."""
+        if self.position > 0:
+            if self.index_entries:
+                self._write_index()
+            self._write(self.view[: self.position])
+            self.position = 0
+            if self.fsync_policy == "flush":
+                os.fsync(self.output.fileno())
+            self.output.end_batch(self.first_ts, self.last_ts, self.count)
+            self.count = 0
+            self.flush_at = self._flush_limit()
+        self.last_flush = time.monotonic()
+
+
+class _ExchangeTimer:
+    """Pairs each request on a connection with the response to it.
+
+    A request starts with the first client->server chunk on a connection (or
+    the first one after a response) and its response is every
+    server->client chunk until the next request. Both timestamps are taken
+    by the proxy, so the latencies are those of the upstream server (plus
+    the network between the proxy and the server) as observed by the proxy.
+    """
+
+    def __init__(self):
+        # Maps a connection id to ``[request_ns, first_ns, last_ns]`` for the
+        # current request and its response (if any) on the connection.
+        self.exchanges = {}
+        self.time_to_first_byte = _histogram.Histogram()
+        self.response_time = _histogram.Histogram()
+
+    def observe(self, connection, time_ns, direction):
+        """Observe a captured chunk.
+
+        Args:
+            connection (Connection): The connection the chunk was captured
+                from.
+            time_ns (int): The timestamp when the chunk was captured.
+            direction (int): The direction the chunk was sent in.
+        """
+        exchange = self.exchanges.get(connection.connection_id)
+        if direction == _replay_format.CLIENT_TO_SERVER:
+            if exchange is None:
+                self.exchanges[connection.connection_id] = [
+                    time_ns,
+                    None,
+                    None,
+                ]
+            elif exchange[1] is not None:
+                self._complete(exchange)
+                exchange[:] = time_ns, None, None
+            # Otherwise, this is more of the current request.
+        elif exchange is not None:
+            if exchange[1] is None:
+                exchange[1] = time_ns
+            exchange[2] = time_ns
+        # Otherwise, the server spoke first (e.g. a greeting); there is no
+        # request to pair it with.
+
+    def _complete(self, exchange):
+        request_ns, first_ns, last_ns = exchange
+        self.time_to_first_byte.record(first_ns - request_ns)
+        self.response_time.record(last_ns - request_ns)
+
+    def expire(self, now_ns):
+        """Stop tracking connections that have been idle for a while.
+
+        A response that has been idle for ``EXCHANGE_IDLE_NS`` is assumed to
+        be complete; a request that is still waiting for a response after
+        ``EXCHANGE_IDLE_NS`` is discarded.
+
+        Args:
+            now_ns (int): The current time (in nanoseconds since the epoch).
+        """
+        cutoff = now_ns - EXCHANGE_IDLE_NS
+        for connection_id, exchange in list(self.exchanges.items()):
+            if exchange[1] is None:
+                if exchange[0] < cutoff:
+                    del self.exchanges[connection_id]
+            elif exchange[2] < cutoff:
+                self._complete(exchange)
+                del self.exchanges[connection_id]
+
+    def complete_all(self):
+        """Complete every exchange that has (part of) a response."""
+        for exchange in self.exchanges.values():
+            if exchange[1] is not None:
+                self._complete(exchange)
+        self.exchanges.clear()
+
+    def display(self):
+        """Display the latency percentiles (in milliseconds)."""
+        for name, histogram in (
+            ("time to first byte", self.time_to_first_byte),
+            ("full response", self.response_time),
+        ):
+            summary = histogram.summary(scale=1e6)
+            details = ", ".join(
+                f"{key}={value:.3f}ms"
+                for key, value in summary.items()
+                if key != "count"
+            )
+            _display.display(
+                f"Upstream {name}: {summary['count']} responses; {details}"
+            )
+
+
+def _display_stats(records, num_bytes, elapsed):
+    elapsed = max(elapsed, 1e-9)
+    _display.display(
+        f"Replay log writer: {records} records ({records / elapsed:.1f}/s), "
+        f"{num_bytes} bytes ({num_bytes / elapsed:.1f} B/s)"
+    )
+
+
+def _display_dedup_stats(deduplicator):
+    _display.display(
+        f"Replay log writer: {deduplicator.references} repeated chunks "
+        f"stored as references, saving {deduplicator.saved_bytes} bytes"
+    )
+
+
+class ReplayLogSink(_sinks.Sink):
+    """A sink that saves log lines to a replay log file.
+
+    Log lines are encoded into a reusable buffer, which is written to the
+    file in one large write once it holds ``FLUSH_BYTES`` or has held
+    records for ``FLUSH_INTERVAL`` seconds. The records / bytes written per
+    second are displayed every ``STATS_INTERVAL`` seconds and when the sink
+    is closed.
+
+    If any of ``segment_bytes``, ``segment_seconds`` or ``compression`` is
+    set, the replay log is written as a series of segments (see
+    :class:`_segments.SegmentedOutput`) rather than a single file. If
+    ``index`` is set, a sidecar index (see :mod:`_index`) is written next to
+    the replay log (or next to each segment).
 
-def _queue_get(queue_, timeout):
-    try:
-        return queue_.get(block=True, timeout=timeout)
-    except queue.Empty:
-        return QUEUE_EMPTY
+    If ``capture_responses`` is set, the replay log (and each segment)
+    starts with a header setting :data:`_replay_format.FLAG_DIRECTION` and
+    each record has a direction byte. Each request is also paired with its
+    response to measure upstream latency; the time to first byte and full
+    response time percentiles are displayed along with the throughput.
 
+    If ``dedup`` is set, the replay log (and each segment) starts with a
+    header setting :data:`_replay_format.FLAG_DEDUP` and a chunk repeated
+    while it is still in the dictionary of a :class:`Deduplicator` is only
+    stored once; the number of bytes saved is displayed along with the
+    throughput.
 
-def save_log_worker(filename, log_queue, done_event):
+    If ``version`` is :data:`_replay_format.VERSION_2`, each record is
+    written with a fixed-width header and a connection id (see
+    :mod:`_replay_format`); the connection table entry for each connection
+    is written before its first record in each file (or segment).
+
+    Args:
+        filename (pathlib.Path): The file where the replay log will be written.
+        fsync_policy (Optional[str]): When to ``fsync()`` the replay log; one
+            of :data:`FSYNC_POLICIES`.
+        segment_bytes (Optional[int]): The size at which to rotate segments.
+        segment_seconds (Optional[float]): The age at which to rotate
+            segments.
+        compression (Optional[str]): The compression applied to closed
+            segments; a key in :data:`_segments.COMPRESSIONS`.
+        index (Optional[bool]): Indicates if a sidecar index should be
+            written.
+        capture_responses (Optional[bool]): Indicates if the log lines
+            include server->client chunks.
+        dedup (Optional[bool]): Indicates if repeated chunks should only be
+            stored once.
+        version (Optional[int]): The format version of the replay log; one
+            of :data:`_replay_format.VERSIONS`.
+
+    Raises:
+        ValueError: If ``version`` is not one of
+            :data:`_replay_format.VERSIONS`.
+        ValueError: If ``dedup`` is set for a version 2 replay log.
+    """
+
+    def __init__(
+        self,
+        filename,
+        fsync_policy="never",
+        segment_bytes=None,
+        segment_seconds=None,
+        compression=None,
+        index=False,
+        capture_responses=False,
+        dedup=False,
+        version=_replay_format.VERSION,
+    ):
+        if version not in _replay_format.VERSIONS:
+            raise ValueError(
+                f"Unsupported replay log version {version!r}",
+                _replay_format.VERSIONS,
+            )
+        if dedup and version == _replay_format.VERSION_2:
+            raise ValueError(
+                "Version 2 replay logs can't be deduplicated", version
+            )
+
+        self.filename = filename
+        self.fsync_policy = fsync_policy
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.compression = compression
+        self.index = index
+        self.capture_responses = capture_responses
+        self.dedup = dedup
+        self.version = version
+        self.records = 0
+        self.num_bytes = 0
+        self.output = None
+        self.record_buffer = None
+        self.exchange_timer = None
+        self.deduplicator = None
+        self._start = None
+        self._last_stats = None
+
+    def start(self):
+        """Open the replay log (or its first segment)."""
+        self._start = time.monotonic()
+        self._last_stats = self._start
+        flags = 0
+        if self.capture_responses:
+            flags |= _replay_format.FLAG_DIRECTION
+            self.exchange_timer = _ExchangeTimer()
+        if self.dedup:
+            flags |= _replay_format.FLAG_DEDUP
+            self.deduplicator = Deduplicator()
+        connections = None
+        if self.version == _replay_format.VERSION_2:
+            connections = ConnectionTable()
+        header = _replay_format.encode_header(flags, self.version)
+        self.output = _segments.open_output(
+            self.filename,
+            self.fsync_policy != "never",
+            segment_bytes=self.segment_bytes,
+            segment_seconds=self.segment_seconds,
+            compression=self.compression,
+            index=self.index,
+            header=header,
+        )
+        self.record_buffer = _RecordBuffer(
+            self.output,
+            self.fsync_policy,
+            self.index,
+            self.capture_responses,
+            deduplicator=self.deduplicator,
+            header_size=len(header),
+            connections=connections,
+        )
+
+    def write_batch(self, batch):
+        """Encode a batch of log lines into the write buffer.
+
+        Args:
+            batch (List[Tuple[int, bytes, Connection, int]]): The log lines.
+        """
+        batch_bytes = 0
+        for time_ns, tcp_chunk, connection, direction in batch:
+            batch_bytes += self.record_buffer.append(
+                time_ns, connection, tcp_chunk, direction
+            )
+            if self.exchange_timer is not None:
+                self.exchange_timer.observe(connection, time_ns, direction)
+        self.records += len(batch)
+        self.num_bytes += batch_bytes
+        _metrics.RECORDS_WRITTEN.inc(len(batch))
+        _metrics.BYTES_WRITTEN.inc(batch_bytes)
+
+    def timeout(self):
+        """Determine how long buffered records may wait to be written.
+
+        Returns:
+            Optional[float]: ``FLUSH_INTERVAL`` if any records are buffered,
+            otherwise :data:`None`.
+        """
+        if self.record_buffer.position > 0:
+            return FLUSH_INTERVAL
+        return None
+
+    def poll(self):
+        """Flush the write buffer (or rotate segments) and report stats."""
+        if self.record_buffer.due():
+            self.record_buffer.flush()
+        elif self.record_buffer.position == 0:
+            # Nothing buffered, so this is a record boundary.
+            self.output.maybe_rotate()
+
+        now = time.monotonic()
+        if now - self._last_stats >= STATS_INTERVAL:
+            self._display_stats(now)
+            if self.exchange_timer is not None:
+                self.exchange_timer.expire(time.time_ns())
+                self.exchange_timer.display()
+            self._last_stats = now
+
+    def _display_stats(self, now):
+        _display_stats(self.records, self.num_bytes, now - self._start)
+        if self.deduplicator is not None:
+            _display_dedup_stats(self.deduplicator)
+
+    def close(self):
+        """Flush the write buffer, close the replay log and report stats."""
+        try:
+            self.record_buffer.flush()
+        finally:
+            self.output.close()
+
+        self._display_stats(time.monotonic())
+        if self.exchange_timer is not None:
+            self.exchange_timer.complete_all()
+            self.exchange_timer.display()
+
+
+def save_log_worker(filename, log_queue, done_event, **kwargs):
     """Worker to save log messages from a queue to a file.
 
     This is intended to be launched in a thread to avoid blocking socket
-    I/O with the requisite file I/O.
+    I/O with the requisite file I/O. Log lines are taken from the queue in
+    batches and written by a :class:`ReplayLogSink`.
 
     Args:
         filename (pathlib.Path): The file where the replay log will be written.
         log_queue (queue.Queue): The queue where log lines will be pushed.
         done_event (threading.Event): An event indicating the proxy that is
             generating log lines is done.
+        kwargs (Dict[str, Any]): Keyword arguments for
+            :class:`ReplayLogSink`.
     """
-    with open(filename, "wb") as file_obj:
-        while True:
-            if done_event.is_set() and log_queue.empty():
-                return
-
-            value = _queue_get(log_queue, QUEUE_GET_TIMEOUT)
-            if value is QUEUE_EMPTY:
-                continue
-
-            # NOTE: We assume items in the queue are of type
-            #       `Tuple[int, bytes, socket.socket, socket.socket]`.
-            time_ns, tcp_chunk, client_socket, server_socket = value
-            client_ip, client_port = client_socket.getpeername()
-            server_ip, server_port = server_socket.getpeername()
-
-            ts_bytes = struct.pack(">Q", time_ns)
-            chunk_length = struct.pack(">I", len(tcp_chunk))
-            description = (
-                f"{client_ip}:{client_port:d} {server_ip}:{server_port:d}"
-            )
-            log_line = (
-                ts_bytes
-                + description.encode("ascii")
-                + b" "
-                + chunk_length
-                + tcp_chunk
-            )
-            file_obj.write(log_line)
+    sink = ReplayLogSink(filename, **kwargs)
+    _sinks.run_sinks([sink], log_queue, done_event)
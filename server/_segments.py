@@ -0,0 +1,410 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import json
+import lzma
+import os
+import pathlib
+import queue
+import shutil
+import threading
+import time
+
+import _display
+import _index
+
+
+# Streaming compression (applied to closed segments) keyed by name, along
+# with the file extension added to a compressed segment.
+COMPRESSIONS = {
+    "gzip": (".gz", gzip.open),
+    "lzma": (".xz", lzma.open),
+}
+MANIFEST_VERSION = 1
+# Size of the reads / writes used when compressing a segment.
+COMPRESS_CHUNK_SIZE = 0x100000
+
+
+def manifest_filename(replay_log):
+    """Determine the manifest file for a segmented replay log.
+
+    Args:
+        replay_log (pathlib.Path): The replay log.
+
+    Returns:
+        pathlib.Path: The manifest file.
+    """
+    replay_log = pathlib.Path(replay_log)
+    return replay_log.with_name(f"{replay_log.name}.manifest.json")
+
+
+class PlainOutput:
+    """Replay log output written to a single (unbounded) file.
+
+    Args:
+        filename (pathlib.Path): The file where the replay log will be written.
+        fsync (bool): Indicates if the file should be synced before it is
+            closed.
+        index (bool): Indicates if a sidecar index should be written.
+        header (bytes): The replay log header (possibly empty), written
+            before any records.
+    """
+
+    def __init__(self, filename, fsync, index, header):
+        self.file_obj = open(filename, "wb", buffering=0)
+        self.file_obj.write(header)
+        self.fsync = fsync
+        self.offset = len(header)
+        self.index_obj = None
+        if index:
+            self.index_obj = open(_index.index_filename(filename), "wb")
+            self.index_obj.write(_index.HEADER)
+
+    def write(self, data):
+        """Write (part of) a sequence of records.
+
+        Args:
+            data (Union[bytes, memoryview]): The encoded records.
+
+        Returns:
+            int: The number of bytes written.
+        """
+        bytes_written = self.file_obj.write(data)
+        self.offset += bytes_written
+        return bytes_written
+
+    def write_index(self, data):
+        """Write sidecar index entries.
+
+        Args:
+            data (bytes): The encoded index entries.
+        """
+        if self.index_obj is not None:
+            self.index_obj.write(data)
+
+    def end_batch(self, first_ts, last_ts, count):
+        """Mark the end of a sequence of whole records.
+
+        Args:
+            first_ts (int): The timestamp of the first record.
+            last_ts (int): The timestamp of the last record.
+            count (int): The number of records.
+        """
+
+    def room(self):
+        """Determine how many bytes can be written before rotation is due.
+
+        Returns:
+            Optional[int]: Always :data:`None`; a single file never rotates.
+        """
+        return None
+
+    def maybe_rotate(self):
+        """Rotate the output, if due; a single file never rotates."""
+
+    def fileno(self):
+        return self.file_obj.fileno()
+
+    def close(self):
+        if self.fsync:
+            os.fsync(self.file_obj.fileno())
+        self.file_obj.close()
+        if self.index_obj is not None:
+            self.index_obj.close()
+
+
+class SegmentedOutput:
+    """Replay log output written to a series of segment files.
+
+    Segments are named ``{replay_log}.00000``, ``{replay_log}.00001``, etc.
+    and a new segment is started (at a record boundary) once the current one
+    holds ``segment_bytes`` or has been open for ``segment_seconds``.
+    Closed segments are compressed by a background thread (so compression
+    never runs on the thread draining the capture buffer) and a manifest
+    listing every segment with its first / last timestamps is kept up to
+    date next to the segments. A sidecar index is (optionally) written for
+    each segment; its offsets are into the **uncompressed** segment.
+
+    Args:
+        filename (pathlib.Path): The replay log; used as the prefix for
+            segment (and manifest) filenames.
+        segment_bytes (Optional[int]): The size at which to rotate segments.
+        segment_seconds (Optional[float]): The age at which to rotate
+            segments.
+        compression (Optional[str]): A key in :data:`COMPRESSIONS`.
+        fsync (bool): Indicates if each segment should be synced before it
+            is closed.
+        index (bool): Indicates if a sidecar index should be written for
+            each segment.
+        header (bytes): The replay log header (possibly empty), written at
+            the start of each segment.
+    """
+
+    def __init__(
+        self,
+        filename,
+        segment_bytes,
+        segment_seconds,
+        compression,
+        fsync,
+        index,
+        header,
+    ):
+        self.filename = pathlib.Path(filename)
+        self.manifest = manifest_filename(self.filename)
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.compression = compression
+        self.fsync = fsync
+        self.index = index
+        self.header = header
+        self.segments = []
+        self.file_obj = None
+        self.index_obj = None
+        self.opened_at = None
+        self._lock = threading.Lock()
+        self._compress_queue = None
+        self._compress_thread = None
+        if compression is not None:
+            self._compress_queue = queue.Queue()
+            self._compress_thread = threading.Thread(
+                target=self._compress_worker
+            )
+            self._compress_thread.start()
+        self._write_manifest()
+
+    def _segment_path(self, index):
+        return self.filename.with_name(f"{self.filename.name}.{index:05d}")
+
+    def _open_segment(self):
+        index = len(self.segments)
+        path = self._segment_path(index)
+        self.file_obj = open(path, "wb", buffering=0)
+        self.file_obj.write(self.header)
+        index_path = None
+        if self.index:
+            index_path = _index.index_filename(path)
+            self.index_obj = open(index_path, "wb")
+            self.index_obj.write(_index.HEADER)
+        self.opened_at = time.monotonic()
+        with self._lock:
+            self.segments.append(
+                {
+                    "filename": path.name,
+                    "index": None if index_path is None else index_path.name,
+                    "compression": None,
+                    "records": 0,
+                    "bytes": len(self.header),
+                    "first_timestamp_ns": None,
+                    "last_timestamp_ns": None,
+                    "closed": False,
+                }
+            )
+
+    def write(self, data):
+        """Write (part of) a sequence of records to the current segment.
+
+        Args:
+            data (Union[bytes, memoryview]): The encoded records.
+
+        Returns:
+            int: The number of bytes written.
+        """
+        if self.file_obj is None:
+            self._open_segment()
+        bytes_written = self.file_obj.write(data)
+        self.segments[-1]["bytes"] += bytes_written
+        return bytes_written
+
+    @property
+    def offset(self):
+        """int: The number of bytes written to the current segment.
+
+        If no segment is open, this is the size of the header, since the
+        next write will start a new segment (which begins with the header).
+        """
+        if self.file_obj is None:
+            return len(self.header)
+        return self.segments[-1]["bytes"]
+
+    def write_index(self, data):
+        """Write sidecar index entries for the current segment.
+
+        Args:
+            data (bytes): The encoded index entries.
+        """
+        if not self.index:
+            return
+        if self.file_obj is None:
+            self._open_segment()
+        self.index_obj.write(data)
+
+    def end_batch(self, first_ts, last_ts, count):
+        """Mark the end of a sequence of whole records.
+
+        Since this is a record boundary, the current segment is rotated here
+        if it is due.
+
+        Args:
+            first_ts (int): The timestamp of the first record.
+            last_ts (int): The timestamp of the last record.
+            count (int): The number of records.
+        """
+        segment = self.segments[-1]
+        with self._lock:
+            if segment["first_timestamp_ns"] is None:
+                segment["first_timestamp_ns"] = first_ts
+            segment["last_timestamp_ns"] = last_ts
+            segment["records"] += count
+        self.maybe_rotate()
+
+    def room(self):
+        """Determine how many bytes can be written before rotation is due.
+
+        Returns:
+            Optional[int]: The number of bytes left before the current (or
+            next) segment reaches ``segment_bytes``, or :data:`None` if
+            segments aren't rotated by size.
+        """
+        if self.segment_bytes is None:
+            return None
+        return self.segment_bytes - self.offset
+
+    def maybe_rotate(self):
+        """Close the current segment if it is due for rotation.
+
+        This must only be called at a record boundary.
+        """
+        if self.file_obj is None:
+            return
+
+        segment = self.segments[-1]
+        if (
+            self.segment_bytes is not None
+            and segment["bytes"] >= self.segment_bytes
+        ):
+            self._close_segment()
+        elif (
+            self.segment_seconds is not None
+            and time.monotonic() - self.opened_at >= self.segment_seconds
+        ):
+            self._close_segment()
+
+    def fileno(self):
+        if self.file_obj is None:
+            self._open_segment()
+        return self.file_obj.fileno()
+
+    def _close_segment(self):
+        if self.fsync:
+            os.fsync(self.file_obj.fileno())
+        self.file_obj.close()
+        self.file_obj = None
+        if self.index_obj is not None:
+            self.index_obj.close()
+            self.index_obj = None
+        index = len(self.segments) - 1
+        with self._lock:
+            self.segments[index]["closed"] = True
+        self._write_manifest()
+        if self._compress_queue is not None:
+            self._compress_queue.put(index)
+
+    def _compress_worker(self):
+        extension, open_func = COMPRESSIONS[self.compression]
+        while True:
+            index = self._compress_queue.get()
+            if index is None:
+                return
+
+            source = self._segment_path(index)
+            target = source.with_name(source.name + extension)
+            partial = target.with_name(target.name + ".partial")
+            with open(source, "rb") as src_obj:
+                with open_func(partial, "wb") as dst_obj:
+                    shutil.copyfileobj(src_obj, dst_obj, COMPRESS_CHUNK_SIZE)
+            os.replace(partial, target)
+            with self._lock:
+                segment = self.segments[index]
+                segment["filename"] = target.name
+                segment["compression"] = self.compression
+                segment["compressed_bytes"] = target.stat().st_size
+            self._write_manifest()
+            source.unlink()
+
+    def _write_manifest(self):
+        with self._lock:
+            contents = json.dumps(
+                {"version": MANIFEST_VERSION, "segments": self.segments},
+                indent=2,
+            )
+            partial = self.manifest.with_name(self.manifest.name + ".partial")
+            partial.write_text(contents + "\n")
+            os.replace(partial, self.manifest)
+
+    def close(self):
+        """Close the current segment and wait for compression to finish."""
+        if self.file_obj is not None:
+            self._close_segment()
+        if self._compress_thread is not None:
+            _display.display("Waiting for replay log segments to compress...")
+            self._compress_queue.put(None)
+            self._compress_thread.join()
+        self._write_manifest()
+
+
+def open_output(
+    filename,
+    fsync,
+    segment_bytes=None,
+    segment_seconds=None,
+    compression=None,
+    index=False,
+    header=b"",
+):
+    """Open the output for a replay log.
+
+    Args:
+        filename (pathlib.Path): The file where the replay log will be written.
+        fsync (bool): Indicates if files should be synced before they are
+            closed.
+        segment_bytes (Optional[int]): The size at which to rotate segments.
+        segment_seconds (Optional[float]): The age at which to rotate
+            segments.
+        compression (Optional[str]): A key in :data:`COMPRESSIONS`.
+        index (Optional[bool]): Indicates if a sidecar index should be
+            written.
+        header (Optional[bytes]): The replay log header, written at the
+            start of the replay log (or each segment).
+
+    Returns:
+        Union[PlainOutput, SegmentedOutput]: A segmented output if any of
+        ``segment_bytes``, ``segment_seconds`` or ``compression`` is set,
+        otherwise a single file.
+    """
+    if (
+        segment_bytes is None
+        and segment_seconds is None
+        and compression is None
+    ):
+        return PlainOutput(filename, fsync, index, header)
+
+    return SegmentedOutput(
+        filename,
+        segment_bytes,
+        segment_seconds,
+        compression,
+        fsync,
+        index,
+        header,
+    )
@@ -10,142 +10,1320 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import queue
+import asyncio
+import multiprocessing
+import os
+import pathlib
 import select
+import signal
 import socket
+import struct
 import threading
 import time
 
+import _async_connect
+import _buffer
+import _capture_buffer
+import _capture_policy
 import _connect
 import _display
+import _index
 import _keepalive
+import _merge_replay_log
+import _metrics
+import _replay_format
 import _save_replay_log
+import _sinks
+import _segments
+import _tls
+import _upstream_pool
+import _upstreams
 
 
 PROXY_HOST = "0.0.0.0"
-BACKLOG = 5
+# Length of the accept queue for the listening socket. The kernel caps this at
+# ``net.core.somaxconn`` (4096 by default on Linux 5.4+).
+BACKLOG = 1024
+# Maximum number of connections accepted each time the listening socket is
+# readable, before finished handlers are reaped.
+ACCEPT_BATCH = 128
 KEEP_ALIVE_INTERVAL = 180  # 3 minutes, in seconds
-# Number of log lines to write before puts to queue will block
-QUEUE_BUFFER = 256
+# Number of bytes of log lines held in memory before the capture overflow
+# policy applies.
+CAPTURE_BUFFER_BYTES = 0x4000000
+ENGINES = ("threads", "asyncio")
+# Maximum number of connections handled concurrently (per process). Each
+# connection holds two sockets and a wakeup eventfd (plus two pipes per
+# spliced direction), so this may need a higher ``RLIMIT_NOFILE``
+# (``ulimit -n``) than the default.
+MAX_CONNECTIONS = 1024
+# What to do with a new connection when ``MAX_CONNECTIONS`` are active:
+# - "queue": stop accepting until a handler finishes (new connections wait
+#   in the listen backlog)
+# - "reject": accept the connection and immediately close it
+OVERFLOW_POLICIES = ("queue", "reject")
+# Time (in seconds) that active connections are given to finish on their own
+# when the proxy is stopped, before they are closed.
+SHUTDOWN_TIMEOUT = 10.0
+# For a listening socket, ``tcpi_unacked`` and ``tcpi_sacked`` in Linux's
+# ``struct tcp_info`` are the length and limit of the accept queue; they
+# follow 8 one-byte fields and 4 ``u32`` fields.
+TCP_INFO_QUEUE = struct.Struct("=8x16xII")
+NETSTAT_PATH = pathlib.Path("/proc/net/netstat")
 
 
-def accept(non_blocking_socket):
-    """Accept a connection on a non-blocking socket.
+def accept_pending(non_blocking_socket, max_batch=ACCEPT_BATCH):
+    """Accept the connections waiting on a non-blocking listening socket.
 
-    Since the socket is non-blocking, a **blocking** call to
-    ``select.select()`` is used to wait until the socket is ready.
+    This should be called once the socket is readable; connections are
+    accepted until none are left (or ``max_batch`` have been accepted), so a
+    burst of connections costs a single wait rather than one per connection.
 
-    Args:
-        non_blocking_socket (socket.socket): A socket that will block to accept
-            a connection.
+    Each accepted socket is returned as-is; setting it up (e.g.
+    ``setup_client_socket()``) is left to its handler, so that the accept
+    loop only accepts.
 
-    Returns:
-       Tuple[socket.socket, str]: A pair of:
-       * The socket of the client connection that was accepted
-       * The address (IP and port) of the client socket
+    Args:
+        non_blocking_socket (socket.socket): A non-blocking listening socket.
+        max_batch (Optional[int]): The maximum number of connections to
+            accept.
 
-    Raises:
-        ValueError: If ``non_blocking_socket`` is not readable after
-            ``select.select()`` returns.
+    Yields:
+        Tuple[socket.socket, str]: A pair of:
+        * The socket of the client connection that was accepted
+        * The address (IP and port) of the client socket
     """
-    readable, _, _ = select.select([non_blocking_socket], [], [])
-    if readable != [non_blocking_socket]:
-        raise ValueError("Socket not ready to accept connections")
+    for _ in range(max_batch):
+        try:
+            client_socket, (ip_addr, port) = non_blocking_socket.accept()
+        except BlockingIOError:
+            return
+        except ConnectionAbortedError:
+            # The client reset the connection while it was in the accept
+            # queue.
+            continue
+        yield client_socket, f"{ip_addr}:{port}"
 
-    client_socket, (ip_addr, port) = non_blocking_socket.accept()
+
+def setup_client_socket(client_socket):
+    """Set up an accepted client socket to be relayed.
+
+    Args:
+        client_socket (socket.socket): The socket of an accepted client.
+    """
     # See: https://docs.python.org/3/library/socket.html#timeouts-and-the-accept-method
     client_socket.setblocking(0)
     # Turn on KEEPALIVE for the connection.
     _keepalive.set_keepalive(client_socket, KEEP_ALIVE_INTERVAL)
 
-    client_addr = f"{ip_addr}:{port}"
-    return client_socket, client_addr
 
+def listen_queue(proxy_socket):
+    """Get the length and limit of the accept queue of a listening socket.
 
-def _serve_proxy(all_threads, log_queue, proxy_port, server_host, server_port):
-    """Serve the proxy.
+    Args:
+        proxy_socket (socket.socket): The listening socket.
 
-    This is a "happy path" implementation for ``serve_proxy`` that doesn't
-    worry about interrupt handling (e.g. ``KeyboardInterrupt``).
+    Returns:
+        Tuple[int, int]: The number of connections waiting to be accepted
+        and the maximum length of the queue. Both are ``0`` if this can't be
+        determined (e.g. not on Linux, or the socket is closed).
+    """
+    tcp_info = getattr(socket, "TCP_INFO", None)
+    if tcp_info is None:
+        return 0, 0
+
+    try:
+        info = proxy_socket.getsockopt(
+            socket.IPPROTO_TCP, tcp_info, TCP_INFO_QUEUE.size
+        )
+    except OSError:
+        return 0, 0
+    if len(info) < TCP_INFO_QUEUE.size:
+        return 0, 0
+    return TCP_INFO_QUEUE.unpack(info)
+
+
+def listen_overflows():
+    """Get the number of connections dropped because an accept queue was full.
+
+    This is the ``ListenOverflows`` counter from ``/proc/net/netstat``, so it
+    covers **every** listening socket on the host (in the current network
+    namespace).
+
+    Returns:
+        int: The number of dropped connections.
+    """
+    with open(NETSTAT_PATH) as file_obj:
+        lines = file_obj.read().splitlines()
+    for names, values in zip(lines[::2], lines[1::2]):
+        if names.startswith("TcpExt:"):
+            counters = dict(zip(names.split()[1:], values.split()[1:]))
+            return int(counters.get("ListenOverflows", 0))
+    return 0
+
+
+def _register_listener(proxy_socket):
+    """Register the metrics for the listening socket of the proxy.
+
+    Args:
+        proxy_socket (socket.socket): The listening socket.
+    """
+    overflows = None
+    if NETSTAT_PATH.exists():
+        overflows = listen_overflows
+    _metrics.register_listener(
+        lambda: listen_queue(proxy_socket)[0],
+        lambda: listen_queue(proxy_socket)[1],
+        overflows,
+    )
+
+
+def _bind_proxy_socket(proxy_port, upstreams, reuse_port, backlog):
+    """Bind a non-blocking listening socket for the proxy.
 
     Args:
-        all_threads (List[threading.Thread]): A list of threads to append to.
-            We utilize the fact that `list.append()` is thread-safe in Python.
-        log_queue (queue.Queue): The queue where log lines will be pushed.
         proxy_port (int): A legal port number that the caller has permissions
             to bind to.
-        server_host (str): The host name where the server process is
-            running (i.e. the server that is being proxied).
-        server_port (int): A port number for a running "server" process.
+        upstreams (_upstreams.UpstreamGroup): The servers being proxied.
+        reuse_port (bool): Indicates if ``SO_REUSEPORT`` should be set, so
+            that several worker processes can bind the same port and have the
+            kernel balance accepted connections among them.
+        backlog (int): The length of the accept queue.
+
+    Returns:
+        socket.socket: The listening socket.
     """
     proxy_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     proxy_socket.setblocking(0)
-    proxy_socket.bind((PROXY_HOST, proxy_port))
+    # NOTE: These must be set **before** `bind()`.
     proxy_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    proxy_socket.listen(BACKLOG)
+    if reuse_port:
+        proxy_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    proxy_socket.bind((PROXY_HOST, proxy_port))
+    proxy_socket.listen(backlog)
+    _register_listener(proxy_socket)
+    server_addrs = ", ".join(upstream.addr for upstream in upstreams.upstreams)
+    plural = "s" if len(upstreams.upstreams) > 1 else ""
     _display.display(
         "Starting tcp-replay-reverse-proxy proxy server on port "
-        f"{proxy_port}\n  Proxying server located at "
-        f"{server_host}:{server_port}"
+        f"{proxy_port}\n  Proxying server{plural} located at {server_addrs}"
     )
+    return proxy_socket
+
 
-    while True:
-        client_socket, client_addr = accept(proxy_socket)
-        _display.display(f"Accepted connection from {client_addr}")
-        # NOTE: Nothing actually `.join()`-s this thread.
-        t_handle = threading.Thread(
-            target=_connect.connect_socket_pair,
-            args=(
-                log_queue,
-                client_socket,
-                client_addr,
-                server_host,
-                server_port,
-            ),
-        )
-        t_handle.start()
-        all_threads.append(t_handle)
-
-
-def serve_proxy(*, proxy_port, server_host, server_port, replay_log):
+def _reap_threads(all_threads):
+    """Remove finished threads from a list of threads.
+
+    This modifies ``all_threads`` in place, so it should only be called from
+    the thread that appends to it.
+
+    Args:
+        all_threads (List[threading.Thread]): A list of threads.
+    """
+    all_threads[:] = [
+        t_handle for t_handle in all_threads if t_handle.is_alive()
+    ]
+
+
+def _admit(slots, client_socket, client_addr):
+    """Acquire a handler slot for a newly accepted connection, if one is free.
+
+    This is only used for the ``"reject"`` overflow policy; with ``"queue"``
+    the slot is acquired **before** accepting.
+
+    Args:
+        slots (threading.BoundedSemaphore): The handler slots for the proxy.
+        client_socket (socket.socket): The socket of the accepted client.
+        client_addr (str): The address of the client socket.
+
+    Returns:
+        bool: Indicates if the connection was admitted. If not, the client
+        socket has been closed.
+    """
+    if slots.acquire(blocking=False):
+        return True
+
+    _metrics.CONNECTIONS_REJECTED.inc()
+    _display.display(
+        f"Rejected connection from {client_addr}; too many connections"
+    )
+    client_socket.close()
+    return False
+
+
+def _handle_connection(
+    slots,
+    log_queue,
+    client_socket,
+    client_addr,
+    upstreams,
+    zero_copy,
+    capture_responses,
+    stop,
+    capture_policy,
+    client_tls,
+):
+    """Handle an admitted connection and release its handler slot when done.
+
+    The client socket is set up (see ``setup_client_socket()``) here rather
+    than in the accept loop, and the connection is relayed to the server
+    chosen by ``upstreams``.
+
+    Args:
+        slots (threading.BoundedSemaphore): The handler slots for the proxy.
+        log_queue (Optional[_capture_buffer.CaptureBuffer]): The buffer where
+            log lines will be pushed, or :data:`None` if capture is off.
+        client_socket (socket.socket): The socket of the accepted client.
+        client_addr (str): The address of the client socket.
+        upstreams (_upstreams.UpstreamGroup): The servers being proxied.
+        zero_copy (bool): Indicates if the zero-copy relay should be used.
+        capture_responses (bool): Indicates if server->client chunks should
+            also be captured.
+        stop (_buffer.Wakeup): A flag that is set when the proxy stops
+            relaying every connection.
+        capture_policy (Optional[_capture_policy.CapturePolicy]): Decides if
+            (and how much of) each connection is captured, if set.
+        client_tls (Optional[_tls.ClientTLS]): Terminates TLS from clients,
+            if enabled.
+    """
+    _metrics.CONNECTIONS_TOTAL.inc()
+    _metrics.CONNECTIONS_ACTIVE.inc()
+    upstream = upstreams.acquire()
+    try:
+        setup_client_socket(client_socket)
+        _connect.connect_socket_pair(
+            log_queue,
+            client_socket,
+            client_addr,
+            upstream.host,
+            upstream.port,
+            zero_copy=zero_copy,
+            capture_responses=capture_responses,
+            upstream_pool=upstream.pool,
+            stop=stop,
+            capture_policy=capture_policy,
+            client_tls=client_tls,
+            upstream_tls=upstream.tls,
+        )
+    finally:
+        upstreams.release(upstream)
+        _metrics.CONNECTIONS_ACTIVE.dec()
+        slots.release()
+
+
+def _serve_proxy(
+    all_threads,
+    stop,
+    log_queue,
+    proxy_port,
+    upstreams,
+    reuse_port,
+    backlog,
+    max_connections,
+    overflow,
+    zero_copy,
+    capture_responses,
+    capture_policy,
+    client_tls,
+):
     """Serve the proxy.
 
-    This should run as a top-level server and CLI invocations of
-    ``tcp-replay-reverse-proxy`` will directly invoke it.
+    This is a "happy path" implementation for ``serve_proxy`` that doesn't
+    worry about interrupt handling (e.g. ``KeyboardInterrupt``).
+
+    Each time the listening socket is readable, every pending connection is
+    accepted (see ``accept_pending()``) and handed to its own handler thread.
 
     Args:
+        all_threads (List[threading.Thread]): A list of threads to append to.
+            Finished handler threads are removed from this list each time
+            pending connections are accepted.
+        stop (_buffer.Wakeup): A flag that is set when the proxy stops
+            relaying every connection.
+        log_queue (Optional[_capture_buffer.CaptureBuffer]): The buffer where
+            log lines will be pushed, or :data:`None` if capture is off.
         proxy_port (int): A legal port number that the caller has permissions
             to bind to.
-        server_host (Optional[str]): The host name where the server process is
-            running (i.e. the server that is being proxied).
-        server_port (int): A port number for a running "server" process.
-        replay_log (pathlib.Path): The file where the replay log will be
-            written.
+        upstreams (_upstreams.UpstreamGroup): The servers being proxied.
+        reuse_port (bool): Indicates if ``SO_REUSEPORT`` should be set on
+            the listening socket.
+        backlog (int): The length of the accept queue.
+        max_connections (int): The maximum number of connections handled
+            concurrently.
+        overflow (str): The overflow policy when ``max_connections`` are
+            active; one of :data:`OVERFLOW_POLICIES`.
+        zero_copy (bool): Indicates if the zero-copy relay should be used.
+        capture_responses (bool): Indicates if server->client chunks should
+            also be captured.
+        capture_policy (Optional[_capture_policy.CapturePolicy]): Decides if
+            (and how much of) each connection is captured, if set.
+        client_tls (Optional[_tls.ClientTLS]): Terminates TLS from clients,
+            if enabled.
+    """
+    proxy_socket = _bind_proxy_socket(
+        proxy_port, upstreams, reuse_port, backlog
+    )
+    slots = threading.BoundedSemaphore(max_connections)
+
+    try:
+        while True:
+            if overflow == "queue":
+                # NOTE: The slot is acquired **before** accepting, so that new
+                #       connections wait in the listen backlog.
+                slots.acquire()
+            _buffer.wait_for(proxy_socket, select.POLLIN)
+            ready_ns = time.perf_counter_ns()
+            _reap_threads(all_threads)
+            for client_socket, client_addr in accept_pending(proxy_socket):
+                _metrics.ACCEPT_LATENCY.observe(
+                    time.perf_counter_ns() - ready_ns
+                )
+                if overflow == "reject" and not _admit(
+                    slots, client_socket, client_addr
+                ):
+                    continue
+
+                _display.display(f"Accepted connection from {client_addr}")
+                t_handle = threading.Thread(
+                    target=_handle_connection,
+                    args=(
+                        slots,
+                        log_queue,
+                        client_socket,
+                        client_addr,
+                        upstreams,
+                        zero_copy,
+                        capture_responses,
+                        stop,
+                        capture_policy,
+                        client_tls,
+                    ),
+                )
+                t_handle.start()
+                all_threads.append(t_handle)
+                # NOTE: Acquire the slot for the next pending connection; if
+                #       none is free, the connection stays in the backlog.
+                if overflow == "queue" and not slots.acquire(blocking=False):
+                    break
+            else:
+                if overflow == "queue":
+                    # Release the slot that no pending connection took.
+                    slots.release()
+    finally:
+        # Stop accepting, so that new clients are refused while the active
+        # connections are drained.
+        proxy_socket.close()
+
+
+def _drain_threads(all_threads, stop, shutdown_timeout):
+    """Wait for active connections to finish, then close the rest.
+
+    Each handler is given until a shared deadline to finish on its own. Any
+    handler still running after that (or after a second interrupt) is
+    stopped by setting ``stop``, which wakes up every relay so that its
+    sockets are closed.
+
+    Args:
+        all_threads (List[threading.Thread]): The handler threads.
+        stop (_buffer.Wakeup): A flag that is set when the proxy stops
+            relaying every connection.
+        shutdown_timeout (float): The time (in seconds) active connections
+            are given to finish.
+    """
+    deadline = time.monotonic() + shutdown_timeout
+    try:
+        for t_handle in all_threads:
+            t_handle.join(max(deadline - time.monotonic(), 0.0))
+    except KeyboardInterrupt:
+        pass
+
+    _reap_threads(all_threads)
+    if not all_threads:
+        return
+
+    _display.display(f"Closing {len(all_threads)} active connections...")
+    stop.set()
+    for t_handle in all_threads:
+        t_handle.join()
+
+
+async def _handle_connection_asyncio(
+    log_queue, client_socket, client_addr, upstreams, **kwargs
+):
+    """Relay an admitted connection to the server chosen by ``upstreams``.
+
+    The client socket is set up (see ``setup_client_socket()``) here rather
+    than in the accept loop.
+
+    Args:
+        log_queue (Optional[_capture_buffer.CaptureBuffer]): The buffer where
+            log lines will be pushed, or :data:`None` if capture is off.
+        client_socket (socket.socket): The socket of the accepted client.
+        client_addr (str): The address of the client socket.
+        upstreams (_upstreams.UpstreamGroup): The servers being proxied.
+        kwargs (Dict[str, Any]): The remaining keyword arguments for
+            ``_async_connect.connect_socket_pair()``.
+    """
+    setup_client_socket(client_socket)
+    upstream = upstreams.acquire()
+    try:
+        await _async_connect.connect_socket_pair(
+            log_queue,
+            client_socket,
+            client_addr,
+            upstream.host,
+            upstream.port,
+            upstream_pool=upstream.pool,
+            **kwargs,
+        )
+    finally:
+        upstreams.release(upstream)
+
+
+async def _wait_readable_asyncio(loop, proxy_socket):
+    """Wait until a listening socket has a connection to accept.
+
+    Args:
+        loop (asyncio.AbstractEventLoop): The running event loop.
+        proxy_socket (socket.socket): The non-blocking listening socket.
+    """
+    readable = loop.create_future()
+
+    def on_readable():
+        if not readable.done():
+            readable.set_result(None)
+
+    loop.add_reader(proxy_socket.fileno(), on_readable)
+    try:
+        await readable
+    finally:
+        loop.remove_reader(proxy_socket.fileno())
+
+
+async def _serve_proxy_asyncio(
+    log_queue,
+    proxy_port,
+    upstreams,
+    reuse_port,
+    backlog,
+    max_connections,
+    overflow,
+    zero_copy,
+    capture_responses,
+    capture_policy,
+    shutdown_timeout,
+):
+    """Serve the proxy from a single ``asyncio`` event loop.
+
+    This is the ``asyncio`` analog of ``_serve_proxy``; each accepted
+    connection is relayed (in both directions) by tasks running on the
+    same event loop rather than by dedicated threads.
+
+    Each time the listening socket becomes readable, every pending
+    connection is accepted (see ``accept_pending()``).
+
+    When the serving task is cancelled (e.g. by ``asyncio.run()`` on an
+    interrupt), the listening socket is closed and the active connections
+    are given ``shutdown_timeout`` seconds to finish before they are
+    cancelled.
+
+    Args:
+        log_queue (Optional[_capture_buffer.CaptureBuffer]): The buffer where
+            log lines will be pushed, or :data:`None` if capture is off.
+        proxy_port (int): A legal port number that the caller has permissions
+            to bind to.
+        upstreams (_upstreams.UpstreamGroup): The servers being proxied.
+        reuse_port (bool): Indicates if ``SO_REUSEPORT`` should be set on
+            the listening socket.
+        backlog (int): The length of the accept queue.
+        max_connections (int): The maximum number of connections handled
+            concurrently.
+        overflow (str): The overflow policy when ``max_connections`` are
+            active; one of :data:`OVERFLOW_POLICIES`.
+        zero_copy (bool): Indicates if the zero-copy relay should be used.
+        capture_responses (bool): Indicates if server->client chunks should
+            also be captured.
+        capture_policy (Optional[_capture_policy.CapturePolicy]): Decides if
+            (and how much of) each connection is captured, if set.
+        shutdown_timeout (float): The time (in seconds) active connections
+            are given to finish when the proxy is stopped.
+    """
+    loop = asyncio.get_running_loop()
+    proxy_socket = _bind_proxy_socket(
+        proxy_port, upstreams, reuse_port, backlog
+    )
+    slots = asyncio.BoundedSemaphore(max_connections)
+    # Hold a reference to each task so it isn't garbage collected while
+    # still running; tasks discard themselves when done.
+    all_tasks = set()
+
+    try:
+        while True:
+            if overflow == "queue":
+                await slots.acquire()
+            # NOTE: As in ``_serve_proxy``, the accept latency is measured
+            #       from the listening socket becoming readable, so waiting
+            #       is kept separate from accepting.
+            await _wait_readable_asyncio(loop, proxy_socket)
+            ready_ns = time.perf_counter_ns()
+            for client_socket, client_addr in accept_pending(proxy_socket):
+                _metrics.ACCEPT_LATENCY.observe(
+                    time.perf_counter_ns() - ready_ns
+                )
+                if overflow == "reject":
+                    if slots.locked():
+                        _metrics.CONNECTIONS_REJECTED.inc()
+                        _display.display(
+                            f"Rejected connection from {client_addr}; too "
+                            "many connections"
+                        )
+                        client_socket.close()
+                        continue
+                    await slots.acquire()
+
+                _display.display(f"Accepted connection from {client_addr}")
+                _metrics.CONNECTIONS_TOTAL.inc()
+                _metrics.CONNECTIONS_ACTIVE.inc()
+                t_handle = asyncio.create_task(
+                    _handle_connection_asyncio(
+                        log_queue,
+                        client_socket,
+                        client_addr,
+                        upstreams,
+                        zero_copy=zero_copy,
+                        capture_responses=capture_responses,
+                        capture_policy=capture_policy,
+                    )
+                )
+                all_tasks.add(t_handle)
+                t_handle.add_done_callback(all_tasks.discard)
+                t_handle.add_done_callback(lambda _: slots.release())
+                t_handle.add_done_callback(
+                    lambda _: _metrics.CONNECTIONS_ACTIVE.dec()
+                )
+                # NOTE: Acquire the slot for the next pending connection; if
+                #       none is free, the connection stays in the backlog.
+                if overflow == "queue":
+                    if slots.locked():
+                        break
+                    await slots.acquire()
+            else:
+                if overflow == "queue":
+                    # Release the slot that no pending connection took.
+                    slots.release()
+    except asyncio.CancelledError:
+        proxy_socket.close()
+        if all_tasks:
+            _, pending = await asyncio.wait(
+                all_tasks, timeout=shutdown_timeout
+            )
+            if pending:
+                _display.display(
+                    f"Closing {len(pending)} active connections..."
+                )
+            for t_handle in pending:
+                t_handle.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        raise
+
+
+def _serve_process(
+    *,
+    proxy_port,
+    upstreams,
+    balance,
+    health_check_interval,
+    replay_log,
+    sinks,
+    engine,
+    reuse_port,
+    backlog,
+    max_connections,
+    overflow,
+    zero_copy,
+    capture,
+    capture_policy,
+    capture_buffer_bytes,
+    capture_overflow,
+    client_tls,
+    writer_kwargs,
+    upstream_pool_size,
+    upstream_pool_max_idle,
+    metrics_port,
+    metrics_callback,
+    metrics_interval,
+    shutdown_timeout,
+):
+    """Serve the proxy from the current process.
+
+    Args:
+        proxy_port (int): A legal port number that the caller has permissions
+            to bind to.
+        upstreams (List[_upstreams.Upstream]): The servers being proxied.
+        balance (str): How a server is chosen for each connection; one of
+            :data:`_upstreams.BALANCE_POLICIES`.
+        health_check_interval (float): The time (in seconds) between health
+            checks of each server.
+        replay_log (Optional[pathlib.Path]): The file where the replay log
+            will be written, if any.
+        sinks (List[_sinks.Sink]): Additional sinks that every captured log
+            line is written to.
+        engine (str): The relay engine to use.
+        reuse_port (bool): Indicates if ``SO_REUSEPORT`` should be set on
+            the listening socket.
+        backlog (int): The length of the accept queue.
+        max_connections (int): The maximum number of connections handled
+            concurrently.
+        overflow (str): The overflow policy when ``max_connections`` are
+            active; one of :data:`OVERFLOW_POLICIES`.
+        zero_copy (bool): Indicates if the zero-copy relay should be used.
+        capture (bool): Indicates if proxied chunks should be captured.
+        capture_policy (Optional[_capture_policy.CapturePolicy]): Decides if
+            (and how much of) each connection is captured, if set.
+        capture_buffer_bytes (int): The number of bytes of log lines held in
+            memory before ``capture_overflow`` applies.
+        capture_overflow (str): The overflow policy for the capture buffer;
+            one of :data:`_capture_buffer.OVERFLOW_POLICIES`.
+        client_tls (Optional[_tls.ClientTLS]): Terminates TLS from clients,
+            if enabled.
+        writer_kwargs (Dict[str, Any]): Keyword arguments for
+            :class:`_save_replay_log.ReplayLogSink`; server->client chunks
+            are captured if ``capture_responses`` is set.
+        upstream_pool_size (int): The number of idle connections to each
+            server kept open; ``0`` disables the pool.
+        upstream_pool_max_idle (float): The age (in seconds) at which an
+            idle connection to the server is replaced.
+        metrics_port (Optional[int]): The port where metrics are served over
+            HTTP, if set.
+        metrics_callback (Optional[Callable[[Dict[str, Any]], None]]): If
+            set, this is called with a snapshot of the metrics every
+            ``metrics_interval`` seconds.
+        metrics_interval (float): The time (in seconds) between metrics
+            snapshots.
+        shutdown_timeout (float): The time (in seconds) active connections
+            are given to finish when the proxy is stopped.
     """
-    # TODO: Limit the size of the thread pool.
-    #       e.g. see
-    #       https://github.com/dhermes/tcp-h2-describe/blob/73c135b37550858c322b7b67c84333381afd3c69/src/tcp_h2_describe/_serve.py#L105
     done_event = threading.Event()
-    log_queue = queue.Queue(maxsize=QUEUE_BUFFER)
+    log_queue = _capture_buffer.CaptureBuffer(
+        capture_buffer_bytes, capture_overflow
+    )
+    all_sinks = list(sinks)
+    if replay_log is not None:
+        all_sinks.insert(
+            0, _save_replay_log.ReplayLogSink(replay_log, **writer_kwargs)
+        )
     save_log_thread = threading.Thread(
-        target=_save_replay_log.save_log_worker,
-        args=(replay_log, log_queue, done_event),
+        target=_sinks.run_sinks, args=(all_sinks, log_queue, done_event)
     )
     save_log_thread.start()
-    all_threads = [save_log_thread]
+    all_threads = []
+    stop = _buffer.Wakeup()
+    capture_responses = writer_kwargs.get("capture_responses", False)
+    # Handlers relay without pushing any log lines if capture is off.
+    handler_queue = log_queue if capture else None
+    _metrics.register_capture_buffer(log_queue)
+    upstream_group = _upstreams.UpstreamGroup(
+        upstreams, balance=balance, health_check_interval=health_check_interval
+    )
+    if upstream_pool_size > 0:
+        upstream_group.start_pools(
+            upstream_pool_size, KEEP_ALIVE_INTERVAL, upstream_pool_max_idle
+        )
+    upstream_group.start()
+    _metrics.register_upstreams(upstream_group)
+    metrics_server = None
+    if metrics_port is not None:
+        metrics_server = _metrics.start_http_server(metrics_port)
+    stop_snapshots = None
+    if metrics_callback is not None:
+        stop_snapshots = _metrics.start_snapshots(
+            metrics_callback, metrics_interval
+        )
 
     try:
-        _serve_proxy(
-            all_threads, log_queue, proxy_port, server_host, server_port
-        )
+        if engine == "asyncio":
+            asyncio.run(
+                _serve_proxy_asyncio(
+                    handler_queue,
+                    proxy_port,
+                    upstream_group,
+                    reuse_port,
+                    backlog,
+                    max_connections,
+                    overflow,
+                    zero_copy,
+                    capture_responses,
+                    capture_policy,
+                    shutdown_timeout,
+                )
+            )
+        else:
+            _serve_proxy(
+                all_threads,
+                stop,
+                handler_queue,
+                proxy_port,
+                upstream_group,
+                reuse_port,
+                backlog,
+                max_connections,
+                overflow,
+                zero_copy,
+                capture_responses,
+                capture_policy,
+                client_tls,
+            )
     except KeyboardInterrupt:
         _display.display(
             "Stopping tcp-replay-reverse-proxy proxy server "
             f"on port {proxy_port}"
         )
         _display.display("Waiting for request handlers to complete...")
+        upstream_group.close()
+        _drain_threads(all_threads, stop, shutdown_timeout)
+        stop.close()
+        # NOTE: The writer is only stopped once every handler is done, so
+        #       that no log lines are pushed after it has stopped.
         done_event.set()
-        # TODO: Add thread shutdown (possibly via a `threading.Event`) instead
-        #       of just waiting for each socket to be closed.
-        for t_handle in all_threads:
-            t_handle.join()
+        save_log_thread.join()
+        log_queue.display_summary()
+        log_queue.close()
+        if stop_snapshots is not None:
+            stop_snapshots.set()
+            metrics_callback(_metrics.REGISTRY.snapshot())
+        if metrics_server is not None:
+            metrics_server.shutdown()
+
+
+def shard_filename(replay_log, worker_index):
+    """Determine the replay log shard written by a worker process.
+
+    Args:
+        replay_log (pathlib.Path): The file where the (merged) replay log will
+            be written.
+        worker_index (int): The index of the worker process.
+
+    Returns:
+        pathlib.Path: The file where the worker's shard will be written.
+    """
+    replay_log = pathlib.Path(replay_log)
+    return replay_log.with_name(f"{replay_log.name}.{worker_index:03d}")
+
+
+def _serve_worker(worker_index, replay_log, process_kwargs):
+    """Serve the proxy from a forked worker process.
+
+    The worker is moved into its own process group so that an interrupt from
+    the terminal is only delivered to the parent, which forwards it to each
+    worker exactly once. If metrics are served over HTTP, each worker serves
+    its own metrics on ``metrics_port + worker_index``.
+
+    Args:
+        worker_index (int): The index of the worker process.
+        replay_log (Optional[pathlib.Path]): The file where the (merged)
+            replay log will be written, if any.
+        process_kwargs (Dict[str, Any]): The remaining keyword arguments for
+            ``_serve_process()``.
+    """
+    os.setpgid(0, 0)
+    process_kwargs = dict(process_kwargs)
+    if process_kwargs["metrics_port"] is not None:
+        process_kwargs["metrics_port"] += worker_index
+    if replay_log is not None:
+        replay_log = shard_filename(replay_log, worker_index)
+    _serve_process(replay_log=replay_log, reuse_port=True, **process_kwargs)
+
+
+def _serve_workers(workers, replay_log, process_kwargs):
+    """Serve the proxy from several forked worker processes.
+
+    Each worker binds the proxy port with ``SO_REUSEPORT`` and writes its own
+    replay log shard. Once every worker has stopped, the shards are merged
+    into ``replay_log`` (ordered by timestamp) and removed. Segmented shards
+    are left in place (each with its own manifest), since merging them
+    would produce a single unbounded file. If a sidecar index was written
+    for each shard, the shard indices are merged along with the records
+    (so each connection keeps its identity) and removed as well.
+
+    Args:
+        workers (int): The number of worker processes.
+        replay_log (Optional[pathlib.Path]): The file where the replay log
+            will be written, if any.
+        process_kwargs (Dict[str, Any]): The remaining keyword arguments for
+            ``_serve_process()``.
+    """
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(
+            target=_serve_worker,
+            args=(worker_index, replay_log, process_kwargs),
+        )
+        for worker_index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        _display.display(f"Stopping {workers} worker processes...")
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGINT)
+        for process in processes:
+            process.join()
+
+    if replay_log is None:
+        return
+    if _segments.manifest_filename(shard_filename(replay_log, 0)).exists():
+        _display.display(
+            f"Left {workers} segmented replay log shards next to {replay_log}"
+        )
+        return
+
+    shards = [
+        shard_filename(replay_log, worker_index)
+        for worker_index in range(workers)
+    ]
+    shards = [shard for shard in shards if shard.exists()]
+    count = _merge_replay_log.merge_replay_logs(
+        shards, replay_log, index=process_kwargs["writer_kwargs"]["index"]
+    )
+    _display.display(
+        f"Merged {len(shards)} replay log shards ({count} records) into "
+        f"{replay_log}"
+    )
+    for shard in shards:
+        shard.unlink()
+        _index.index_filename(shard).unlink(missing_ok=True)
+
+
+def serve_proxy(
+    *,
+    proxy_port,
+    server_host=None,
+    server_port=None,
+    upstreams=None,
+    balance="least-connections",
+    health_check_interval=_upstreams.HEALTH_CHECK_INTERVAL,
+    replay_log=None,
+    sinks=None,
+    engine="threads",
+    workers=1,
+    backlog=BACKLOG,
+    max_connections=MAX_CONNECTIONS,
+    overflow="queue",
+    zero_copy=False,
+    capture=True,
+    capture_sample_percent=100.0,
+    capture_allow=None,
+    capture_deny=None,
+    capture_max_bytes=None,
+    capture_framing=None,
+    capture_passwords="redact",
+    capture_buffer_bytes=CAPTURE_BUFFER_BYTES,
+    capture_overflow="drop",
+    tls_certfile=None,
+    tls_keyfile=None,
+    upstream_tls=False,
+    upstream_tls_cafile=None,
+    upstream_tls_verify=True,
+    tls_direct=False,
+    fsync_policy="never",
+    segment_bytes=None,
+    segment_seconds=None,
+    segment_compression=None,
+    index=False,
+    capture_responses=False,
+    dedup=False,
+    replay_log_version=_replay_format.VERSION,
+    upstream_pool_size=0,
+    upstream_pool_max_idle=_upstream_pool.MAX_IDLE,
+    metrics_port=None,
+    metrics_callback=None,
+    metrics_interval=_metrics.SNAPSHOT_INTERVAL,
+    shutdown_timeout=SHUTDOWN_TIMEOUT,
+):
+    """Serve the proxy.
+
+    This should run as a top-level server and CLI invocations of
+    ``tcp-replay-reverse-proxy`` will directly invoke it.
+
+    Args:
+        proxy_port (int): A legal port number that the caller has permissions
+            to bind to.
+        server_host (Optional[str]): The host name where the server process is
+            running (i.e. the server that is being proxied).
+        server_port (Optional[int]): A port number for a running "server"
+            process. Required unless ``upstreams`` is set.
+        upstreams (Optional[Iterable[Tuple[str, int, ...]]]): If set, the
+            proxy balances connections across several servers (e.g. a fleet
+            of read replicas) rather than proxying ``server_host`` /
+            ``server_port``. Each is a ``(host, port)`` pair, optionally
+            followed by an (integer) weight. The server a connection is
+            relayed to is recorded as the server address of each of its
+            records.
+        balance (Optional[str]): How a server is chosen from ``upstreams``
+            for each connection. One of ``"least-connections"`` (the
+            default; the server with the fewest active connections relative
+            to its weight) or ``"weighted"`` (servers take turns in
+            proportion to their weights).
+        health_check_interval (Optional[float]): The time (in seconds)
+            between TCP health checks of each server in ``upstreams``. A
+            server that fails two checks in a row is taken out of rotation
+            until a check succeeds.
+        replay_log (Optional[pathlib.Path]): The file where the replay log
+            will be written. Required unless ``sinks`` is set.
+        sinks (Optional[Iterable[_sinks.Sink]]): Additional destinations
+            that every captured log line is written to (in batches), e.g. a
+            :class:`_stream_sink.StreamSink` that ships captures to a
+            collector over the network. With several workers, each worker
+            starts its own copy of each sink.
+        engine (Optional[str]): The relay engine to use. One of
+            ``"threads"`` (the default; two threads per connection) or
+            ``"asyncio"`` (all connections relayed from one event loop).
+        workers (Optional[int]): The number of worker processes. If more
+            than one, each worker binds ``proxy_port`` with ``SO_REUSEPORT``
+            and the replay log shards are merged on shutdown.
+        backlog (Optional[int]): The length of the accept queue of the
+            listening socket (per worker process), i.e. how many connections
+            the kernel holds while the proxy accepts them. The kernel caps
+            this at ``net.core.somaxconn``; when a burst of clients (e.g. a
+            restarting application fleet) overflows it, their connection
+            attempts are dropped and retried after a delay.
+        max_connections (Optional[int]): The maximum number of connections
+            handled concurrently (per worker process).
+        overflow (Optional[str]): What to do with a new connection when
+            ``max_connections`` are already active. One of ``"queue"`` (the
+            default; wait for an active connection to finish) or
+            ``"reject"`` (close the new connection immediately).
+        zero_copy (Optional[bool]): Indicates if chunks should be relayed
+            through preallocated buffers, with ``splice(2)`` (where
+            available) moving the uncaptured server->client direction
+            entirely within the kernel.
+        capture (Optional[bool]): Indicates if proxied chunks should be
+            captured. If not, the proxy only relays (an empty replay log is
+            still written); this is mostly useful as a baseline when
+            measuring the cost of capture.
+        capture_sample_percent (Optional[float]): The percentage of
+            connections captured. Each connection is sampled (once, when it
+            is accepted) by a hash of its client address, so the choice is
+            the same across worker processes.
+        capture_allow (Optional[Iterable[str]]): If set, only connections
+            from clients in one of these CIDR blocks are captured.
+        capture_deny (Optional[Iterable[str]]): Connections from clients in
+            any of these CIDR blocks are not captured.
+        capture_max_bytes (Optional[int]): If set, at most this many bytes
+            are captured per connection; the rest of the connection is
+            relayed without being captured. A connection's capture stops at
+            the first chunk that doesn't fit.
+
+            A connection that isn't captured skips the capture path
+            entirely and is relayed with the cheapest relay (``splice(2)``
+            where available), even if ``zero_copy`` is not set. With
+            ``zero_copy``, the rest of a connection whose budget is
+            exhausted is moved with ``splice(2)`` as well.
+        capture_framing (Optional[str]): If ``"postgres"``, the captured
+            client->server stream is split into one record per PostgreSQL
+            message (using the startup packet and each message's type byte
+            and length) rather than one record per TCP chunk. Every record
+            can then be parsed on its own (e.g. with ``postgres.ParseChunk``).
+        capture_passwords (Optional[str]): What to do with password / SASL
+            messages when ``capture_framing`` is ``"postgres"``. One of
+            ``"redact"`` (the default; keep the type byte and length but zero
+            the contents), ``"skip"`` (don't capture them) or ``"keep"``.
+        capture_buffer_bytes (Optional[int]): The number of bytes of log
+            lines held in memory while waiting to be written.
+        capture_overflow (Optional[str]): What to do with a log line when the
+            capture buffer is full. One of ``"drop"`` (the default; drop it
+            and count it), ``"spill"`` (write it to a temporary file) or
+            ``"block"`` (stall the proxied connection until there is room).
+        tls_certfile (Optional[str]): If set, the proxy terminates TLS from
+            clients with this (PEM) certificate chain, so that chunks are
+            relayed and captured as plaintext. Sessions can be resumed (with
+            any worker process). Unless ``tls_direct`` is set, TLS is
+            negotiated with a PostgreSQL ``SSLRequest`` (see
+            :class:`_tls.ClientTLS`) and clients that don't ask for TLS are
+            relayed as plaintext. Only supported by the ``"threads"``
+            engine.
+        tls_keyfile (Optional[str]): The PEM file with the private key for
+            ``tls_certfile``, if it isn't in ``tls_certfile``.
+        upstream_tls (Optional[bool]): Indicates if the proxy should
+            originate TLS to the server (e.g. to re-encrypt a connection
+            whose client TLS was terminated). The most recent session with
+            the server is resumed by the next connection. Only supported by
+            the ``"threads"`` engine.
+        upstream_tls_cafile (Optional[str]): The PEM file with the
+            certificate authorities trusted for the server's certificate; if
+            not set, the system defaults are used.
+        upstream_tls_verify (Optional[bool]): Indicates if the server's
+            certificate (and host name) should be verified.
+        tls_direct (Optional[bool]): Indicates if TLS handshakes (with
+            clients and servers) start on the first bytes of a connection.
+            By default (:data:`False`), TLS is negotiated the way PostgreSQL
+            does it, with a plaintext ``SSLRequest`` that is answered before
+            the handshake.
+
+            Since a TLS connection can't be half-closed, an EOF in one
+            direction of a connection with a TLS side closes the whole
+            connection. Chunks are never moved with ``splice(2)`` to or from
+            a TLS socket.
+        fsync_policy (Optional[str]): When to ``fsync()`` the replay log;
+            one of :data:`_save_replay_log.FSYNC_POLICIES`.
+        segment_bytes (Optional[int]): If set, the replay log is written as
+            segments which are rotated once they reach this size. A segment
+            exceeds this by (at most) the size of its last record.
+        segment_seconds (Optional[float]): If set, the replay log is written
+            as segments which are rotated once they are this old.
+        segment_compression (Optional[str]): If set, closed segments are
+            compressed in the background; a key in
+            :data:`_segments.COMPRESSIONS`.
+        index (Optional[bool]): Indicates if a sidecar index (record offsets,
+            timestamps and connection ids) should be written next to the
+            replay log (or each segment).
+        capture_responses (Optional[bool]): Indicates if the chunks sent from
+            the server to the client should also be captured. If so, each
+            record carries a direction (see :mod:`_replay_format`) and the
+            upstream time to first byte and full response time are reported
+            on shutdown.
+        dedup (Optional[bool]): Indicates if a chunk that repeats a recent
+            chunk (e.g. the same query sent by many connections) should be
+            stored as a reference to it rather than in full. The replay log
+            sets :data:`_replay_format.FLAG_DEDUP`; it can be expanded back
+            to the plain format with
+            :func:`_merge_replay_log.expand_replay_log`.
+        replay_log_version (Optional[int]): The format version of the replay
+            log; one of :data:`_replay_format.VERSIONS`. A version 2 replay
+            log stores each record with a fixed-width header and a
+            connection id (see :mod:`_replay_format`), so its records can be
+            scanned without searching for delimiters. It can be converted
+            to (or from) version 1 with
+            :func:`_merge_replay_log.convert_replay_log`.
+        upstream_pool_size (Optional[int]): If positive, this many idle
+            connections to each server are kept open (per worker process) and
+            refilled in the background, so that an accepted client is handed
+            an already connected socket. Since a pooled connection is opened
+            **before** its client connects, a greeting sent by the server is
+            already waiting (and is relayed) when the client is handed the
+            connection.
+        upstream_pool_max_idle (Optional[float]): The age (in seconds) at
+            which an idle pooled connection is closed and replaced. This
+            should be shorter than the time the server allows a new
+            connection to stay silent. Note that the pool churns even while
+            the proxy is idle: ``upstream_pool_size`` connections are
+            reopened every ``upstream_pool_max_idle`` seconds, and a server
+            may log each closed one (e.g. PostgreSQL logs "incomplete
+            startup packet").
+        metrics_port (Optional[int]): If set, metrics are served (on the
+            loopback interface) in the Prometheus text format at
+            ``/metrics`` and as JSON at ``/snapshot``. With several workers,
+            each worker serves its own metrics on ``metrics_port`` plus its
+            index.
+        metrics_callback (Optional[Callable[[Dict[str, Any]], None]]): If
+            set, this is called (from a background thread in each worker
+            process) with a snapshot of the metrics every
+            ``metrics_interval`` seconds and once more on shutdown.
+        metrics_interval (Optional[float]): The time (in seconds) between
+            metrics snapshots.
+        shutdown_timeout (Optional[float]): When the proxy is stopped, it
+            stops accepting and gives the active connections this long (in
+            seconds) to finish on their own before closing them. A second
+            interrupt closes them right away.
+
+    Raises:
+        ValueError: If neither or both of ``server_port`` and ``upstreams``
+            are set.
+        ValueError: If ``upstreams`` is empty.
+        ValueError: If neither ``replay_log`` nor ``sinks`` are set.
+        ValueError: If an entry in ``upstreams`` isn't a ``(host, port)``
+            pair (optionally followed by a positive weight).
+        ValueError: If ``balance`` is not one of
+            :data:`_upstreams.BALANCE_POLICIES`.
+        ValueError: If ``health_check_interval`` is not positive.
+        ValueError: If ``engine`` is not one of :data:`ENGINES`.
+        ValueError: If ``capture_sample_percent`` is not between 0 and 100.
+        ValueError: If ``capture_allow`` or ``capture_deny`` contain an
+            invalid CIDR block.
+        ValueError: If ``capture_max_bytes`` is not positive.
+        ValueError: If ``capture_framing`` is not one of
+            :data:`_capture_policy.FRAMINGS`.
+        ValueError: If ``capture_passwords`` is not one of
+            :data:`_postgres.PASSWORD_POLICIES`.
+        ValueError: If ``tls_certfile`` or ``upstream_tls`` are set with the
+            ``"asyncio"`` engine.
+        ValueError: If ``workers`` is not positive.
+        ValueError: If ``backlog`` is not positive.
+        ValueError: If ``max_connections`` is not positive.
+        ValueError: If ``overflow`` is not one of :data:`OVERFLOW_POLICIES`.
+        ValueError: If ``capture_overflow`` is not one of
+            :data:`_capture_buffer.OVERFLOW_POLICIES`.
+        ValueError: If ``fsync_policy`` is not one of
+            :data:`_save_replay_log.FSYNC_POLICIES`.
+        ValueError: If ``segment_compression`` is not a key in
+            :data:`_segments.COMPRESSIONS`.
+        ValueError: If ``replay_log_version`` is not one of
+            :data:`_replay_format.VERSIONS`.
+        ValueError: If ``dedup`` is set with a version 2 replay log.
+        ValueError: If ``upstream_pool_size`` is negative.
+        ValueError: If ``upstream_pool_max_idle`` is not positive.
+        ValueError: If ``shutdown_timeout`` is negative.
+    """
+    if (server_port is None) == (upstreams is None):
+        raise ValueError(
+            "Exactly one of server_port or upstreams must be set",
+            server_port,
+            upstreams,
+        )
+    sinks = [] if sinks is None else list(sinks)
+    if replay_log is None and not sinks:
+        raise ValueError(
+            "A replay log or at least one sink is required", replay_log, sinks
+        )
+    if balance not in _upstreams.BALANCE_POLICIES:
+        raise ValueError(
+            f"Unsupported balance policy {balance!r}",
+            _upstreams.BALANCE_POLICIES,
+        )
+    if health_check_interval <= 0:
+        raise ValueError(
+            "The health check interval must be positive", health_check_interval
+        )
+    if engine not in ENGINES:
+        raise ValueError(f"Unsupported engine {engine!r}", ENGINES)
+    if engine == "asyncio" and (tls_certfile is not None or upstream_tls):
+        raise ValueError("TLS is only supported by the threads engine", engine)
+    if workers < 1:
+        raise ValueError("At least one worker is required", workers)
+    if backlog < 1:
+        raise ValueError("The backlog must be positive", backlog)
+    if max_connections < 1:
+        raise ValueError(
+            "At least one connection must be allowed", max_connections
+        )
+    if overflow not in OVERFLOW_POLICIES:
+        raise ValueError(
+            f"Unsupported overflow policy {overflow!r}", OVERFLOW_POLICIES
+        )
+    if capture_overflow not in _capture_buffer.OVERFLOW_POLICIES:
+        raise ValueError(
+            f"Unsupported capture overflow policy {capture_overflow!r}",
+            _capture_buffer.OVERFLOW_POLICIES,
+        )
+    if fsync_policy not in _save_replay_log.FSYNC_POLICIES:
+        raise ValueError(
+            f"Unsupported fsync policy {fsync_policy!r}",
+            _save_replay_log.FSYNC_POLICIES,
+        )
+    if (
+        segment_compression is not None
+        and segment_compression not in _segments.COMPRESSIONS
+    ):
+        raise ValueError(
+            f"Unsupported compression {segment_compression!r}",
+            tuple(_segments.COMPRESSIONS),
+        )
+    if replay_log_version not in _replay_format.VERSIONS:
+        raise ValueError(
+            f"Unsupported replay log version {replay_log_version!r}",
+            _replay_format.VERSIONS,
+        )
+    if dedup and replay_log_version == _replay_format.VERSION_2:
+        raise ValueError(
+            "Version 2 replay logs can't be deduplicated", replay_log_version
+        )
+
+    if upstream_pool_size < 0:
+        raise ValueError(
+            "The upstream pool size can't be negative", upstream_pool_size
+        )
+    if upstream_pool_max_idle <= 0:
+        raise ValueError(
+            "The upstream pool idle age must be positive",
+            upstream_pool_max_idle,
+        )
+    if shutdown_timeout < 0:
+        raise ValueError(
+            "The shutdown timeout can't be negative", shutdown_timeout
+        )
+
+    capture_policy = None
+    if (
+        capture_sample_percent != 100.0
+        or capture_allow is not None
+        or capture_deny is not None
+        or capture_max_bytes is not None
+        or capture_framing is not None
+        or capture_passwords != "redact"
+    ):
+        capture_policy = _capture_policy.CapturePolicy(
+            sample_percent=capture_sample_percent,
+            allow=capture_allow,
+            deny=capture_deny,
+            max_bytes=capture_max_bytes,
+            framing=capture_framing,
+            passwords=capture_passwords,
+        )
+
+    # NOTE: The TLS contexts are created **before** forking any worker
+    #       processes, so that the workers share session ticket keys.
+    client_tls = None
+    if tls_certfile is not None:
+        client_tls = _tls.ClientTLS(
+            _tls.server_context(tls_certfile, tls_keyfile), direct=tls_direct
+        )
+    if upstreams is None:
+        upstreams = [(server_host, server_port)]
+    upstream_list = []
+    for spec in upstreams:
+        tls_upstream = None
+        if upstream_tls:
+            tls_upstream = _tls.UpstreamTLS(
+                spec[0],
+                cafile=upstream_tls_cafile,
+                verify=upstream_tls_verify,
+                direct=tls_direct,
+            )
+        upstream_list.append(_upstreams.make_upstream(spec, tls=tls_upstream))
+    if not upstream_list:
+        raise ValueError("At least one upstream is required", upstreams)
+
+    process_kwargs = {
+        "proxy_port": proxy_port,
+        "upstreams": upstream_list,
+        "balance": balance,
+        "health_check_interval": health_check_interval,
+        "sinks": sinks,
+        "engine": engine,
+        "backlog": backlog,
+        "max_connections": max_connections,
+        "overflow": overflow,
+        "zero_copy": zero_copy,
+        "capture": capture,
+        "capture_policy": capture_policy,
+        "capture_buffer_bytes": capture_buffer_bytes,
+        "capture_overflow": capture_overflow,
+        "client_tls": client_tls,
+        "upstream_pool_size": upstream_pool_size,
+        "upstream_pool_max_idle": upstream_pool_max_idle,
+        "metrics_port": metrics_port,
+        "metrics_callback": metrics_callback,
+        "metrics_interval": metrics_interval,
+        "shutdown_timeout": shutdown_timeout,
+        "writer_kwargs": {
+            "fsync_policy": fsync_policy,
+            "segment_bytes": segment_bytes,
+            "segment_seconds": segment_seconds,
+            "compression": segment_compression,
+            "index": index,
+            "capture_responses": capture_responses,
+            "dedup": dedup,
+            "version": replay_log_version,
+        },
+    }
+    if workers == 1:
+        _serve_process(
+            replay_log=replay_log, reuse_port=False, **process_kwargs
+        )
+    else:
+        _serve_workers(workers, replay_log, process_kwargs)
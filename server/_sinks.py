@@ -0,0 +1,154 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import queue
+import time
+
+import _metrics
+
+
+# Block a `get()` from the queue for 2 seconds.
+QUEUE_GET_TIMEOUT = 2.0
+QUEUE_EMPTY = object()  # Sentinel
+# Maximum number of log lines taken from the queue at once.
+BATCH_SIZE = 1024
+
+
+def _queue_get(queue_, timeout):
+    try:
+        return queue_.get(block=True, timeout=timeout)
+    except queue.Empty:
+        return QUEUE_EMPTY
+
+
+def get_batch(queue_, timeout):
+    """Get a batch of log lines from a queue.
+
+    Blocks (up to ``timeout``) for the first log line, then takes whatever
+    else is already in the queue, up to ``BATCH_SIZE`` log lines in total.
+
+    Args:
+        queue_ (queue.Queue): The queue where log lines are pushed.
+        timeout (float): The maximum time to block for the first log line.
+
+    Returns:
+        List[Tuple[int, bytes, _save_replay_log.Connection, int]]: The log
+        lines (possibly empty).
+    """
+    value = _queue_get(queue_, timeout)
+    if value is QUEUE_EMPTY:
+        return []
+
+    batch = [value]
+    while len(batch) < BATCH_SIZE:
+        try:
+            batch.append(queue_.get_nowait())
+        except queue.Empty:
+            break
+
+    return batch
+
+
+class Sink:
+    """A destination for captured log lines.
+
+    A single writer thread (see :func:`run_sinks`) takes batches of log
+    lines from the capture buffer and hands each batch to every sink, in
+    order. Every method is called from that thread, so a sink doesn't need
+    any locking of its own; however, while a sink blocks the writer, the
+    capture buffer fills up (and its overflow policy applies) for **every**
+    sink. A sink that does slow I/O (e.g. over the network) should hand
+    batches off to a thread of its own.
+
+    Each log line is a tuple of the timestamp (in nanoseconds since the
+    epoch), the TCP chunk, the :class:`_save_replay_log.Connection` it was
+    captured from and its direction (see :mod:`_replay_format`).
+
+    With several worker processes, each worker has its own copy of each
+    sink (the proxy forks after the sinks are created), so a sink should
+    open files, sockets or threads in ``start()`` rather than when it is
+    created.
+    """
+
+    def start(self):
+        """Prepare the sink, before the first batch is written."""
+
+    def write_batch(self, batch):
+        """Write a batch of log lines.
+
+        Args:
+            batch (List[Tuple[int, bytes, _save_replay_log.Connection, \
+                int]]): The log lines, oldest first.
+        """
+        raise NotImplementedError
+
+    def timeout(self):
+        """Determine how long the writer may wait before calling ``poll()``.
+
+        Returns:
+            Optional[float]: The time (in seconds), or :data:`None` if the
+            sink has no deadline.
+        """
+        return None
+
+    def poll(self):
+        """Do periodic work, e.g. flush buffered log lines.
+
+        This is called after every batch and whenever the writer has waited
+        ``timeout()`` seconds (or ``QUEUE_GET_TIMEOUT``) without one.
+        """
+
+    def close(self):
+        """Flush and close the sink, once every log line has been written."""
+
+
+def run_sinks(sinks, log_queue, done_event):
+    """Worker to hand log lines from a queue to several sinks.
+
+    This is intended to be launched in a thread to avoid blocking socket
+    I/O with the sinks' (file, network, etc.) I/O. It runs until
+    ``done_event`` is set and every log line in the queue has been written,
+    then closes each sink.
+
+    Args:
+        sinks (Sequence[Sink]): The sinks; each batch is written to every
+            sink, in order.
+        log_queue (queue.Queue): The queue where log lines will be pushed.
+        done_event (threading.Event): An event indicating the proxy that is
+            generating log lines is done.
+    """
+    started = []
+    try:
+        for sink in sinks:
+            sink.start()
+            started.append(sink)
+
+        while True:
+            if done_event.is_set() and log_queue.empty():
+                break
+
+            timeout = QUEUE_GET_TIMEOUT
+            for sink in sinks:
+                sink_timeout = sink.timeout()
+                if sink_timeout is not None:
+                    timeout = min(timeout, sink_timeout)
+            batch = get_batch(log_queue, timeout)
+            if batch:
+                # The oldest log line in the batch has waited the longest.
+                _metrics.WRITER_LAG.observe(time.time_ns() - batch[0][0])
+                for sink in sinks:
+                    sink.write_batch(batch)
+            for sink in sinks:
+                sink.poll()
+    finally:
+        for sink in started:
+            sink.close()
@@ -0,0 +1,337 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import queue
+import socket
+import struct
+import threading
+
+import _capture_buffer
+import _display
+import _metrics
+import _replay_format
+import _save_replay_log
+import _sinks
+
+
+# Each frame is ``[LENGTH][RECORDS]``, where ``LENGTH`` is the size of
+# ``RECORDS`` (one or more replay log records, each with a direction byte).
+FRAME_STRUCT = struct.Struct(">I")
+# Every connection to the collector starts with this replay log header, so
+# the frame payloads sent on it (concatenated) form a replay log.
+STREAM_HEADER = _replay_format.encode_header(_replay_format.FLAG_DIRECTION)
+# Default number of bytes of log lines held in memory while the collector
+# can't keep up (or can't be reached).
+BUFFER_BYTES = 0x4000000
+# - "drop": drop the newest log line and count it
+# - "spill": append the log line to a temporary file (dropping it instead
+#   if that would exceed ``max_spill_bytes``)
+OVERFLOW_POLICIES = ("drop", "spill")
+# Bounds (in seconds) for the exponential backoff between failed connects.
+MIN_BACKOFF = 0.1
+MAX_BACKOFF = 30.0
+# Maximum time (in seconds) to wait for a connection to the collector.
+CONNECT_TIMEOUT = 5.0
+# A send that makes no progress for this long (in seconds) is treated as a
+# lost connection.
+SEND_TIMEOUT = 30.0
+# Maximum time (in seconds) the sender thread waits for a batch before
+# checking if the sink is being closed.
+POLL_INTERVAL = 0.5
+# Default time (in seconds) ``close()`` waits for buffered log lines to be
+# sent before giving up on them.
+CLOSE_TIMEOUT = 5.0
+
+
+def encode_frame(batch):
+    """Encode a batch of log lines as a single frame.
+
+    Args:
+        batch (List[Tuple[int, bytes, _save_replay_log.Connection, int]]):
+            The log lines.
+
+    Returns:
+        bytes: The frame.
+    """
+    parts = []
+    for time_ns, tcp_chunk, connection, direction in batch:
+        parts.append(
+            _save_replay_log.TIMESTAMP_STRUCT.pack(time_ns)
+            + _replay_format.DIRECTION_STRUCT.pack(direction)
+            + connection.description
+            + _save_replay_log.LENGTH_STRUCT.pack(len(tcp_chunk))
+        )
+        parts.append(tcp_chunk)
+    payload = b"".join(parts)
+    return FRAME_STRUCT.pack(len(payload)) + payload
+
+
+def _describe(address):
+    if isinstance(address, tuple):
+        host, port = address
+        return f"{host}:{port}"
+    return os.fspath(address)
+
+
+class StreamSink(_sinks.Sink):
+    """A sink that streams log lines to a collector over a socket.
+
+    Batches of log lines are handed to a background thread (through a
+    buffer of their own), so that a slow or unreachable collector never
+    blocks the writer (or any other sink). The thread sends each batch as
+    a frame (see :func:`encode_frame`) on a TCP or UNIX socket; every
+    connection starts with ``STREAM_HEADER``, so a collector can strip the
+    ``LENGTH`` of each frame and append the rest to a file to get a replay
+    log.
+
+    If the connection fails, the frame being sent is kept and resent in
+    full on a new connection (a collector should discard a frame cut off
+    by a lost connection). Connect failures are reported (once per streak of
+    failures) and retried with exponential backoff. While the collector is
+    unreachable, log lines are held in memory, up to ``buffer_bytes``; the
+    ``overflow`` policy then either drops new log lines or spills them to
+    a temporary file (up to ``max_spill_bytes``).
+
+    .. note::
+
+        The collector doesn't acknowledge frames, so frames that had been
+        written to the socket (but not yet read by the collector) when the
+        connection is lost are not resent.
+
+    Args:
+        address (Union[Tuple[str, int], str, pathlib.Path]): The collector;
+            a ``(host, port)`` pair for TCP or a path for a UNIX socket.
+        buffer_bytes (Optional[int]): The maximum number of bytes
+            (approximately) of log lines held in memory.
+        overflow (Optional[str]): One of :data:`OVERFLOW_POLICIES`.
+        max_spill_bytes (Optional[int]): The maximum number of bytes
+            (approximately) of log lines spilled to disk, if limited.
+        close_timeout (Optional[float]): The time (in seconds) ``close()``
+            waits for buffered log lines to be sent.
+
+    Raises:
+        ValueError: If ``buffer_bytes`` is not positive.
+        ValueError: If ``overflow`` is not one of :data:`OVERFLOW_POLICIES`.
+    """
+
+    def __init__(
+        self,
+        address,
+        buffer_bytes=BUFFER_BYTES,
+        overflow="drop",
+        max_spill_bytes=None,
+        close_timeout=CLOSE_TIMEOUT,
+    ):
+        if buffer_bytes < 1:
+            raise ValueError(
+                "The stream buffer size must be positive", buffer_bytes
+            )
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(
+                f"Unsupported stream overflow policy {overflow!r}",
+                OVERFLOW_POLICIES,
+            )
+
+        self.address = address
+        self.addr = _describe(address)
+        self.buffer_bytes = buffer_bytes
+        self.overflow = overflow
+        self.max_spill_bytes = max_spill_bytes
+        self.close_timeout = close_timeout
+        self.connected = False
+        self.connect_failures = 0
+        self.disconnects = 0
+        self.sent_records = 0
+        self.sent_bytes = 0
+        self.unsent_records = 0
+        self._buffer = None
+        self._socket = None
+        self._socket_lock = threading.Lock()
+        self._closing = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start sending buffered log lines from a background thread."""
+        self._buffer = _capture_buffer.CaptureBuffer(
+            self.buffer_bytes,
+            self.overflow,
+            max_spill_bytes=self.max_spill_bytes,
+        )
+        self._thread = threading.Thread(target=self._send, daemon=True)
+        self._thread.start()
+        _metrics.register_stream_sink(self)
+
+    @property
+    def buffered_bytes(self):
+        """int: The approximate bytes of log lines held in memory."""
+        return self._buffer.num_bytes
+
+    @property
+    def dropped_records(self):
+        """int: The number of log lines dropped because the buffer was full."""
+        return self._buffer.dropped_records
+
+    @property
+    def spilled_records(self):
+        """int: The number of log lines spilled to disk."""
+        return self._buffer.spilled_records
+
+    def write_batch(self, batch):
+        """Hand a batch of log lines to the sender thread.
+
+        Args:
+            batch (List[Tuple[int, bytes, _save_replay_log.Connection, \
+                int]]): The log lines.
+        """
+        for item in batch:
+            self._buffer.put(item)
+
+    def _open(self):
+        if isinstance(self.address, tuple):
+            collector_socket = socket.create_connection(
+                self.address, timeout=CONNECT_TIMEOUT
+            )
+        else:
+            collector_socket = socket.socket(
+                socket.AF_UNIX, socket.SOCK_STREAM
+            )
+            collector_socket.settimeout(CONNECT_TIMEOUT)
+            try:
+                collector_socket.connect(os.fspath(self.address))
+            except OSError:
+                collector_socket.close()
+                raise
+
+        try:
+            collector_socket.settimeout(SEND_TIMEOUT)
+            collector_socket.sendall(STREAM_HEADER)
+        except OSError:
+            collector_socket.close()
+            raise
+        return collector_socket
+
+    def _connect(self, backoff):
+        """Connect to the collector, waiting ``backoff`` if that fails.
+
+        Returns:
+            bool: Indicates if the sink is now connected.
+        """
+        try:
+            collector_socket = self._open()
+        except OSError as exc:
+            self.connect_failures += 1
+            if backoff == MIN_BACKOFF:
+                _display.display(
+                    "Stream sink failed to connect to "
+                    f"collector({self.addr}): {exc}"
+                )
+            self._stopped.wait(backoff)
+            return False
+
+        with self._socket_lock:
+            self._socket = collector_socket
+        self.connected = True
+        _display.display(f"Stream sink connected to collector({self.addr})")
+        return True
+
+    def _disconnect(self):
+        with self._socket_lock:
+            collector_socket, self._socket = self._socket, None
+        self.connected = False
+        if collector_socket is not None:
+            collector_socket.close()
+
+    def _send(self):
+        backoff = MIN_BACKOFF
+        frame = None
+        while not self._stopped.is_set():
+            if frame is None:
+                batch = _sinks.get_batch(self._buffer, POLL_INTERVAL)
+                if not batch:
+                    if self._closing.is_set():
+                        break
+                    continue
+                frame = encode_frame(batch)
+                frame_records = len(batch)
+
+            if self._socket is None:
+                if not self._connect(backoff):
+                    backoff = min(2 * backoff, MAX_BACKOFF)
+                    continue
+                backoff = MIN_BACKOFF
+
+            try:
+                self._socket.sendall(frame)
+            except OSError as exc:
+                if not self._stopped.is_set():
+                    self.disconnects += 1
+                    _display.display(
+                        "Stream sink lost connection to "
+                        f"collector({self.addr}): {exc}"
+                    )
+                self._disconnect()
+                continue
+
+            self.sent_records += frame_records
+            self.sent_bytes += len(frame)
+            frame = None
+
+        if frame is not None:
+            self.unsent_records += frame_records
+        self._disconnect()
+
+    def close(self):
+        """Send the buffered log lines (for up to ``close_timeout`` seconds).
+
+        Log lines still buffered after ``close_timeout`` are counted and
+        discarded.
+        """
+        self._closing.set()
+        self._thread.join(self.close_timeout)
+        if self._thread.is_alive():
+            self._stopped.set()
+            with self._socket_lock:
+                if self._socket is not None:
+                    # Interrupt a blocked ``sendall()``.
+                    try:
+                        self._socket.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+            self._thread.join()
+
+        while True:
+            try:
+                self._buffer.get_nowait()
+            except queue.Empty:
+                break
+            self.unsent_records += 1
+        self._buffer.close()
+        self.display_summary()
+
+    def display_summary(self):
+        """Display how many log lines were sent, dropped or never sent."""
+        _display.display(
+            f"Streamed {self.sent_records} log lines ({self.sent_bytes} "
+            f"bytes) to collector({self.addr})"
+        )
+        if self.dropped_records:
+            _display.display(
+                f"Stream to collector({self.addr}) is INCOMPLETE: dropped "
+                f"{self.dropped_records} log lines (buffer full)"
+            )
+        if self.unsent_records:
+            _display.display(
+                f"Stream to collector({self.addr}) is INCOMPLETE: gave up "
+                f"on {self.unsent_records} unsent log lines"
+            )
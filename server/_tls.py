@@ -0,0 +1,460 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import select
+import socket
+import ssl
+import struct
+import threading
+import time
+
+import _buffer
+import _metrics
+import _postgres
+
+
+# Maximum time (in seconds) to wait for a TLS handshake to complete.
+HANDSHAKE_TIMEOUT = 10.0
+# Errors raised by a non-blocking TLS socket that should be retried once the
+# socket is ready.
+WANT_ERRORS = (ssl.SSLWantReadError, ssl.SSLWantWriteError)
+# A PostgreSQL client asks for TLS with an ``SSLRequest`` (``[LENGTH][CODE]``,
+# with no type byte) and starts the handshake once the server replies
+# ``ACCEPT_TLS``; ``REFUSE`` declines the request (e.g. a ``GSSENCRequest``).
+REQUEST_STRUCT = struct.Struct(">II")
+ACCEPT_TLS = b"S"
+REFUSE = b"N"
+# How long (in seconds) to wait before peeking again at a partially received
+# request.
+PEEK_INTERVAL = 0.01
+
+
+class TLSSocket:
+    """A non-blocking TLS socket that is relayed from two threads at once.
+
+    OpenSSL doesn't allow a TLS connection to be used from several threads
+    at once, but each direction of a relayed connection runs in its own
+    thread. Every call into the TLS connection therefore holds a lock; since
+    the socket is non-blocking, the lock is never held while waiting.
+
+    A call that must be retried once the socket is ready raises
+    :exc:`BlockingIOError` (rather than :exc:`ssl.SSLWantReadError` or
+    :exc:`ssl.SSLWantWriteError`), just like a plain non-blocking socket,
+    so that it can be relayed with the functions in :mod:`_buffer`.
+
+    Args:
+        tls_socket (ssl.SSLSocket): The (non-blocking) TLS socket, with its
+            handshake complete.
+    """
+
+    def __init__(self, tls_socket):
+        self.tls_socket = tls_socket
+        self._lock = threading.Lock()
+
+    def fileno(self):
+        return self.tls_socket.fileno()
+
+    def getpeername(self):
+        return self.tls_socket.getpeername()
+
+    @property
+    def session(self):
+        """Optional[ssl.SSLSession]: The TLS session of the connection."""
+        with self._lock:
+            return self.tls_socket.session
+
+    def pending(self):
+        """Get the number of decrypted bytes that can be read immediately.
+
+        These bytes have already been read from the socket, so waiting for
+        the socket to be readable won't report them.
+
+        Returns:
+            int: The number of bytes.
+        """
+        with self._lock:
+            return self.tls_socket.pending()
+
+    def recv(self, size):
+        """Read decrypted bytes; see :meth:`socket.socket.recv`."""
+        with self._lock:
+            try:
+                return self.tls_socket.recv(size)
+            except WANT_ERRORS as exc:
+                raise BlockingIOError(errno.EAGAIN, str(exc)) from exc
+
+    def recv_into(self, buffer_view):
+        """Read decrypted bytes; see :meth:`socket.socket.recv_into`."""
+        with self._lock:
+            try:
+                return self.tls_socket.recv_into(buffer_view)
+            except WANT_ERRORS as exc:
+                raise BlockingIOError(errno.EAGAIN, str(exc)) from exc
+
+    def send(self, data):
+        """Encrypt and send bytes; see :meth:`socket.socket.send`."""
+        with self._lock:
+            try:
+                return self.tls_socket.send(data)
+            except WANT_ERRORS as exc:
+                raise BlockingIOError(errno.EAGAIN, str(exc)) from exc
+
+    def close(self):
+        self.tls_socket.close()
+
+
+def _handshake(tls_socket, tls_metrics, timeout):
+    """Complete the handshake on a non-blocking TLS socket.
+
+    Args:
+        tls_socket (ssl.SSLSocket): The TLS socket, created with
+            ``do_handshake_on_connect=False``.
+        tls_metrics (_metrics.TLSMetrics): The metrics to update.
+        timeout (float): The maximum time (in seconds) to wait for the
+            handshake to complete.
+
+    Returns:
+        TLSSocket: The TLS socket, ready to be relayed.
+
+    Raises:
+        OSError: If the handshake fails or times out. The TLS socket is
+            closed in this case.
+    """
+    start = time.monotonic()
+    deadline = start + timeout
+    try:
+        while True:
+            try:
+                tls_socket.do_handshake()
+                break
+            except ssl.SSLWantReadError:
+                events = select.POLLIN
+            except ssl.SSLWantWriteError:
+                events = select.POLLOUT
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not _buffer.wait_for(
+                tls_socket, events, remaining
+            ):
+                raise TimeoutError(
+                    errno.ETIMEDOUT, "Timed out during TLS handshake"
+                )
+    except OSError:
+        tls_metrics.failures.inc()
+        tls_socket.close()
+        raise
+
+    tls_metrics.handshakes.inc()
+    if tls_socket.session_reused:
+        tls_metrics.resumed.inc()
+    tls_metrics.latency.observe(int(1e9 * (time.monotonic() - start)))
+    return TLSSocket(tls_socket)
+
+
+def _remaining(deadline):
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError(errno.ETIMEDOUT, "Timed out negotiating TLS")
+    return remaining
+
+
+def _wait(socket_, events, deadline):
+    if not _buffer.wait_for(socket_, events, _remaining(deadline)):
+        raise TimeoutError(errno.ETIMEDOUT, "Timed out negotiating TLS")
+
+
+def _send_all(socket_, data, deadline):
+    view = memoryview(data)
+    while view:
+        try:
+            view = view[socket_.send(view) :]
+        except BlockingIOError:
+            _wait(socket_, select.POLLOUT, deadline)
+
+
+def _recv_exact(socket_, size, deadline):
+    data = b""
+    while len(data) < size:
+        try:
+            chunk = socket_.recv(size - len(data))
+        except BlockingIOError:
+            _wait(socket_, select.POLLIN, deadline)
+            continue
+        if not chunk:
+            raise ConnectionResetError(
+                errno.ECONNRESET, "Connection closed while negotiating TLS"
+            )
+        data += chunk
+    return data
+
+
+def _peek_request(client_socket, deadline):
+    """Peek at the first packet from a PostgreSQL client.
+
+    Nothing is consumed, so a packet that isn't a request can be relayed
+    as is.
+
+    Args:
+        client_socket (socket.socket): The (non-blocking) client socket.
+        deadline (float): The time (from :func:`time.monotonic`) to give up.
+
+    Returns:
+        Optional[int]: The code of the request (e.g. ``SSLRequest``) if the
+        packet is one, otherwise :data:`None` (e.g. for a startup packet, or
+        if the client disconnected).
+
+    Raises:
+        TimeoutError: If the packet doesn't arrive before ``deadline``.
+    """
+    while True:
+        _wait(client_socket, select.POLLIN, deadline)
+        try:
+            data = client_socket.recv(REQUEST_STRUCT.size, socket.MSG_PEEK)
+        except BlockingIOError:
+            continue
+        if not data:
+            return None
+        if len(data) == REQUEST_STRUCT.size:
+            break
+        # NOTE: The socket stays readable while part of the request is
+        #       buffered, so wait a little before peeking again.
+        time.sleep(PEEK_INTERVAL)
+
+    length, code = REQUEST_STRUCT.unpack(data)
+    if length != REQUEST_STRUCT.size:
+        return None
+    return code
+
+
+def server_context(certfile, keyfile=None):
+    """Create the TLS context used to terminate TLS from clients.
+
+    Session resumption is left on (OpenSSL enables both a session cache and
+    session tickets for a server by default), so that a reconnecting client
+    can skip the full handshake. Since the ticket keys belong to the
+    context, a context created **before** forking worker processes lets a
+    client resume a session with any of the workers.
+
+    Args:
+        certfile (str): The PEM file with the certificate chain presented
+            to clients.
+        keyfile (Optional[str]): The PEM file with the private key, if it
+            isn't in ``certfile``.
+
+    Returns:
+        ssl.SSLContext: The context.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile, keyfile)
+    return context
+
+
+def accept(context, client_socket, timeout=HANDSHAKE_TIMEOUT):
+    """Terminate TLS for a newly accepted client.
+
+    Args:
+        context (ssl.SSLContext): The server context, from
+            :func:`server_context`.
+        client_socket (socket.socket): The (non-blocking) client socket. It
+            is detached by this call, whether or not the handshake succeeds.
+        timeout (Optional[float]): The maximum time (in seconds) to wait for
+            the handshake to complete.
+
+    Returns:
+        TLSSocket: The client connection, ready to be relayed.
+
+    Raises:
+        OSError: If the handshake fails or times out.
+    """
+    tls_socket = context.wrap_socket(
+        client_socket, server_side=True, do_handshake_on_connect=False
+    )
+    return _handshake(tls_socket, _metrics.TLS["client"], timeout)
+
+
+class ClientTLS:
+    """Terminates TLS from clients.
+
+    By default, TLS is negotiated the way PostgreSQL does it: a client that
+    wants TLS first sends a plaintext ``SSLRequest``, which is answered
+    with ``ACCEPT_TLS`` before the handshake. A ``GSSENCRequest`` is
+    refused (the client may then send an ``SSLRequest``). A client that
+    doesn't ask for TLS (e.g. a ``CancelRequest`` or a startup packet with
+    ``sslmode=disable``) is relayed as plaintext, leaving it to the server
+    to decide if that is allowed. With ``direct``, the handshake instead
+    starts on the first bytes of the connection, as for most protocols
+    (and PostgreSQL 17 clients with ``sslnegotiation=direct``).
+
+    Args:
+        context (ssl.SSLContext): The server context, from
+            :func:`server_context`.
+        direct (Optional[bool]): Indicates if the handshake starts
+            immediately rather than after an ``SSLRequest``.
+    """
+
+    def __init__(self, context, direct=False):
+        self.context = context
+        self.direct = direct
+
+    def _negotiate(self, client_socket, deadline):
+        """Answer the requests that precede a PostgreSQL TLS handshake.
+
+        Returns:
+            bool: Indicates if the client asked for TLS.
+        """
+        code = _peek_request(client_socket, deadline)
+        if code == _postgres.GSSENC_REQUEST_CODE:
+            _recv_exact(client_socket, REQUEST_STRUCT.size, deadline)
+            _send_all(client_socket, REFUSE, deadline)
+            code = _peek_request(client_socket, deadline)
+        if code != _postgres.SSL_REQUEST_CODE:
+            return False
+
+        _recv_exact(client_socket, REQUEST_STRUCT.size, deadline)
+        _send_all(client_socket, ACCEPT_TLS, deadline)
+        return True
+
+    def accept(self, client_socket, timeout=HANDSHAKE_TIMEOUT):
+        """Terminate TLS for a newly accepted client.
+
+        Args:
+            client_socket (socket.socket): The (non-blocking) client socket.
+                It is detached by this call if TLS is negotiated, whether
+                or not the handshake succeeds.
+            timeout (Optional[float]): The maximum time (in seconds) to wait
+                for the negotiation and handshake to complete.
+
+        Returns:
+            Union[TLSSocket, socket.socket]: The client connection, ready
+            to be relayed; the plain client socket if the client didn't ask
+            for TLS.
+
+        Raises:
+            OSError: If the negotiation or handshake fails or times out. The
+                client socket is closed in this case.
+        """
+        if not self.direct:
+            deadline = time.monotonic() + timeout
+            try:
+                if not self._negotiate(client_socket, deadline):
+                    return client_socket
+                timeout = _remaining(deadline)
+            except OSError:
+                _metrics.TLS["client"].failures.inc()
+                client_socket.close()
+                raise
+        return accept(self.context, client_socket, timeout)
+
+
+class UpstreamTLS:
+    """Originates TLS to the server, resuming sessions where possible.
+
+    The most recent session with the server is kept and offered on the next
+    connection, so that only the first connection (and any connection after
+    the server stops accepting the session) pays for a full handshake.
+
+    As with :class:`ClientTLS`, TLS is negotiated the way PostgreSQL does
+    it by default: an ``SSLRequest`` is sent and the handshake starts once
+    the server accepts it. With ``direct``, the handshake starts
+    immediately.
+
+    Args:
+        server_hostname (str): The host name the server's certificate is
+            checked against (if ``verify`` is set).
+        cafile (Optional[str]): The PEM file with the certificate authorities
+            to trust; if not set, the system defaults are used.
+        verify (Optional[bool]): Indicates if the server's certificate should
+            be verified.
+        direct (Optional[bool]): Indicates if the handshake starts
+            immediately rather than after an ``SSLRequest``.
+    """
+
+    def __init__(
+        self, server_hostname, cafile=None, verify=True, direct=False
+    ):
+        context = ssl.create_default_context(cafile=cafile)
+        if not verify:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        self.context = context
+        self.server_hostname = server_hostname
+        self.direct = direct
+        self._session = None
+        self._lock = threading.Lock()
+
+    def wrap(self, server_socket, timeout=HANDSHAKE_TIMEOUT):
+        """Originate TLS on a connection to the server.
+
+        Args:
+            server_socket (socket.socket): The (connected, non-blocking)
+                server socket. It is detached by this call, whether or not
+                the handshake succeeds.
+            timeout (Optional[float]): The maximum time (in seconds) to wait
+                for the handshake to complete.
+
+        Returns:
+            TLSSocket: The server connection, ready to be relayed.
+
+        Raises:
+            OSError: If the server refuses TLS, or the handshake fails or
+                times out.
+        """
+        if not self.direct:
+            deadline = time.monotonic() + timeout
+            try:
+                _send_all(
+                    server_socket,
+                    REQUEST_STRUCT.pack(
+                        REQUEST_STRUCT.size, _postgres.SSL_REQUEST_CODE
+                    ),
+                    deadline,
+                )
+                reply = _recv_exact(server_socket, len(ACCEPT_TLS), deadline)
+                if reply != ACCEPT_TLS:
+                    raise ConnectionRefusedError(
+                        errno.ECONNREFUSED, "Server refused the SSLRequest"
+                    )
+                timeout = _remaining(deadline)
+            except OSError:
+                _metrics.TLS["upstream"].failures.inc()
+                server_socket.close()
+                raise
+
+        with self._lock:
+            session = self._session
+        tls_socket = self.context.wrap_socket(
+            server_socket,
+            server_hostname=self.server_hostname,
+            do_handshake_on_connect=False,
+            session=session,
+        )
+        tls_socket = _handshake(tls_socket, _metrics.TLS["upstream"], timeout)
+        self.save_session(tls_socket)
+        return tls_socket
+
+    def save_session(self, tls_socket):
+        """Keep the session of a connection to offer on the next one.
+
+        With TLS 1.3 the server only sends a session ticket after the
+        handshake, so this should also be called once a connection is done.
+
+        Args:
+            tls_socket (TLSSocket): A connection to the server.
+        """
+        session = tls_socket.session
+        if session is None or not session.has_ticket:
+            # NOTE: Keep the previous session rather than replacing it with
+            #       one that can't be resumed.
+            return
+        with self._lock:
+            self._session = session
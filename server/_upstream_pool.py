@@ -0,0 +1,209 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import select
+import socket
+import threading
+import time
+
+import _buffer
+import _connect
+import _display
+import _keepalive
+import _metrics
+
+
+# Default age (in seconds) at which idle sockets are closed (and replaced),
+# so that they are handed out well before the server gives up on
+# a connection that never sent anything (e.g. ``authentication_timeout``
+# for PostgreSQL defaults to one minute).
+MAX_IDLE = 30.0
+# How often (in seconds) the refill thread checks idle sockets when it
+# isn't woken up by a socket being taken.
+CHECK_INTERVAL = 1.0
+# Bounds (in seconds) for the exponential backoff between failed connects.
+MIN_BACKOFF = 0.05
+MAX_BACKOFF = 5.0
+
+
+def _is_alive(server_socket):
+    """Check if an idle (non-blocking) server socket is still usable.
+
+    An idle socket is only readable if the server has closed it, reset it
+    or already sent something (e.g. a greeting). In the last case the data
+    stays in the kernel and is relayed once a client takes the socket.
+
+    Args:
+        server_socket (socket.socket): An idle connection to the server.
+
+    Returns:
+        bool: Indicates if the socket can still be handed to a client.
+    """
+    if not _buffer.wait_for(server_socket, select.POLLIN, 0):
+        return True
+
+    try:
+        return server_socket.recv(1, socket.MSG_PEEK) != b""
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+
+
+class UpstreamPool:
+    """A pool of pre-established connections to the server.
+
+    A background thread keeps up to ``size`` idle connections open (with
+    keepalive set) and opens a replacement each time one is taken, so that
+    an accepted client can be relayed without waiting for a new connection
+    to the server. Connect failures are counted and reported (once per
+    streak of failures) and retried with exponential backoff.
+
+    ``get()`` never blocks, so it can be called from an event loop; if the
+    pool is empty it returns :data:`None` and the caller should connect
+    directly.
+
+    Args:
+        server_host (str): The host name where the server process is
+            running (i.e. the server that is being proxied).
+        server_port (int): A port number for a running "server" process.
+        size (int): The target number of idle connections.
+        keep_alive_interval (int): The number of seconds to use for
+            keepalive on each connection.
+        max_idle (Optional[float]): The age (in seconds) at which an idle
+            connection is closed and replaced.
+    """
+
+    def __init__(
+        self,
+        server_host,
+        server_port,
+        size,
+        keep_alive_interval,
+        max_idle=MAX_IDLE,
+    ):
+        self.server_host = server_host
+        self.server_port = server_port
+        self.size = size
+        self.keep_alive_interval = keep_alive_interval
+        self.max_idle = max_idle
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        # Pairs of (time connected, socket); the oldest socket is first.
+        self._idle = collections.deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._refill, daemon=True)
+
+    def qsize(self):
+        """Get the number of idle connections.
+
+        Returns:
+            int: The number of idle connections.
+        """
+        return len(self._idle)
+
+    def start(self):
+        """Start filling the pool from a background thread."""
+        self._thread.start()
+
+    def get(self):
+        """Take an idle connection from the pool.
+
+        The oldest idle connection is handed out first, so that fewer
+        connections reach ``max_idle``; connections that the server has
+        closed are discarded.
+
+        Returns:
+            Optional[socket.socket]: A connected (non-blocking) socket, or
+            :data:`None` if the pool is empty.
+        """
+        self._wakeup.set()
+        while True:
+            with self._lock:
+                if not self._idle:
+                    self.misses += 1
+                    return None
+                _, server_socket = self._idle.popleft()
+                alive = _is_alive(server_socket)
+                if alive:
+                    self.hits += 1
+                else:
+                    self.expired += 1
+
+            if alive:
+                return server_socket
+            server_socket.close()
+
+    def _expire(self):
+        """Close idle connections that are too old or have been closed."""
+        deadline = time.monotonic() - self.max_idle
+        with self._lock:
+            keep = collections.deque()
+            expired = []
+            for connected, server_socket in self._idle:
+                if connected < deadline or not _is_alive(server_socket):
+                    expired.append(server_socket)
+                else:
+                    keep.append((connected, server_socket))
+            self._idle = keep
+            self.expired += len(expired)
+
+        for server_socket in expired:
+            server_socket.close()
+
+    def _refill(self):
+        server_addr = f"{self.server_host}:{self.server_port}"
+        backoff = MIN_BACKOFF
+        while not self._stopped.is_set():
+            # NOTE: This is cleared **before** checking the pool, so that a
+            #       socket taken during the check isn't missed.
+            self._wakeup.clear()
+            self._expire()
+            while self.qsize() < self.size and not self._stopped.is_set():
+                try:
+                    server_socket = _connect.open_upstream(
+                        self.server_host, self.server_port
+                    )
+                except OSError as exc:
+                    _metrics.CONNECT_FAILURES.inc()
+                    if backoff == MIN_BACKOFF:
+                        _display.display(
+                            "Upstream pool failed to connect to "
+                            f"server({server_addr}): {exc}"
+                        )
+                    self._stopped.wait(backoff)
+                    backoff = min(2 * backoff, MAX_BACKOFF)
+                    continue
+
+                backoff = MIN_BACKOFF
+                _keepalive.set_keepalive(
+                    server_socket, self.keep_alive_interval
+                )
+                with self._lock:
+                    self._idle.append((time.monotonic(), server_socket))
+
+            self._wakeup.wait(CHECK_INTERVAL)
+
+    def close(self):
+        """Stop the background thread and close every idle connection."""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        with self._lock:
+            idle, self._idle = self._idle, collections.deque()
+        for _, server_socket in idle:
+            server_socket.close()
@@ -0,0 +1,278 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+
+import _connect
+import _display
+import _upstream_pool
+
+
+# How a server is chosen for each new connection:
+# - "least-connections": the server with the fewest active connections
+#   (relative to its weight)
+# - "weighted": servers take turns in proportion to their weights (smooth
+#   weighted round-robin)
+BALANCE_POLICIES = ("least-connections", "weighted")
+# Time (in seconds) between health checks of each server.
+HEALTH_CHECK_INTERVAL = 5.0
+# Maximum time (in seconds) a health check waits for a connection.
+HEALTH_CHECK_TIMEOUT = 2.0
+# Number of consecutive failed health checks before a server is taken out of
+# rotation. A single successful check puts it back.
+UNHEALTHY_THRESHOLD = 2
+
+
+class Upstream:
+    """A server that connections can be relayed to.
+
+    Args:
+        host (str): The host name where the server process is running.
+        port (int): A port number for a running "server" process.
+        weight (Optional[int]): The relative share of connections the server
+            should be given.
+        tls (Optional[_tls.UpstreamTLS]): Originates TLS to the server, if
+            set.
+    """
+
+    def __init__(self, host, port, weight=1, tls=None):
+        self.host = host
+        self.port = port
+        self.weight = weight
+        self.tls = tls
+        self.pool = None
+        self.active = 0
+        self.healthy = True
+        # Consecutive failed health checks.
+        self.failures = 0
+        self.health_check_failures = 0
+        # Used by the "weighted" balance policy.
+        self.current_weight = 0
+
+    @property
+    def addr(self):
+        """str: The address (host and port) of the server."""
+        return f"{self.host}:{self.port}"
+
+
+def make_upstream(spec, tls=None):
+    """Create a server from a ``(host, port)`` or ``(host, port, weight)``.
+
+    Args:
+        spec (Tuple[str, int, ...]): The server address, optionally followed
+            by its weight.
+        tls (Optional[_tls.UpstreamTLS]): Originates TLS to the server, if
+            set.
+
+    Returns:
+        Upstream: The server.
+
+    Raises:
+        ValueError: If ``spec`` doesn't have two or three entries.
+        ValueError: If the weight is not positive.
+    """
+    if len(spec) == 2:
+        host, port = spec
+        weight = 1
+    elif len(spec) == 3:
+        host, port, weight = spec
+    else:
+        raise ValueError(
+            "An upstream must be (host, port) or (host, port, weight)", spec
+        )
+
+    if weight < 1:
+        raise ValueError("An upstream weight must be positive", spec)
+
+    return Upstream(host, port, weight=weight, tls=tls)
+
+
+class UpstreamGroup:
+    """The servers that connections are balanced across.
+
+    Each connection is relayed to a server chosen by ``acquire()`` and must
+    be handed back with ``release()`` once it is done, so that the number of
+    active connections per server stays accurate.
+
+    If there is more than one server, a background thread checks each
+    server (by opening and closing a TCP connection) every
+    ``health_check_interval`` seconds. A server that fails
+    :data:`UNHEALTHY_THRESHOLD` checks in a row is taken out of rotation
+    until a check succeeds again. If **every** server is out of rotation,
+    connections are balanced across all of them anyway (so a client gets a
+    connection error rather than being dropped by the proxy).
+
+    Args:
+        upstreams (Sequence[Upstream]): The servers.
+        balance (Optional[str]): How a server is chosen for each
+            connection; one of :data:`BALANCE_POLICIES`.
+        health_check_interval (Optional[float]): The time (in seconds)
+            between health checks of each server.
+        health_check_timeout (Optional[float]): The maximum time (in seconds)
+            a health check waits for a connection.
+    """
+
+    def __init__(
+        self,
+        upstreams,
+        balance="least-connections",
+        health_check_interval=HEALTH_CHECK_INTERVAL,
+        health_check_timeout=HEALTH_CHECK_TIMEOUT,
+    ):
+        self.upstreams = upstreams
+        self.balance = balance
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+        # The server checked first by the next "least-connections" choice,
+        # so that ties are broken round-robin.
+        self._next = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._check, daemon=True)
+
+    def start_pools(self, size, keep_alive_interval, max_idle):
+        """Keep a pool of idle connections open to each server.
+
+        Args:
+            size (int): The target number of idle connections per server.
+            keep_alive_interval (int): The number of seconds to use for
+                keepalive on each connection.
+            max_idle (float): The age (in seconds) at which an idle
+                connection is closed and replaced.
+        """
+        for upstream in self.upstreams:
+            upstream.pool = _upstream_pool.UpstreamPool(
+                upstream.host,
+                upstream.port,
+                size,
+                keep_alive_interval,
+                max_idle=max_idle,
+            )
+            upstream.pool.start()
+
+    def start(self):
+        """Start checking the health of each server from a background thread.
+
+        This does nothing if there is only one server, since it would be
+        chosen whether or not it is healthy.
+        """
+        if len(self.upstreams) > 1:
+            self._thread.start()
+
+    def _least_connections(self, candidates):
+        count = len(candidates)
+        chosen = None
+        for offset in range(count):
+            upstream = candidates[(self._next + offset) % count]
+            # NOTE: Compare `active / weight` without dividing.
+            if (
+                chosen is None
+                or upstream.active * chosen.weight
+                < chosen.active * upstream.weight
+            ):
+                chosen = upstream
+        self._next = (self._next + 1) % count
+        return chosen
+
+    def _weighted(self, candidates):
+        total = 0
+        chosen = None
+        for upstream in candidates:
+            upstream.current_weight += upstream.weight
+            total += upstream.weight
+            if (
+                chosen is None
+                or upstream.current_weight > chosen.current_weight
+            ):
+                chosen = upstream
+        chosen.current_weight -= total
+        return chosen
+
+    def acquire(self):
+        """Choose the server to relay a new connection to.
+
+        Returns:
+            Upstream: The server; its active connection count has been
+            incremented.
+        """
+        with self._lock:
+            candidates = [
+                upstream for upstream in self.upstreams if upstream.healthy
+            ]
+            if not candidates:
+                candidates = self.upstreams
+
+            if len(candidates) == 1:
+                chosen = candidates[0]
+            elif self.balance == "weighted":
+                chosen = self._weighted(candidates)
+            else:
+                chosen = self._least_connections(candidates)
+            chosen.active += 1
+        return chosen
+
+    def release(self, upstream):
+        """Hand back a server once a connection relayed to it is done.
+
+        Args:
+            upstream (Upstream): The server returned by ``acquire()``.
+        """
+        with self._lock:
+            upstream.active -= 1
+
+    def _check_one(self, upstream):
+        try:
+            server_socket = _connect.open_upstream(
+                upstream.host, upstream.port, self.health_check_timeout
+            )
+        except OSError as exc:
+            with self._lock:
+                upstream.health_check_failures += 1
+                upstream.failures += 1
+                taken_out = (
+                    upstream.healthy
+                    and upstream.failures >= UNHEALTHY_THRESHOLD
+                )
+                if taken_out:
+                    upstream.healthy = False
+            if taken_out:
+                _display.display(
+                    f"Taking server({upstream.addr}) out of rotation after "
+                    f"{upstream.failures} failed health checks: {exc}"
+                )
+            return
+
+        server_socket.close()
+        with self._lock:
+            upstream.failures = 0
+            put_back = not upstream.healthy
+            upstream.healthy = True
+        if put_back:
+            _display.display(
+                f"Putting server({upstream.addr}) back in rotation"
+            )
+
+    def _check(self):
+        while not self._stopped.wait(self.health_check_interval):
+            for upstream in self.upstreams:
+                if self._stopped.is_set():
+                    return
+                self._check_one(upstream)
+
+    def close(self):
+        """Stop the health checks and close each server's idle connections."""
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        for upstream in self.upstreams:
+            if upstream.pool is not None:
+                upstream.pool.close()